@@ -0,0 +1,412 @@
+"""医疗数据标注工具的性能基准：生成合成数据集并计时导入、筛选、翻页、保存标注、导出、类别映射和多人并发标注
+
+结果以JSON输出，便于不同版本/机器之间对比：
+    python benchmark.py --cases 100000 --diseases 1000 -o results.json
+    python benchmark.py --preset large --format xlsx
+"""
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import sqlite3
+import platform
+import tempfile
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from engine import (
+    DISEASE_SEPARATOR, REQUIRED_COLUMNS, PREFETCH_AHEAD, PREFETCH_BEHIND,
+    AnnotationEngine, CaseCache, AnnotationWriter,
+)
+
+# 结果JSON的格式版本，字段变化时递增
+RESULT_VERSION = 2
+
+# 预设规模：(病例数, 疾病类别数)
+PRESETS = {
+    'small': (10000, 100),
+    'medium': (100000, 1000),
+    'large': (1000000, 10000),
+}
+
+# 合成疾病名称的组成部分
+ORGANS = ['肺', '肝', '肾', '胃', '心', '脑', '甲状腺', '胰腺', '结肠', '乳腺',
+          '前列腺', '膀胱', '食管', '胆囊', '脾', '骨', '皮肤', '卵巢', '子宫', '淋巴结']
+CONDITIONS = ['炎', '癌', '结节', '囊肿', '结石', '纤维化', '梗死', '出血', '功能不全', '增生',
+              '息肉', '肿大', '萎缩', '损伤', '感染', '硬化', '钙化', '积液', '腺瘤', '狭窄']
+
+# 合成病历文本的短语（描述约100~600字，诊断约10~60字）
+DESCRIPTION_PHRASES = [
+    '患者自述', '反复咳嗽咳痰', '伴胸闷气短', '活动后加重', '夜间不能平卧', '无发热寒战',
+    '食欲下降', '体重减轻约5公斤', '腹部隐痛', '进食后明显', '大便颜色变黑', '尿频尿急',
+    '既往高血压病史十年', '规律服用降压药物', '否认糖尿病史', '吸烟二十年', '每日一包',
+    '查体：神志清楚', '双肺呼吸音粗', '可闻及湿啰音', '心律齐', '未闻及病理性杂音', '腹软',
+    '肝脾肋下未触及', '双下肢轻度水肿', '血常规提示白细胞升高', 'CT示右肺下叶斑片影',
+    '超声示肝内多发低回声结节', '肿瘤标志物轻度升高', '建议进一步检查', '。', '，',
+]
+DIAGNOSIS_PHRASES = [
+    '考虑', '不除外', '待排', '慢性', '急性', '合并', '伴', '继发', '可能性大', '术后复查',
+]
+
+# 结果中保留的延迟分位数
+PERCENTILES = (50, 90, 99)
+
+# 并发标注：每个标注员修改公共病例（而不是自己任务中的病例）的比例，以及每修改多少条写回一次
+HOT_EDIT_RATE = 0.05
+SESSION_FLUSH_EVERY = 20
+
+def disease_names(count):
+    """生成 count 个互不相同的疾病名称（器官×病变组合，超出后加分型后缀）"""
+    combos = len(ORGANS) * len(CONDITIONS)
+    names = []
+    for i in range(count):
+        name = ORGANS[i % len(ORGANS)] + CONDITIONS[(i // len(ORGANS)) % len(CONDITIONS)]
+        if i >= combos:
+            name += f"（{i // combos}型）"
+        names.append(name)
+    return names
+
+def generate_rows(cases, diseases, seed=0):
+    """按 id/描述/诊断/标注 的结构逐行生成合成病例
+    
+    类别按排名近似Zipf分布（少数常见病覆盖大部分病例），约20%的病例未标注。
+    """
+    rng = random.Random(seed)
+    names = disease_names(diseases)
+    cum_weights = []
+    total = 0.0
+    for rank in range(len(names)):
+        total += 1.0 / (rank + 1)
+        cum_weights.append(total)
+    
+    width = len(str(cases))
+    for i in range(cases):
+        description = "".join(rng.choices(DESCRIPTION_PHRASES, k=rng.randint(15, 80)))
+        labels = list(dict.fromkeys(rng.choices(names, cum_weights=cum_weights, k=rng.randint(1, 3))))
+        diagnosis = "".join(rng.choice(DIAGNOSIS_PHRASES) + label for label in labels)
+        annotations = DISEASE_SEPARATOR.join(labels) if rng.random() >= 0.2 else ""
+        yield (f"C{i:0{width}d}", description, diagnosis, annotations)
+
+def write_dataset(file_path, rows):
+    """把合成病例写为 .csv 或 .xlsx（按扩展名），返回行数"""
+    count = 0
+    if file_path.lower().endswith('.csv'):
+        with open(file_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(REQUIRED_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    else:
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(REQUIRED_COLUMNS)
+        for row in rows:
+            sheet.append(row)
+            count += 1
+        workbook.save(file_path)
+    return count
+
+def summarize(samples):
+    """把逐次耗时（秒）汇总为总计、平均值和分位数（毫秒）"""
+    ordered = sorted(samples)
+    summary = {
+        'count': len(ordered),
+        'total_s': sum(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+    }
+    for p in PERCENTILES:
+        index = min(int(len(ordered) * p / 100), len(ordered) - 1)
+        summary[f'p{p}_ms'] = ordered[index] * 1000 if ordered else 0.0
+    return summary
+
+def timed(func, *args, **kwargs):
+    """执行一次并返回 (结果, 耗时秒数)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def remove_database(db_path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+def bench_import(engine, file_path):
+    """全量导入后再合并导入同一文件（与 load_excel 相同，经 import_sources 多进程解析后单连接写入）"""
+    results = {}
+    (stats, _), seconds = timed(engine.import_sources, [file_path])
+    results['import'] = {'seconds': seconds, 'rows': stats['inserted'], 'rows_per_s': stats['inserted'] / seconds}
+    (stats, _), seconds = timed(engine.import_sources, [file_path], merge=True)
+    results['import_merge'] = {'seconds': seconds, 'unchanged': stats['unchanged']}
+    return results
+
+def bench_filter(engine, names, search_terms, repeat):
+    """按类别、全文检索及其组合筛选（对应 load_data）"""
+    counts = engine.disease_counts()
+    ranked = sorted(names, key=lambda name: -counts.get(name, 0))
+    scenarios = {
+        'all': {},
+        'common_disease': {'diseases': ranked[:1]},
+        'rare_disease': {'diseases': ranked[len(ranked) // 2:len(ranked) // 2 + 1]},
+        'five_diseases': {'diseases': ranked[:5]},
+    }
+    for term in search_terms:
+        scenarios[f'search_{len(term)}chars'] = {'search_text': term}
+    scenarios['search_and_disease'] = {'diseases': ranked[:5], 'search_text': search_terms[0]}
+    
+    results = {}
+    for name, kwargs in scenarios.items():
+        samples = []
+        for _ in range(repeat):
+            ids, seconds = timed(engine.query_ids, **kwargs)
+            samples.append(seconds)
+        results[name] = dict(summarize(samples), matches=len(ids))
+    return results
+
+def bench_navigation(engine, steps, seed):
+    """顺序翻页、随机跳转和按ID定位（对应 display_current_case：经导航器取id、读缓存并预取相邻病例）"""
+    navigator, open_seconds = timed(engine.navigator)
+    steps = min(steps, len(navigator))
+    results = {'open': {'seconds': open_seconds, 'anchors': len(navigator.anchors)}}
+    rng = random.Random(seed)
+    orders = {
+        'sequential': list(range(steps)),
+        'random_jump': [rng.randrange(len(navigator)) for _ in range(steps)],
+    }
+    for name, order in orders.items():
+        cache = CaseCache(engine.db)
+        samples = []
+        for index in order:
+            start = time.perf_counter()
+            cache.get(navigator.id_at(index))
+            cache.prefetch(navigator.ids_between(index - PREFETCH_BEHIND, index + PREFETCH_AHEAD + 1))
+            samples.append(time.perf_counter() - start)
+        results[name] = dict(summarize(samples), hit_rate=cache.stats()['hit_rate'])
+        cache.close()
+    
+    ids = engine.query_ids()
+    samples = []
+    for case_id in rng.sample(ids, min(steps, len(ids))):
+        _, seconds = timed(navigator.position_of, case_id)
+        samples.append(seconds)
+    results['goto_id'] = summarize(samples)
+    navigator.close()
+    return results
+
+def bench_save_annotations(engine, names, edits, seed):
+    """逐条修改标注后批量写回（对应 save_current_annotation + 定时刷新）"""
+    rng = random.Random(seed)
+    ids = engine.query_ids()
+    targets = rng.sample(ids, min(edits, len(ids)))
+    writer = AnnotationWriter(engine.db, interval=3600)
+    start = time.perf_counter()
+    for case_id in targets:
+        writer.submit(case_id, DISEASE_SEPARATOR.join(rng.sample(names, min(2, len(names)))))
+    submit_seconds = time.perf_counter() - start
+    written, flush_seconds = timed(writer.flush)
+    writer.close()
+    return {'edits': written, 'submit_seconds': submit_seconds, 'flush_seconds': flush_seconds}
+
+def bench_export(engine, workdir):
+    """全量和按类别筛选导出（对应 export_excel）"""
+    results = {}
+    counts = engine.disease_counts()
+    common = max(counts, key=counts.get) if counts else None
+    for fmt in ('csv', 'xlsx'):
+        file_path = os.path.join(workdir, f"export.{fmt}")
+        rows, seconds = timed(engine.export_file, file_path)
+        results[f'full_{fmt}'] = {'seconds': seconds, 'rows': rows, 'bytes': os.path.getsize(file_path)}
+        if common is not None:
+            ids = engine.query_ids([common])
+            rows, seconds = timed(engine.export_file, file_path, ids)
+            results[f'filtered_{fmt}'] = {'seconds': seconds, 'rows': rows}
+    return results
+
+def bench_remap(engine, names, seed):
+    """单个类别重命名与按1%类别批量映射（对应 rename_disease）"""
+    rng = random.Random(seed)
+    counts = engine.disease_counts()
+    if not counts:
+        return {}
+    common = max(counts, key=counts.get)
+    results = {}
+    (_, updated), seconds = timed(engine.remap, {common: common + "（新）"})
+    results['rename_common'] = {'seconds': seconds, 'cases': len(updated)}
+    
+    sources = rng.sample(names[1:], max(len(names) // 100, 1)) if len(names) > 1 else []
+    mapping = {old: rng.choice(names) for old in sources if old != common}
+    (_, updated), seconds = timed(engine.remap, mapping)
+    results['bulk_remap'] = {'seconds': seconds, 'mappings': len(mapping), 'cases': len(updated)}
+    return results
+
+def annotator_session(db_path, annotator, edits, hot_ids, seed):
+    """一个标注员进程：领取任务后逐条修改其中的病例，其间少量修改公共病例（制造并发冲突），返回统计"""
+    engine = AnnotationEngine(db_path)
+    cache = CaseCache(engine.db)
+    writer = AnnotationWriter(engine.db, cache, interval=3600)
+    rng = random.Random(seed)
+    try:
+        batch = engine.claim_batch(annotator)
+        ids = engine.query_ids(id_range=(batch['start_id'], batch['end_id'])) if batch else []
+        written, conflicts, samples = 0, 0, []
+        start = time.perf_counter()
+        for i in range(edits if ids else 0):
+            if hot_ids and rng.random() < HOT_EDIT_RATE:
+                case_id = rng.choice(hot_ids)
+            else:
+                case_id = ids[i % len(ids)]
+            row = cache.get(case_id)
+            writer.submit(case_id, f"{annotator}-{i}", row[4])
+            if (i + 1) % SESSION_FLUSH_EVERY == 0:
+                count, seconds = timed(writer.flush)
+                written += count
+                samples.append(seconds)
+                conflicts += len(writer.take_conflicts())
+        count, seconds = timed(writer.flush)
+        written += count
+        samples.append(seconds)
+        conflicts += len(writer.take_conflicts())
+        return {
+            'batch': batch['id'] if batch else None,
+            'seconds': time.perf_counter() - start,
+            'written': written,
+            'conflicts': conflicts,
+            'flush_samples': samples,
+        }
+    finally:
+        writer.close()
+        cache.close()
+        engine.close()
+
+def bench_concurrency(engine, db_path, annotators, edits, hot, seed):
+    """多个标注员进程同时领取任务并保存标注（对应多人共用一个数据库）
+    
+    检查领取的任务互不重叠，且版本号的总增量等于成功写入的条数（没有被静默覆盖的修改）。
+    """
+    totals = engine.totals()
+    engine.create_batches(max(totals['cases'] // (annotators * 2), 1))
+    rng = random.Random(seed)
+    hot_ids = rng.sample(engine.query_ids(), min(hot, totals['cases']))
+    with engine.db.connection() as conn:
+        versions_before = conn.execute("SELECT SUM(version) FROM cases").fetchone()[0]
+    
+    context = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    with context.Pool(annotators) as pool:
+        sessions = pool.starmap(annotator_session, [
+            (db_path, f"annotator{i}", edits, hot_ids, seed + i) for i in range(annotators)
+        ])
+    seconds = time.perf_counter() - start
+    
+    with engine.db.connection() as conn:
+        versions_after = conn.execute("SELECT SUM(version) FROM cases").fetchone()[0]
+    batches = [session['batch'] for session in sessions]
+    written = sum(session['written'] for session in sessions)
+    return {
+        'annotators': annotators,
+        'seconds': seconds,
+        'edits_per_s': edits * annotators / seconds,
+        'written': written,
+        'conflicts': sum(session['conflicts'] for session in sessions),
+        'disjoint_batches': len(set(batches)) == len(batches) and None not in batches,
+        'lost_updates': written - (versions_after - versions_before),
+        'flush': summarize([sample for session in sessions for sample in session['flush_samples']]),
+    }
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="annotator-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    dataset = os.path.join(workdir, f"cases_{args.cases}_{args.diseases}.{args.format}")
+    db_path = os.path.join(workdir, "bench.db")
+    names = disease_names(args.diseases)
+    report = {
+        'version': RESULT_VERSION,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+        },
+        'parameters': {
+            'cases': args.cases,
+            'diseases': args.diseases,
+            'format': args.format,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'steps': args.steps,
+            'edits': args.edits,
+            'annotators': args.annotators,
+        },
+        'results': {},
+    }
+    results = report['results']
+    
+    def stage(name, func, *func_args):
+        print(f"[{name}] ...", file=sys.stderr, flush=True)
+        results[name], seconds = timed(func, *func_args)
+        print(f"[{name}] {seconds:.2f}s", file=sys.stderr, flush=True)
+    
+    try:
+        if not os.path.exists(dataset) or args.regenerate:
+            rows, seconds = timed(write_dataset, dataset, generate_rows(args.cases, args.diseases, args.seed))
+            results['generate'] = {'seconds': seconds, 'rows': rows, 'bytes': os.path.getsize(dataset)}
+        
+        remove_database(db_path)
+        engine = AnnotationEngine(db_path)
+        report['environment']['fts'] = engine.fts_enabled
+        try:
+            stage('import', bench_import, engine, dataset)
+            stage('filter', bench_filter, engine, names, ['伴胸闷气短', '腹软'], args.repeat)
+            stage('navigation', bench_navigation, engine, args.steps, args.seed)
+            stage('save_annotations', bench_save_annotations, engine, names, args.edits, args.seed)
+            stage('export', bench_export, engine, workdir)
+            stage('remap', bench_remap, engine, names, args.seed)
+            if args.annotators:
+                stage('concurrency', bench_concurrency, engine, db_path, args.annotators, args.edits, args.hot, args.seed)
+        finally:
+            engine.close()
+        report['environment']['database_bytes'] = os.path.getsize(db_path)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="医疗数据标注工具性能基准")
+    parser.add_argument("--preset", choices=sorted(PRESETS), help="预设规模（覆盖 --cases/--diseases）")
+    parser.add_argument("--cases", type=int, default=10000, help="病例数（默认10000）")
+    parser.add_argument("--diseases", type=int, default=100, help="疾病类别数（默认100）")
+    parser.add_argument("--format", choices=['csv', 'xlsx'], default='csv', help="合成数据文件格式")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子（相同种子生成相同数据）")
+    parser.add_argument("--repeat", type=int, default=5, help="筛选查询重复次数")
+    parser.add_argument("--steps", type=int, default=2000, help="翻页步数")
+    parser.add_argument("--edits", type=int, default=1000, help="修改标注的病例数")
+    parser.add_argument("--annotators", type=int, default=4, help="并发标注的进程数（0 表示跳过）")
+    parser.add_argument("--hot", type=int, default=20, help="各标注员都会修改的公共病例数（用于产生冲突）")
+    parser.add_argument("--workdir", help="数据集和数据库目录（指定后保留，可复用已生成的数据集）")
+    parser.add_argument("--regenerate", action="store_true", help="即使数据集已存在也重新生成")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录")
+    parser.add_argument("-o", "--output", help="结果JSON文件（默认输出到stdout）")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.preset:
+        args.cases, args.diseases = PRESETS[args.preset]
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
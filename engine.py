@@ -0,0 +1,2870 @@
+"""医疗数据标注工具的数据引擎：存储、导入导出、类别映射与检索，不依赖Tk
+
+既可被 gui.py 调用，也可在无显示器的服务器上通过命令行运行批处理：
+    python engine.py --db medical_data.db import data.xlsx --merge
+"""
+import sqlite3
+import threading
+import queue
+import atexit
+import csv
+import hashlib
+import os
+import sys
+import argparse
+import json
+import re
+import getpass
+import socket
+import multiprocessing
+from bisect import bisect_left, bisect_right
+from itertools import islice, count as counter
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from instrumentation import Instrumentation, TimedConnection
+
+# 默认数据库文件
+DEFAULT_DB_PATH = "medical_data.db"
+
+# 数据库路径的环境变量（多名标注员共用一个数据库时指向同一个文件）
+DB_PATH_ENV = "ANNOTATOR_DB"
+
+# 标注员名称的环境变量（未设置时为 用户名@主机名）
+ANNOTATOR_ENV = "ANNOTATOR_NAME"
+
+# 划分任务时每个任务的病例数
+WORK_BATCH_SIZE = 500
+
+# 标注中多个疾病类别之间的分隔符
+DISEASE_SEPARATOR = '；'
+
+# Excel/CSV中必需的列（依次对应 cases 表的 id, description, diagnosis, annotations）
+REQUIRED_COLUMNS = ['id', '描述', '诊断', '标注']
+
+# 流式导入每批写入的行数
+IMPORT_CHUNK_SIZE = 5000
+
+# 多文件导入时的解析进程数（默认为CPU核数）
+IMPORT_WORKERS = os.cpu_count() or 1
+
+# 解析进程与写入线程之间最多缓冲的批数（控制内存占用）
+IMPORT_QUEUE_SIZE = 16
+
+# 导入文件夹时识别的表格文件
+IMPORT_EXTENSIONS = ('.xlsx', '.xlsm', '.xls', '.csv')
+
+# 流式导出每批读取的行数
+EXPORT_CHUNK_SIZE = 5000
+
+# 导出读取的病例列；缓存额外读取版本号，保存标注时据此检测是否已被别人修改
+EXPORT_COLUMNS = "id, description, diagnosis, annotations"
+CACHE_COLUMNS = EXPORT_COLUMNS + ", version"
+
+# 病例缓存容量
+CASE_CACHE_SIZE = 512
+
+# 导航时预取的前后条数
+PREFETCH_AHEAD = 20
+PREFETCH_BEHIND = 5
+
+# 标注输入时自动补全列出的类别名数
+COMPLETION_LIMIT = 10
+
+# 导航锚点间隔：每隔多少条记录在内存中保留一个id（定位时最多在索引上顺序跳过这么多条）
+NAV_ANCHOR_INTERVAL = 1024
+
+# 导航时一次从数据库读取的id数
+NAV_PAGE_SIZE = 256
+
+# 标注写回队列的定时刷新间隔（秒）
+ANNOTATION_FLUSH_INTERVAL = 2.0
+
+# 后台任务调度器中并发执行只读任务（导出、建索引等）的线程数；写数据库的任务另有一个专用线程
+JOB_WORKERS = 2
+
+# 调度器中保留的已结束任务数（供查看状态）
+JOB_HISTORY_SIZE = 50
+
+# 数据库结构版本（PRAGMA user_version），用于旧数据库升级
+SCHEMA_VERSION = 2
+
+# 修改记录中保留的最近操作数（可以撤销/重做）；更早的操作在压缩时合并，只保留增量导出需要的信息
+JOURNAL_KEEP_OPERATIONS = 1000
+
+# 每新增多少个操作自动压缩一次修改记录
+JOURNAL_COMPACT_INTERVAL = 200
+
+# 可以撤销/重做的操作类型（合并导入只记录变化的病例，供增量导出使用）
+UNDOABLE_OPERATIONS = ('annotate', 'rename')
+
+# 默认的增量导出标记名
+DEFAULT_EXPORT_MARK = 'default'
+
+# 修改记录中的操作类型名称
+OPERATION_NAMES = {'annotate': "修改标注", 'rename': "修改类别名", 'import': "合并导入", 'undo': "撤销", 'redo': "重做"}
+
+def default_db_path():
+    """数据库路径：优先使用环境变量 ANNOTATOR_DB，否则为当前目录下的默认文件"""
+    return os.environ.get(DB_PATH_ENV) or DEFAULT_DB_PATH
+
+def default_annotator():
+    """标注员名称：优先使用环境变量 ANNOTATOR_NAME，否则为 用户名@主机名"""
+    return os.environ.get(ANNOTATOR_ENV) or f"{getpass.getuser()}@{socket.gethostname()}"
+
+def split_diseases(annotations):
+    """将标注字符串拆分为疾病列表（去空白、去重，保持原有顺序）"""
+    diseases = []
+    for disease in (annotations or '').split(DISEASE_SEPARATOR):
+        disease = disease.strip()
+        if disease and disease not in diseases:
+            diseases.append(disease)
+    return diseases
+
+def sync_case_diseases(cursor, rows):
+    """按 (case_id, annotations) 重建病例-疾病索引表中对应病例的记录"""
+    rows = list(rows)
+    cursor.executemany("DELETE FROM case_diseases WHERE case_id = ?", [(case_id,) for case_id, _ in rows])
+    cursor.executemany(
+        "INSERT INTO case_diseases (case_id, disease) VALUES (?, ?)",
+        [(case_id, disease) for case_id, annotations in rows for disease in split_diseases(annotations)]
+    )
+
+def refresh_disease_names(cursor, names):
+    """按病例-疾病索引表同步疾病表中的指定名称：仍有病例使用的补上，已无病例使用的删除"""
+    names = [(name, name) for name in set(names)]
+    cursor.executemany(
+        "INSERT OR IGNORE INTO diseases (name) SELECT ? WHERE EXISTS (SELECT 1 FROM case_diseases WHERE disease = ?)",
+        names
+    )
+    cursor.executemany(
+        "DELETE FROM diseases WHERE name = ? AND NOT EXISTS (SELECT 1 FROM case_diseases WHERE disease = ?)",
+        names
+    )
+
+def begin_operation(cursor, kind, description='', target=None):
+    """在修改记录中登记一个操作，返回操作id；每隔 JOURNAL_COMPACT_INTERVAL 个操作自动压缩一次"""
+    cursor.execute(
+        "INSERT INTO operations (kind, description, target) VALUES (?, ?, ?)", (kind, description, target)
+    )
+    operation_id = cursor.lastrowid
+    if operation_id % JOURNAL_COMPACT_INTERVAL == 0:
+        compact_journal(cursor)
+    return operation_id
+
+def journal_changes(cursor, operation_id, changes):
+    """追加修改记录：changes 为 (case_id, 旧标注, 新标注, 旧原始标注, 新原始标注)，后两项只在改动原始标注时记录"""
+    cursor.executemany(
+        """INSERT INTO change_log (operation_id, case_id, old_value, new_value, old_source, new_source)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        [(operation_id, *change) for change in changes]
+    )
+
+def journal_edits(cursor, edits):
+    """逐条登记人工修改的标注 (case_id, 旧标注, 新标注)，每条是一个可单独撤销的操作"""
+    for case_id, old, new in edits:
+        operation_id = begin_operation(cursor, 'annotate', case_id)
+        journal_changes(cursor, operation_id, [(case_id, old, new, None, None)])
+
+def read_annotations(cursor, case_ids):
+    """读取病例当前的 {case_id: (标注, 原始标注, 版本号)}，不存在的病例不在结果中"""
+    stored = {}
+    for id_chunk in iter_chunks(case_ids, 900):
+        placeholders = ", ".join("?" for _ in id_chunk)
+        cursor.execute(
+            f"SELECT id, annotations, source_annotations, version FROM cases WHERE id IN ({placeholders})", id_chunk
+        )
+        for case_id, annotations, source, version in cursor.fetchall():
+            stored[case_id] = (annotations, source, version)
+    return stored
+
+def apply_operation(cursor, operation_id, kind):
+    """撤销（kind='undo'）或重做（kind='redo'）一个操作，返回 (已恢复的病例id, 冲突的病例id)
+    
+    只改动当前标注仍等于预期值的病例；之后又被修改过（或已删除）的病例保持不变，作为冲突返回。
+    恢复本身也作为一个新操作记入修改记录，增量导出会包含这些病例。
+    """
+    begin_write(cursor)
+    cursor.execute("SELECT kind, undone FROM operations WHERE id = ?", (operation_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(f"修改记录中没有操作 #{operation_id}（可能已被压缩）")
+    if row[0] not in UNDOABLE_OPERATIONS:
+        raise ValueError(f"操作 #{operation_id}（{OPERATION_NAMES.get(row[0], row[0])}）不能撤销或重做")
+    if bool(row[1]) != (kind == 'redo'):
+        raise ValueError(f"操作 #{operation_id} {'尚未撤销' if kind == 'redo' else '已经撤销'}")
+    
+    # 每个病例取最早的旧值和最晚的新值：[旧标注, 新标注, 旧原始标注, 新原始标注]
+    cursor.execute(
+        """SELECT case_id, old_value, new_value, old_source, new_source FROM change_log
+           WHERE operation_id = ? ORDER BY seq""",
+        (operation_id,)
+    )
+    spans = {}
+    for case_id, old, new, old_source, new_source in cursor.fetchall():
+        if case_id in spans:
+            spans[case_id][1] = new
+            spans[case_id][3] = new_source
+        else:
+            spans[case_id] = [old, new, old_source, new_source]
+    
+    stored = read_annotations(cursor, list(spans))
+    changes, conflicts = [], []
+    for case_id, (old, new, old_source, new_source) in spans.items():
+        expected, value, source = (new, old, old_source) if kind == 'undo' else (old, new, new_source)
+        current = stored.get(case_id)
+        if current is None or current[0] != expected:
+            conflicts.append(case_id)
+        elif source is None:
+            changes.append((case_id, current[0], value, None, None))
+        else:
+            changes.append((case_id, current[0], value, current[1], source))
+    
+    cursor.executemany(
+        """UPDATE cases SET annotations = ?, source_annotations = COALESCE(?, source_annotations),
+                  version = version + 1 WHERE id = ?""",
+        [(value, source, case_id) for case_id, _, value, _, source in changes]
+    )
+    sync_case_diseases(cursor, [(case_id, value) for case_id, _, value, _, _ in changes])
+    refresh_disease_names(cursor, [
+        disease for _, old, new, _, _ in changes for disease in split_diseases(old) + split_diseases(new)
+    ])
+    
+    cursor.execute("UPDATE operations SET undone = ? WHERE id = ?", (int(kind == 'undo'), operation_id))
+    journal_changes(cursor, begin_operation(cursor, kind, f"#{operation_id}", target=operation_id), changes)
+    return [change[0] for change in changes], conflicts
+
+def last_undoable(cursor):
+    """最近一次尚未撤销的修改，没有时返回 None"""
+    placeholders = ", ".join("?" for _ in UNDOABLE_OPERATIONS)
+    cursor.execute(
+        f"SELECT MAX(id) FROM operations WHERE kind IN ({placeholders}) AND undone = 0", UNDOABLE_OPERATIONS
+    )
+    return cursor.fetchone()[0]
+
+def next_redoable(cursor):
+    """可以重做的操作：最近一次撤销的修改，且撤销之后没有新的修改或导入，没有时返回 None"""
+    placeholders = ", ".join("?" for _ in UNDOABLE_OPERATIONS)
+    cursor.execute(f'''
+        SELECT MIN(id) FROM operations WHERE kind IN ({placeholders}) AND undone = 1 AND id > (
+            SELECT COALESCE(MAX(id), 0) FROM operations
+            WHERE (kind IN ({placeholders}) AND undone = 0) OR kind = 'import'
+        )
+    ''', UNDOABLE_OPERATIONS * 2)
+    return cursor.fetchone()[0]
+
+def journal_position(cursor):
+    """修改记录当前的位置（最后分配的序号，压缩删除记录后也不会回退）"""
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def export_mark(cursor, name):
+    cursor.execute("SELECT seq FROM export_marks WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def set_export_mark(cursor, name, seq):
+    cursor.execute(
+        "INSERT INTO export_marks (name, seq) VALUES (?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET seq = excluded.seq, exported_at = datetime('now', 'localtime')",
+        (name, seq)
+    )
+
+def changed_case_ids(cursor, since, until):
+    """修改记录 (since, until] 区间内变化过、且仍然存在的病例id（已排序）"""
+    cursor.execute('''
+        SELECT DISTINCT case_id FROM change_log
+        WHERE seq > ? AND seq <= ? AND case_id IN (SELECT id FROM cases)
+        ORDER BY case_id
+    ''', (since, until))
+    return [row[0] for row in cursor.fetchall()]
+
+def begin_write(cursor):
+    """开始写事务并立即取得写锁：多个进程同时写入时，事务内先读后写的检查不会被其它写入插队"""
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+
+def range_conditions(id_range, column):
+    """id区间 [起始, 结束) 的查询条件，结束为 None 表示不设上限；没有区间时为空"""
+    if id_range is None:
+        return [], []
+    start, end = id_range
+    conditions, params = [f"{column} >= ?"], [start]
+    if end is not None:
+        conditions.append(f"{column} < ?")
+        params.append(end)
+    return conditions, params
+
+def batch_info(row):
+    """work_batches 的一行转换为字典"""
+    return dict(zip(('id', 'start_id', 'end_id', 'cases', 'annotator', 'claimed_at', 'finished_at'), row))
+
+def create_work_batches(cursor, size=WORK_BATCH_SIZE):
+    """按id顺序把全部病例划分为每份约 size 条的任务（替换现有划分），返回任务数
+    
+    每个任务覆盖 [start_id, 下一个任务的 start_id) 区间，第一个任务从最小值开始、最后一个不设上限，
+    因此任务之间互不重叠，之后合并导入的病例也总是恰好属于一个任务。
+    """
+    begin_write(cursor)
+    cursor.execute("SELECT COUNT(*) FROM work_batches WHERE annotator IS NOT NULL AND finished_at IS NULL")
+    if cursor.fetchone()[0]:
+        raise ValueError("还有已领取但未完成的任务，不能重新划分")
+    cursor.execute("DELETE FROM work_batches")
+    
+    cursor.execute(
+        "SELECT id FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY id) AS n FROM cases) WHERE (n - 1) % ? = 0 ORDER BY id",
+        (size,)
+    )
+    starts = [row[0] for row in cursor.fetchall()]
+    if not starts:
+        return 0
+    cursor.execute("SELECT COUNT(*) FROM cases")
+    total = cursor.fetchone()[0]
+    starts[0] = ''
+    ends = starts[1:] + [None]
+    cursor.executemany(
+        "INSERT INTO work_batches (id, start_id, end_id, cases) VALUES (?, ?, ?, ?)",
+        [(i + 1, start, end, min(size, total - i * size)) for i, (start, end) in enumerate(zip(starts, ends))]
+    )
+    return len(starts)
+
+def claim_work_batch(cursor, annotator):
+    """为标注员领取一个任务：已有未完成的任务时继续该任务，否则领取编号最小的未领取任务
+    
+    在写事务中检查并领取，多个进程同时领取也不会拿到同一个任务。没有可领取的任务时返回 None。
+    """
+    begin_write(cursor)
+    cursor.execute(
+        """SELECT id, start_id, end_id, cases, annotator, claimed_at, finished_at FROM work_batches
+           WHERE annotator = ? AND finished_at IS NULL ORDER BY id LIMIT 1""",
+        (annotator,)
+    )
+    row = cursor.fetchone()
+    if row is not None:
+        return batch_info(row)
+    cursor.execute("SELECT id FROM work_batches WHERE annotator IS NULL ORDER BY id LIMIT 1")
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    cursor.execute(
+        "UPDATE work_batches SET annotator = ?, claimed_at = datetime('now', 'localtime') WHERE id = ?",
+        (annotator, row[0])
+    )
+    cursor.execute(
+        "SELECT id, start_id, end_id, cases, annotator, claimed_at, finished_at FROM work_batches WHERE id = ?",
+        (row[0],)
+    )
+    return batch_info(cursor.fetchone())
+
+def finish_work_batch(cursor, batch_id, annotator, release=False):
+    """完成（release 为 True 时为放弃，退回待领取）标注员自己领取的任务"""
+    if release:
+        cursor.execute(
+            """UPDATE work_batches SET annotator = NULL, claimed_at = NULL
+               WHERE id = ? AND annotator = ? AND finished_at IS NULL""",
+            (batch_id, annotator)
+        )
+    else:
+        cursor.execute(
+            """UPDATE work_batches SET finished_at = datetime('now', 'localtime')
+               WHERE id = ? AND annotator = ? AND finished_at IS NULL""",
+            (batch_id, annotator)
+        )
+    if cursor.rowcount == 0:
+        raise ValueError(f"任务 #{batch_id} 不是 {annotator} 正在进行的任务")
+
+def compact_journal(cursor, keep=JOURNAL_KEEP_OPERATIONS):
+    """压缩修改记录：保留最近 keep 个操作，更早的操作不再可以撤销，返回删除的记录条数
+    
+    更早的记录中已导出过的直接删除；尚未导出的每个病例只保留最后一条（增量导出只需要知道哪些病例变过）。
+    """
+    cursor.execute("SELECT id FROM operations ORDER BY id DESC LIMIT 1 OFFSET ?", (keep,))
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    horizon = row[0]
+    
+    # 没有导出标记时增量导出等同于全量导出，旧记录都不再需要
+    cursor.execute("SELECT MIN(seq) FROM export_marks")
+    exported = cursor.fetchone()[0]
+    cursor.execute(
+        "DELETE FROM change_log WHERE operation_id <= ? AND (? IS NULL OR seq <= ?)", (horizon, exported, exported)
+    )
+    deleted = cursor.rowcount
+    cursor.execute('''
+        DELETE FROM change_log WHERE operation_id <= ? AND seq NOT IN (
+            SELECT MAX(seq) FROM change_log WHERE operation_id <= ? GROUP BY case_id
+        )
+    ''', (horizon, horizon))
+    deleted += cursor.rowcount
+    cursor.execute("DELETE FROM operations WHERE id <= ?", (horizon,))
+    return deleted
+
+# 病例“已修改”：当前标注与导入时的原始标注不同（不存在的病例视为未修改）
+CASE_MODIFIED = "COALESCE((SELECT annotations IS NOT source_annotations FROM cases WHERE id = {}), 0)"
+
+# 统计表触发器：cases / case_diseases 每次增删改时增量维护类别计数、共现计数和总数，
+# 打开统计面板只需读取这几张小表
+STATS_TRIGGERS = {
+    'stats_cases_insert': '''
+        AFTER INSERT ON cases BEGIN
+            UPDATE case_totals SET cases = cases + 1,
+                modified = modified + (new.annotations IS NOT new.source_annotations);
+            UPDATE disease_counts SET modified = modified + 1
+                WHERE (new.annotations IS NOT new.source_annotations)
+                  AND disease IN (SELECT disease FROM case_diseases WHERE case_id = new.id);
+        END
+    ''',
+    'stats_cases_delete': '''
+        AFTER DELETE ON cases BEGIN
+            UPDATE case_totals SET cases = cases - 1,
+                modified = modified - (old.annotations IS NOT old.source_annotations);
+            UPDATE disease_counts SET modified = modified - 1
+                WHERE (old.annotations IS NOT old.source_annotations)
+                  AND disease IN (SELECT disease FROM case_diseases WHERE case_id = old.id);
+        END
+    ''',
+    'stats_cases_update': '''
+        AFTER UPDATE OF annotations, source_annotations ON cases
+        WHEN (old.annotations IS NOT old.source_annotations) != (new.annotations IS NOT new.source_annotations)
+        BEGIN
+            UPDATE case_totals SET modified = modified + (new.annotations IS NOT new.source_annotations)
+                - (old.annotations IS NOT old.source_annotations);
+            UPDATE disease_counts SET modified = modified + (new.annotations IS NOT new.source_annotations)
+                - (old.annotations IS NOT old.source_annotations)
+                WHERE disease IN (SELECT disease FROM case_diseases WHERE case_id = new.id);
+        END
+    ''',
+    'stats_case_diseases_insert': f'''
+        AFTER INSERT ON case_diseases BEGIN
+            INSERT INTO disease_counts (disease, cases, modified)
+                VALUES (new.disease, 1, {CASE_MODIFIED.format("new.case_id")})
+                ON CONFLICT (disease) DO UPDATE SET cases = cases + 1, modified = modified + excluded.modified;
+            INSERT INTO disease_pairs (disease_a, disease_b, cases)
+                SELECT MIN(disease, new.disease), MAX(disease, new.disease), 1 FROM case_diseases
+                WHERE case_id = new.case_id AND disease <> new.disease
+                ON CONFLICT (disease_a, disease_b) DO UPDATE SET cases = cases + 1;
+            UPDATE case_totals SET labelled = labelled + 1
+                WHERE NOT EXISTS (SELECT 1 FROM case_diseases WHERE case_id = new.case_id AND disease <> new.disease);
+        END
+    ''',
+    'stats_case_diseases_delete': f'''
+        AFTER DELETE ON case_diseases BEGIN
+            UPDATE disease_counts SET cases = cases - 1, modified = modified - {CASE_MODIFIED.format("old.case_id")}
+                WHERE disease = old.disease;
+            DELETE FROM disease_counts WHERE disease = old.disease AND cases <= 0;
+            UPDATE disease_pairs SET cases = cases - 1
+                WHERE (disease_a, disease_b) IN (
+                    SELECT MIN(disease, old.disease), MAX(disease, old.disease) FROM case_diseases
+                    WHERE case_id = old.case_id
+                );
+            DELETE FROM disease_pairs WHERE cases <= 0;
+            UPDATE case_totals SET labelled = labelled - 1
+                WHERE NOT EXISTS (SELECT 1 FROM case_diseases WHERE case_id = old.case_id);
+        END
+    ''',
+}
+
+# 全文索引触发器：cases 表增删改时同步维护 cases_fts
+FULLTEXT_TRIGGERS = {
+    'cases_fts_insert': '''
+        AFTER INSERT ON cases BEGIN
+            INSERT INTO cases_fts (rowid, description, diagnosis)
+            VALUES (new.rowid, new.description, new.diagnosis);
+        END
+    ''',
+    'cases_fts_delete': '''
+        AFTER DELETE ON cases BEGIN
+            INSERT INTO cases_fts (cases_fts, rowid, description, diagnosis)
+            VALUES ('delete', old.rowid, old.description, old.diagnosis);
+        END
+    ''',
+    'cases_fts_update': '''
+        AFTER UPDATE OF description, diagnosis ON cases BEGIN
+            INSERT INTO cases_fts (cases_fts, rowid, description, diagnosis)
+            VALUES ('delete', old.rowid, old.description, old.diagnosis);
+            INSERT INTO cases_fts (rowid, description, diagnosis)
+            VALUES (new.rowid, new.description, new.diagnosis);
+        END
+    ''',
+}
+
+def create_triggers(cursor, triggers):
+    for name, body in triggers.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+def drop_triggers(cursor, triggers):
+    for name in triggers:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def has_fulltext_index(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'cases_fts'")
+    return cursor.fetchone() is not None
+
+def rebuild_statistics(cursor):
+    """按现有数据一次性重新计算统计表（全量导入和旧数据库升级时使用，比逐行触发快得多）"""
+    cursor.execute("DELETE FROM disease_counts")
+    cursor.execute("DELETE FROM disease_pairs")
+    cursor.execute("DELETE FROM case_totals")
+    cursor.execute('''
+        INSERT INTO disease_counts (disease, cases, modified)
+        SELECT cd.disease, COUNT(*), SUM(c.annotations IS NOT c.source_annotations)
+        FROM case_diseases cd LEFT JOIN cases c ON c.id = cd.case_id
+        GROUP BY cd.disease
+    ''')
+    cursor.execute('''
+        INSERT INTO disease_pairs (disease_a, disease_b, cases)
+        SELECT a.disease, b.disease, COUNT(*)
+        FROM case_diseases a JOIN case_diseases b ON b.case_id = a.case_id AND b.disease > a.disease
+        GROUP BY a.disease, b.disease
+    ''')
+    cursor.execute('''
+        INSERT INTO case_totals (id, cases, labelled, modified)
+        SELECT 0, COUNT(*), (SELECT COUNT(DISTINCT case_id) FROM case_diseases),
+               COALESCE(SUM(annotations IS NOT source_annotations), 0)
+        FROM cases
+    ''')
+
+def build_search_condition(text, fts_enabled=True):
+    """把检索框内容转换为 cases 表上的 WHERE 条件，返回 (sql, params)
+    
+    以空白分隔的多个词取交集。trigram 分词要求词长至少3个字符，较短的词（如"肺炎"）
+    在全文索引的候选结果上再用 instr 过滤；全文索引不可用时全部走 instr 扫描。
+    """
+    terms = text.split()
+    indexed = [t for t in terms if fts_enabled and len(t) >= 3]
+    scanned = [t for t in terms if t not in indexed]
+    
+    conditions = []
+    params = []
+    if indexed:
+        conditions.append("rowid IN (SELECT rowid FROM cases_fts WHERE cases_fts MATCH ?)")
+        params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in indexed))
+    for term in scanned:
+        conditions.append("(instr(description, ?) > 0 OR instr(diagnosis, ?) > 0)")
+        params.extend([term, term])
+    return " AND ".join(conditions), params
+
+def filter_source(diseases=(), search_text="", intersect=True, fts_enabled=True, id_range=None):
+    """把筛选条件转换为返回不重复病例id（列名 id）的子查询，返回 (sql, params)
+    
+    id_range 为 (起始id, 结束id) 时只保留该区间内的病例（领取的任务）。
+    """
+    diseases = list(diseases)
+    placeholders = ", ".join("?" for _ in diseases)
+    if search_text:
+        conditions, params = build_search_condition(search_text, fts_enabled)
+        if diseases and intersect:
+            conditions += f" AND id IN (SELECT case_id FROM case_diseases WHERE disease IN ({placeholders}))"
+            params += diseases
+        ranges, range_params = range_conditions(id_range, "id")
+        conditions = " AND ".join([conditions] + ranges)
+        return f"SELECT id FROM cases WHERE {conditions}", params + range_params
+    if not diseases:
+        ranges, range_params = range_conditions(id_range, "id")
+        where = " WHERE " + " AND ".join(ranges) if ranges else ""
+        return f"SELECT id FROM cases{where}", range_params
+    ranges, range_params = range_conditions(id_range, "case_id")
+    where = "".join(" AND " + condition for condition in ranges)
+    if len(diseases) == 1:
+        return f"SELECT case_id AS id FROM case_diseases WHERE disease = ?{where}", diseases + range_params
+    return (f"SELECT DISTINCT case_id AS id FROM case_diseases WHERE disease IN ({placeholders}){where}",
+            diseases + range_params)
+
+def filter_key(diseases=(), search_text="", intersect=True, id_range=None, expression=""):
+    """筛选条件的规范化键（保存每个筛选的浏览位置用）；expression 为组合筛选条件，给出时代替类别列表"""
+    diseases = sorted(set(diseases))
+    key = [diseases, search_text, bool(intersect and (diseases or expression) and search_text)]
+    if id_range is not None:
+        key.append(list(id_range))
+    if expression:
+        key.append({'expression': " ".join(expression.split())})
+    return json.dumps(key, ensure_ascii=False)
+
+class OperationCancelled(Exception):
+    """用户取消了后台操作"""
+
+class MissingColumnsError(ValueError):
+    """表格缺少必需的列（多工作表导入时这类工作表直接跳过）"""
+
+def iter_chunks(iterable, size):
+    """把可迭代对象切分为长度不超过 size 的列表"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def track_chunks(chunks, progress=None, cancel_event=None, total=None):
+    """逐批转发数据：每批之前检查取消，之后回调 progress(已处理行数, total)"""
+    processed = 0
+    for chunk in chunks:
+        if cancel_event is not None and cancel_event.is_set():
+            raise OperationCancelled()
+        yield chunk
+        processed += len(chunk)
+        if progress:
+            progress(processed, total)
+    if cancel_event is not None and cancel_event.is_set():
+        raise OperationCancelled()
+
+def content_hash(description, diagnosis):
+    """病例原始内容（描述+诊断）的摘要，用于合并导入时识别未变化的行"""
+    data = f"{description}\x1f{diagnosis}".encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def clear_cases(cursor):
+    """清空全部病例数据，准备批量写入
+    
+    统计表和全文索引的触发器先移除（cases 表没有触发器时 DELETE 可直接清空整表），
+    写入完成后由 finish_bulk_load 整体重建，比逐行触发快得多。
+    """
+    # DDL不会自动开启事务：先显式开始，取消或出错回滚时触发器也一并恢复
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN")
+    drop_triggers(cursor, STATS_TRIGGERS)
+    drop_triggers(cursor, FULLTEXT_TRIGGERS)
+    if has_fulltext_index(cursor):
+        cursor.execute("INSERT INTO cases_fts (cases_fts) VALUES ('delete-all')")
+    cursor.execute("DELETE FROM cases")
+    cursor.execute("DELETE FROM diseases")
+    cursor.execute("DELETE FROM case_diseases")
+    # 修改记录和导出标记都属于被替换掉的数据，一并清空（之后的增量导出为全量导出）
+    cursor.execute("DELETE FROM change_log")
+    cursor.execute("DELETE FROM operations")
+    cursor.execute("DELETE FROM export_marks")
+    cursor.execute("DELETE FROM work_batches")
+    # 修改记录的位置前进一格（不对应任何记录）：其它进程中已建立的位图索引据此发现数据已被整体替换并重建
+    cursor.execute("UPDATE sqlite_sequence SET seq = seq + 1 WHERE name = 'change_log'")
+    if cursor.rowcount == 0:
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', 1)")
+
+def finish_bulk_load(cursor):
+    """批量写入完成后重建统计表和全文索引，并恢复触发器"""
+    rebuild_statistics(cursor)
+    create_triggers(cursor, STATS_TRIGGERS)
+    if has_fulltext_index(cursor):
+        cursor.execute("INSERT INTO cases_fts (cases_fts) VALUES ('rebuild')")
+        create_triggers(cursor, FULLTEXT_TRIGGERS)
+
+def merge_cases(cursor, chunks, operation_id=None):
+    """合并导入：按id插入新病例，更新描述/诊断有变化的病例（保留已有标注），跳过未变化的病例
+    
+    给出 operation_id 时把新增和变化的病例记入修改记录（供增量导出）。
+    返回 inserted/updated/unchanged/new_diseases 统计。
+    """
+    stats = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'new_diseases': 0}
+    new_diseases = set()
+    
+    for chunk in chunks:
+        # 同一批中重复的id以最后一行为准
+        latest = {row[0]: row for row in chunk}
+        
+        stored = {}
+        for id_chunk in iter_chunks(latest, 900):
+            placeholders = ", ".join("?" for _ in id_chunk)
+            # 旧版本导入的行没有摘要，只为这些行读取原文计算
+            cursor.execute(
+                f"""SELECT id, content_hash,
+                           CASE WHEN content_hash IS NULL THEN description END,
+                           CASE WHEN content_hash IS NULL THEN diagnosis END
+                    FROM cases WHERE id IN ({placeholders})""",
+                id_chunk
+            )
+            for case_id, stored_hash, desc, diag in cursor.fetchall():
+                stored[case_id] = (stored_hash, desc, diag)
+        
+        inserts, updates, backfills = [], [], []
+        for case_id, (_, desc, diag, anno) in latest.items():
+            new_hash = content_hash(desc, diag)
+            if case_id not in stored:
+                inserts.append((case_id, desc, diag, anno, new_hash))
+                continue
+            stored_hash, old_desc, old_diag = stored[case_id]
+            if stored_hash is None and content_hash(old_desc or '', old_diag or '') == new_hash:
+                backfills.append((new_hash, case_id))
+                stats['unchanged'] += 1
+            elif stored_hash == new_hash:
+                stats['unchanged'] += 1
+            else:
+                updates.append((desc, diag, new_hash, case_id))
+        
+        cursor.executemany(
+            """INSERT INTO cases (id, description, diagnosis, annotations, source_annotations, content_hash)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            [(case_id, desc, diag, anno, anno, new_hash) for case_id, desc, diag, anno, new_hash in inserts]
+        )
+        case_diseases = [(row[0], disease) for row in inserts for disease in split_diseases(row[3])]
+        cursor.executemany("INSERT INTO case_diseases (case_id, disease) VALUES (?, ?)", case_diseases)
+        new_diseases.update(disease for _, disease in case_diseases)
+        cursor.executemany(
+            "UPDATE cases SET description = ?, diagnosis = ?, content_hash = ?, version = version + 1 WHERE id = ?",
+            updates
+        )
+        cursor.executemany("UPDATE cases SET content_hash = ? WHERE id = ?", backfills)
+        if operation_id is not None:
+            journal_changes(cursor, operation_id, [(row[0], None, row[3], None, None) for row in inserts] +
+                                                  [(row[3], None, None, None, None) for row in updates])
+        
+        stats['inserted'] += len(inserts)
+        stats['updated'] += len(updates)
+    
+    cursor.executemany("INSERT OR IGNORE INTO diseases (name) VALUES (?)", [(d,) for d in sorted(new_diseases)])
+    stats['new_diseases'] = max(cursor.rowcount, 0)
+    return stats
+
+def remap_diseases(cursor, mapping):
+    """按 {旧名称: 新名称} 批量改写标注（新名称为空表示删除该类别），返回 (每个映射影响的病例数, 被修改的病例id)
+    
+    所有映射在一次遍历中同时生效：a→b、b→c 不会把 a 连锁改成 c；合并后重复的类别自动去重。
+    """
+    mapping = {old.strip(): new.strip() for old, new in mapping.items() if old.strip() and old.strip() != new.strip()}
+    if not mapping:
+        return {}, []
+    
+    description = "；".join(f"{old} → {new or '(删除)'}" for old, new in mapping.items())
+    operation_id = begin_operation(cursor, 'rename', description)
+    
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS remap (old TEXT PRIMARY KEY, new TEXT NOT NULL)")
+    cursor.execute("DELETE FROM temp.remap")
+    cursor.executemany("INSERT INTO temp.remap (old, new) VALUES (?, ?)", mapping.items())
+    
+    counts = dict.fromkeys(mapping, 0)
+    cursor.execute(
+        "SELECT disease, COUNT(*) FROM case_diseases WHERE disease IN (SELECT old FROM temp.remap) GROUP BY disease"
+    )
+    counts.update(cursor.fetchall())
+    
+    def apply_mapping(annotations):
+        new_diseases = []
+        for disease in split_diseases(annotations):
+            disease = mapping.get(disease, disease)
+            if disease and disease not in new_diseases:
+                new_diseases.append(disease)
+        return DISEASE_SEPARATOR.join(new_diseases)
+    
+    # 受影响的病例只读取、改写一次，无论涉及多少个映射
+    cursor.execute('''
+        SELECT id, annotations, source_annotations FROM cases WHERE id IN (
+            SELECT case_id FROM case_diseases WHERE disease IN (SELECT old FROM temp.remap)
+        )
+    ''')
+    updates, rows, changes = [], [], []
+    for case_id, annotations, source in cursor.fetchall():
+        new_annotations = apply_mapping(annotations)
+        # 原始标注同步改名，重命名本身不算作人工修改
+        if source == annotations:
+            new_source = new_annotations
+        elif source is not None:
+            new_source = apply_mapping(source)
+        else:
+            new_source = None
+        updates.append((case_id, new_annotations))
+        rows.append((new_annotations, new_source, case_id))
+        changes.append((case_id, annotations, new_annotations, source, new_source))
+    
+    cursor.executemany(
+        "UPDATE cases SET annotations = ?, source_annotations = ?, version = version + 1 WHERE id = ?", rows
+    )
+    sync_case_diseases(cursor, updates)
+    journal_changes(cursor, operation_id, changes)
+    
+    # 疾病表：加入新名称，删除已无病例使用的旧名称
+    cursor.executemany("INSERT OR IGNORE INTO diseases (name) VALUES (?)", [(new,) for new in set(mapping.values()) if new])
+    cursor.execute('''
+        DELETE FROM diseases WHERE name IN (SELECT old FROM temp.remap)
+            AND NOT EXISTS (SELECT 1 FROM case_diseases WHERE disease = diseases.name)
+    ''')
+    cursor.execute("DELETE FROM temp.remap")
+    return counts, [case_id for case_id, _ in updates]
+
+def read_mapping_csv(file_path):
+    """读取两列（旧名称, 新名称）的映射CSV，首行为表头时自动跳过"""
+    mapping = {}
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        for i, row in enumerate(csv.reader(f)):
+            if not row or not row[0].strip():
+                continue
+            if i == 0 and row[0].strip() in ('旧名称', '原名称', 'old', 'old_name'):
+                continue
+            mapping[row[0].strip()] = row[1].strip() if len(row) > 1 else ''
+    return mapping
+
+def cell_text(value):
+    """单元格值转为文本，空单元格为空字符串"""
+    return '' if value is None else str(value)
+
+def count_csv_rows(file_path):
+    """快速统计CSV数据行数（按换行符计数，用于进度显示）"""
+    lines = 0
+    last = b'\n'
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        lines += 1
+    return max(lines - 1, 0)
+
+def open_case_rows(file_path, sheet=None):
+    """流式读取病例文件，返回 (数据行数, 行生成器)，每行为 (id, 描述, 诊断, 标注)
+    
+    .xlsx 使用 openpyxl 只读模式逐行读取，.csv 走标准库快速通道，内存占用与文件大小无关。
+    sheet 为工作表名，默认读取第一个工作表（CSV忽略）。行数未知时返回 None。
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    
+    if ext == '.csv':
+        total = count_csv_rows(file_path)
+        f = open(file_path, newline='', encoding='utf-8-sig')
+        rows = csv.reader(f)
+        close = f.close
+    elif ext == '.xls':
+        # 旧版xls格式不支持流式读取（且最多65536行），仍交给pandas
+        import pandas as pd
+        df = pd.read_excel(file_path, sheet_name=sheet or 0, dtype=object)
+        df = df.astype(object).where(df.notna(), None)
+        total = len(df)
+        rows = iter([list(df.columns)] + df.values.tolist())
+        close = None
+    else:
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        total = worksheet.max_row - 1 if worksheet.max_row else None
+        rows = worksheet.iter_rows(values_only=True)
+        close = workbook.close
+    
+    try:
+        header = [cell_text(c).strip() for c in next(rows, [])]
+    except Exception:
+        if close:
+            close()
+        raise
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in header]
+    if missing_columns:
+        if close:
+            close()
+        raise MissingColumnsError(f"缺少必需的列: {', '.join(missing_columns)}")
+    positions = [header.index(col) for col in REQUIRED_COLUMNS]
+    
+    def generate():
+        try:
+            for row in rows:
+                values = [cell_text(row[i]) if i < len(row) else '' for i in positions]
+                # 跳过完全空白的行（Excel中常见的尾部空行）
+                if any(values):
+                    yield tuple(values)
+        finally:
+            if close:
+                close()
+    
+    return total, generate()
+
+def list_sheets(file_path):
+    """工作簿中的全部工作表名；CSV或读取失败时返回 [None]（读取错误留到解析时按文件报告）"""
+    ext = os.path.splitext(file_path)[1].lower()
+    try:
+        if ext in ('.xlsx', '.xlsm'):
+            # 只读取 xl/workbook.xml 中的工作表清单，不加载共享字符串等内容
+            import zipfile
+            from xml.etree import ElementTree
+            with zipfile.ZipFile(file_path) as archive:
+                root = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+            return [sheet.get('name') for sheet in root.iter() if sheet.tag.endswith('}sheet')] or [None]
+        if ext == '.xls':
+            import pandas as pd
+            with pd.ExcelFile(file_path) as book:
+                return list(book.sheet_names) or [None]
+    except Exception:
+        pass
+    return [None]
+
+def list_import_sources(paths):
+    """把文件/文件夹展开为 (文件, 工作表) 列表：文件夹递归查找表格文件，工作簿的每个工作表各为一个来源"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                files.extend(
+                    os.path.join(dirpath, name) for name in sorted(filenames)
+                    # ~$ 开头的是Excel打开文件时生成的锁文件
+                    if name.lower().endswith(IMPORT_EXTENSIONS) and not name.startswith('~$')
+                )
+        else:
+            files.append(path)
+    return [(file_path, sheet) for file_path in files for sheet in list_sheets(file_path)]
+
+def iter_source_messages(index, file_path, sheet, chunk_size=IMPORT_CHUNK_SIZE, stop=None):
+    """解析一个来源，依次产出消息 (类型, 来源序号, 数据)：
+    
+    start(行数) → 若干 rows(一批行) → done；缺少必需列时为 skipped，出错时为 error（附错误信息）。
+    """
+    try:
+        total, rows = open_case_rows(file_path, sheet)
+    except MissingColumnsError as e:
+        yield ('skipped', index, str(e))
+        return
+    except Exception as e:
+        yield ('error', index, str(e) or type(e).__name__)
+        return
+    
+    yield ('start', index, total)
+    try:
+        for chunk in iter_chunks(rows, chunk_size):
+            if stop is not None and stop.is_set():
+                rows.close()
+                return
+            yield ('rows', index, chunk)
+    except Exception as e:
+        yield ('error', index, str(e) or type(e).__name__)
+        return
+    yield ('done', index, None)
+
+# 解析进程中的输出队列和停止标志（由进程池初始化函数设置）
+_parse_output = None
+_parse_stop = None
+
+def _init_parse_worker(output, stop):
+    global _parse_output, _parse_stop
+    _parse_output, _parse_stop = output, stop
+    # 中止导入时队列中可能还有没人读取的数据，进程退出时不等待它们写完
+    output.cancel_join_thread()
+
+def parse_source(index, file_path, sheet):
+    """解析进程入口：把一个来源的消息放入输出队列"""
+    for message in iter_source_messages(index, file_path, sheet, stop=_parse_stop):
+        _parse_output.put(message)
+
+@contextmanager
+def parse_sources(sources, workers=None):
+    """并行解析多个 (文件, 工作表) 来源，产出 iter_source_messages 格式的消息（不同来源的批次交错到达）
+    
+    每个来源由进程池中的一个进程解析（Excel解析受GIL限制，多线程无效），数据经有界队列交给
+    调用方所在的唯一写入线程。workers <= 1 或只有一个来源时直接在当前进程中解析。
+    """
+    workers = min(workers or IMPORT_WORKERS, len(sources))
+    if workers <= 1:
+        yield (message for index, (file_path, sheet) in enumerate(sources)
+               for message in iter_source_messages(index, file_path, sheet))
+        return
+    
+    # 进程池只在并行导入时用到，不拖慢启动
+    from concurrent.futures import ProcessPoolExecutor
+    # spawn 在各平台行为一致，也避免在已有后台线程的进程中 fork
+    context = multiprocessing.get_context("spawn")
+    output = context.Queue(IMPORT_QUEUE_SIZE)
+    stop = context.Event()
+    executor = ProcessPoolExecutor(workers, mp_context=context,
+                                   initializer=_init_parse_worker, initargs=(output, stop))
+    futures = {executor.submit(parse_source, index, file_path, sheet): index
+               for index, (file_path, sheet) in enumerate(sources)}
+    
+    def messages():
+        finished = set()
+        while len(finished) < len(sources):
+            try:
+                message = output.get(timeout=0.5)
+            except queue.Empty:
+                # 解析进程崩溃时收不到结束消息，按其任务的异常报告
+                for future, index in futures.items():
+                    if index not in finished and future.done() and future.exception() is not None:
+                        finished.add(index)
+                        yield ('error', index, str(future.exception()) or type(future.exception()).__name__)
+                continue
+            if message[0] in ('done', 'skipped', 'error'):
+                finished.add(message[1])
+            yield message
+    
+    try:
+        yield messages()
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        # 取走残留数据，让阻塞在 put 上的进程尽快结束
+        while not all(future.done() for future in futures):
+            try:
+                output.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        executor.shutdown()
+
+def collect_source_chunks(messages, results, progress=None, cancel_event=None, on_source=None):
+    """消费解析消息并产出数据批次，同时更新 results 中每个来源的状态
+    
+    progress(已处理行数, 总行数) 在每批之后调用，所有来源都报告了行数之前总行数为 None；
+    on_source(序号, 来源状态) 在来源开始、完成、跳过或出错时调用。
+    """
+    processed = 0
+    total = 0
+    total_known = True
+    reported = set()
+    for kind, index, payload in messages:
+        if cancel_event is not None and cancel_event.is_set():
+            raise OperationCancelled()
+        result = results[index]
+        if kind == 'rows':
+            yield payload
+            result['rows'] += len(payload)
+            processed += len(payload)
+            if progress:
+                progress(processed, total if total_known and len(reported) == len(results) else None)
+            continue
+        
+        reported.add(index)
+        if kind == 'start':
+            result['status'] = 'running'
+            result['total'] = payload
+            total += payload or 0
+            total_known = total_known and payload is not None
+        elif kind == 'done':
+            result['status'] = 'done'
+        else:
+            result['status'] = kind
+            result['error'] = payload
+        if on_source:
+            on_source(index, result)
+    if cancel_event is not None and cancel_event.is_set():
+        raise OperationCancelled()
+
+def iter_case_rows(conn, case_ids=None, chunk_size=EXPORT_CHUNK_SIZE, columns=EXPORT_COLUMNS):
+    """按id顺序分批读取病例；case_ids 为 None 时读取全部病例，否则只读取指定id（需已排序）"""
+    cursor = conn.cursor()
+    if case_ids is None:
+        cursor.execute(f"SELECT {columns} FROM cases ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    else:
+        # 每批id数保持在SQLite参数上限以内
+        for id_chunk in iter_chunks(case_ids, min(chunk_size, 900)):
+            placeholders = ", ".join("?" for _ in id_chunk)
+            cursor.execute(
+                f"SELECT {columns} FROM cases WHERE id IN ({placeholders}) ORDER BY id",
+                id_chunk
+            )
+            yield cursor.fetchall()
+
+def write_xlsx(file_path, chunks):
+    """以openpyxl只写模式逐行写入xlsx"""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(REQUIRED_COLUMNS)
+    for rows in chunks:
+        for row in rows:
+            sheet.append(row)
+    workbook.save(file_path)
+
+def write_csv(file_path, chunks):
+    """写入UTF-8 CSV（带BOM，Excel可直接打开）"""
+    with open(file_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(REQUIRED_COLUMNS)
+        for rows in chunks:
+            writer.writerows(rows)
+
+def write_parquet(file_path, chunks):
+    """按批写入Parquet（需要pyarrow）"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("导出Parquet需要先安装 pyarrow")
+    
+    schema = pa.schema([(col, pa.string()) for col in REQUIRED_COLUMNS])
+    with pq.ParquetWriter(file_path, schema) as writer:
+        for rows in chunks:
+            if not rows:
+                # 这一批的病例在列出id之后全部被删除了
+                continue
+            columns = [pa.array(values, pa.string()) for values in zip(*rows)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+EXPORT_WRITERS = {
+    '.xlsx': write_xlsx,
+    '.csv': write_csv,
+    '.parquet': write_parquet,
+}
+
+def export_cases(conn, file_path, case_ids=None, progress=None, cancel_event=None):
+    """流式导出病例到文件（格式由扩展名决定），返回导出的行数
+    
+    progress(processed, total) 在每批写出后调用；cancel_event 被设置时中止。
+    先写入同一目录下的临时文件，完成后再替换目标文件：取消或出错时不会留下半截文件，也不会删掉原有的同名文件。
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext not in EXPORT_WRITERS:
+        raise ValueError(f"不支持的导出格式: {ext or '(无扩展名)'}")
+    
+    if case_ids is None:
+        total = conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+    else:
+        total = len(case_ids)
+    exported = 0
+    
+    def on_progress(processed, total):
+        nonlocal exported
+        exported = processed
+        if progress:
+            progress(processed, total)
+    
+    import tempfile
+    directory, name = os.path.split(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(suffix=ext, prefix=f".{name}.", dir=directory)
+    os.close(fd)
+    try:
+        EXPORT_WRITERS[ext](temp_path, track_chunks(iter_case_rows(conn, case_ids), on_progress, cancel_event, total))
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return exported
+
+class Database:
+    """SQLite连接管理：UI线程复用一个长连接，后台线程从连接池借用连接"""
+    
+    # 每个新连接都会执行的调优参数
+    PRAGMAS = (
+        "PRAGMA journal_mode = WAL",        # 后台写入时UI线程仍可读取
+        "PRAGMA synchronous = NORMAL",      # WAL模式下只在检查点时fsync，断电也不会损坏数据库
+        "PRAGMA busy_timeout = 30000",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -65536",       # 64MB页缓存
+        "PRAGMA mmap_size = 268435456",     # 256MB内存映射读取
+    )
+    
+    def __init__(self, db_path, pool_size=4, instrumentation=None):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.instrumentation = instrumentation or Instrumentation()
+        self._pool = queue.LifoQueue()
+        self._owner_thread = threading.get_ident()
+        self._main_conn = self._connect(check_same_thread=True)
+        
+    def _connect(self, check_same_thread=False):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=check_same_thread,
+                               factory=TimedConnection)
+        conn.instrumentation = self.instrumentation
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+        
+    def open_connection(self):
+        """新建一个不进入连接池的连接，由调用方负责关闭（可在创建它的线程之外使用）"""
+        return self._connect()
+        
+    @property
+    def main_conn(self):
+        """UI线程专用的长连接"""
+        return self._main_conn
+        
+    @contextmanager
+    def connection(self):
+        """按调用线程取得连接：UI线程直接使用长连接，其它线程借用池化连接，用完归还"""
+        if threading.get_ident() == self._owner_thread:
+            try:
+                yield self._main_conn
+            except BaseException:
+                # 与池化连接一致：异常退出时不把半截写入留在长连接的事务里
+                if self._main_conn.in_transaction:
+                    self._main_conn.rollback()
+                raise
+            return
+        
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            # 未提交的事务（如异常退出）一律回滚，避免把半截写入带回连接池
+            if conn.in_transaction:
+                conn.rollback()
+            if self._pool.qsize() < self.pool_size:
+                self._pool.put(conn)
+            else:
+                conn.close()
+        
+    def close(self):
+        """关闭所有连接（退出程序时调用）"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._main_conn.close()
+
+class CaseCache:
+    """按id缓存病例行的有界LRU缓存，由后台线程批量预取即将浏览的病例"""
+    
+    def __init__(self, db, capacity=CASE_CACHE_SIZE):
+        self.db = db
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        # 每次失效都会递增；预取结果若跨越了失效则丢弃，避免把旧数据写回缓存
+        self._generation = 0
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._prefetch_loop, daemon=True)
+        self._worker.start()
+        
+    def get(self, case_id):
+        """读取病例行 (id, description, diagnosis, annotations, version)，未命中时查询数据库并缓存"""
+        with self._lock:
+            row = self._rows.get(case_id)
+            if row is not None:
+                self._rows.move_to_end(case_id)
+                self.hits += 1
+                return row
+            self.misses += 1
+            generation = self._generation
+        
+        with self.db.connection() as conn:
+            row = conn.execute(f"SELECT {CACHE_COLUMNS} FROM cases WHERE id = ?", (case_id,)).fetchone()
+        if row is not None:
+            self._store([row], generation)
+        return row
+        
+    def prefetch(self, case_ids):
+        """在后台批量加载尚未缓存的病例"""
+        with self._lock:
+            missing = [case_id for case_id in case_ids if case_id not in self._rows]
+        if missing:
+            self._requests.put(missing)
+        
+    def invalidate(self, case_ids=None):
+        """使指定病例（默认全部）的缓存失效"""
+        with self._lock:
+            self._generation += 1
+            if case_ids is None:
+                self._rows.clear()
+            else:
+                for case_id in case_ids:
+                    self._rows.pop(case_id, None)
+        
+    def stats(self):
+        """命中/未命中计数"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._rows),
+            }
+        
+    def close(self):
+        self._requests.put(None)
+        
+    def _store(self, rows, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            for row in rows:
+                self._rows[row[0]] = row
+                self._rows.move_to_end(row[0])
+            while len(self._rows) > self.capacity:
+                self._rows.popitem(last=False)
+        
+    def _prefetch_loop(self):
+        while True:
+            case_ids = self._requests.get()
+            # 快速翻页时只处理最新的请求
+            while case_ids is not None and not self._requests.empty():
+                case_ids = self._requests.get()
+            if case_ids is None:
+                return
+            
+            with self._lock:
+                generation = self._generation
+                case_ids = [case_id for case_id in case_ids if case_id not in self._rows]
+            if not case_ids:
+                continue
+            
+            try:
+                with self.db.connection() as conn:
+                    rows = [row for chunk in iter_case_rows(conn, sorted(case_ids), columns=CACHE_COLUMNS)
+                            for row in chunk]
+            except sqlite3.Error:
+                continue
+            self._store(rows, generation)
+
+class AnnotationWriter:
+    """标注写回队列：修改先记入内存，由后台线程定时在一个事务中批量写入数据库
+    
+    翻页不再等待提交；程序正常退出、关闭窗口时会同步刷新剩余修改。
+    给出 jobs（JobScheduler）时定时刷新交给它的写队列执行，与导入、改名等写任务逐个进行，不再互相等待写锁。
+    提交时带上加载病例时的版本号即可做乐观并发检查：写入前发现版本已变（被其他标注员修改过）的病例
+    不会覆盖，而是放入冲突列表并调用 on_conflict()，由调用方通过 take_conflicts() 取走处理。
+    """
+    
+    def __init__(self, db, case_cache=None, interval=ANNOTATION_FLUSH_INTERVAL, on_conflict=None, jobs=None):
+        self.db = db
+        self.case_cache = case_cache
+        self.interval = interval
+        self.on_conflict = on_conflict
+        self.jobs = jobs
+        self.last_error = None
+        # 已排进写队列、尚未开始执行的刷新任务（之后登记的修改由它一并写入）
+        self._flush_job = None
+        self._pending = OrderedDict()
+        self._conflicts = []
+        # 本进程写入后各病例的版本号：之后基于旧版本的再次修改不算与自己冲突
+        self._written = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._start()
+        # 解释器退出（包括未捕获异常导致的退出）时也要落盘
+        atexit.register(self.close)
+        
+    def submit(self, case_id, annotation, version=None):
+        """登记一条待写入的标注（同一病例只保留最新值）
+        
+        version 为加载病例时的版本号；为 None 时不做冲突检查，直接覆盖。
+        """
+        with self._lock:
+            if case_id in self._pending:
+                # 写入前又改了一次：仍以最初加载时的版本为准
+                version = self._pending[case_id][1]
+            self._pending[case_id] = (annotation, version)
+            self._pending.move_to_end(case_id)
+        
+    def pending_value(self, case_id):
+        """返回尚未写入数据库的标注，没有则返回 None"""
+        with self._lock:
+            pending = self._pending.get(case_id)
+        return pending[0] if pending else None
+        
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+        
+    def overwrite(self, conflict):
+        """处理冲突时保留自己的修改：以对方写入后的版本为基准重新排队（之后又改过时以最新值为准）"""
+        with self._lock:
+            pending = self._pending.get(conflict['case_id'])
+            annotation = pending[0] if pending else conflict['mine']
+            self._pending[conflict['case_id']] = (annotation, conflict['version'])
+            self._pending.move_to_end(conflict['case_id'])
+        
+    def take_conflicts(self):
+        """取走目前所有的冲突：[{'case_id', 'mine', 'theirs', 'version'}]，version 为对方写入后的版本号"""
+        with self._lock:
+            conflicts, self._conflicts = self._conflicts, []
+        return conflicts
+        
+    def flush(self):
+        """把当前所有待写入的标注在一个事务中写入数据库，返回写入条数（不含冲突）"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.items())
+            if not batch:
+                return 0
+            
+            with self.db.instrumentation.measure("save", cases=len(batch)) as fields, \
+                    self.db.connection() as conn:
+                cursor = conn.cursor()
+                # 版本检查和写入在同一个写事务中，检查之后其它进程无法插入修改
+                begin_write(cursor)
+                stored = read_annotations(cursor, [case_id for case_id, _ in batch])
+                edits, conflicts = [], []
+                for case_id, (annotation, version) in batch:
+                    if case_id not in stored:
+                        continue
+                    current, _, current_version = stored[case_id]
+                    if version is not None and current_version != max(version, self._written.get(case_id, version)):
+                        conflicts.append({'case_id': case_id, 'mine': annotation, 'theirs': current,
+                                          'version': current_version})
+                    elif annotation != current:
+                        edits.append((case_id, current, annotation))
+                
+                cursor.executemany(
+                    "UPDATE cases SET annotations = ?, version = version + 1 WHERE id = ?",
+                    [(annotation, case_id) for case_id, _, annotation in edits]
+                )
+                sync_case_diseases(cursor, [(case_id, annotation) for case_id, _, annotation in edits])
+                journal_edits(cursor, edits)
+                conn.commit()
+                fields['conflicts'] = len(conflicts)
+            
+            for case_id, _, _ in edits:
+                self._written[case_id] = stored[case_id][2] + 1
+            # 提交成功后才移出队列；写入期间又被修改的病例保留新值等待下一轮
+            with self._lock:
+                for case_id, value in batch:
+                    if self._pending.get(case_id) == value:
+                        del self._pending[case_id]
+                self._conflicts.extend(conflicts)
+            if self.case_cache is not None:
+                self.case_cache.invalidate([case_id for case_id, _ in batch])
+            if conflicts and self.on_conflict:
+                self.on_conflict()
+            return len(batch) - len(conflicts)
+        
+    def schedule_flush(self):
+        """把刷新排进调度器的写队列，返回任务（已有尚未开始的刷新任务时直接返回它）"""
+        with self._lock:
+            job = self._flush_job
+            if job is None or job.status != 'pending':
+                job = self._flush_job = self.jobs.submit("写入标注", lambda job: self._try_flush(), write=True)
+            return job
+        
+    def close(self):
+        """停止后台线程并同步写入剩余修改；写入失败时抛出异常，可调用 reopen() 恢复定时刷新"""
+        if self._closed:
+            return
+        self._stop.set()
+        self._worker.join()
+        self.flush()
+        self._closed = True
+        
+    def reopen(self):
+        """close() 写入失败后继续使用：重新启动定时刷新"""
+        if not self._closed and not self._worker.is_alive():
+            self._start()
+        
+    def _start(self):
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._flush_loop, daemon=True)
+        self._worker.start()
+        
+    def _try_flush(self):
+        try:
+            written = self.flush()
+        except sqlite3.Error as e:
+            # 保留队列内容，下一轮重试
+            self.last_error = e
+            raise
+        self.last_error = None
+        return written
+        
+    def _flush_loop(self):
+        while not self._stop.wait(self.interval):
+            if self.jobs is None:
+                try:
+                    self._try_flush()
+                except sqlite3.Error:
+                    pass
+            elif self.pending_count():
+                try:
+                    self.schedule_flush()
+                except RuntimeError:
+                    # 调度器已关闭（正在退出），剩余修改由 close() 写入
+                    pass
+
+class Job:
+    """一个后台任务：状态、取消标志和进度（由 JobScheduler.submit 创建）
+    
+    status 依次为 pending（排队中）、running（执行中），结束时为 done、failed 或 cancelled。
+    """
+    
+    def __init__(self, job_id, name, func, write, cancel_event=None, callbacks=None):
+        self.id = job_id
+        self.name = name
+        self.write = write
+        self.status = 'pending'
+        self.cancel_event = cancel_event or threading.Event()
+        # (已完成, 总数)，总数未知时为 None
+        self.progress = (0, None)
+        self.result = None
+        self.error = None
+        self._func = func
+        self._callbacks = callbacks or {}
+        self._scheduler = None
+        self._finished = threading.Event()
+        
+    def cancel(self):
+        """请求取消：排队中的任务不再执行；执行中的任务在下一个检查点抛出 OperationCancelled 并回滚"""
+        self.cancel_event.set()
+        
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+        
+    def wait(self, timeout=None):
+        """等待任务结束，超时返回 False"""
+        return self._finished.wait(timeout)
+        
+    def report(self, done, total=None):
+        """由任务函数调用，报告进度（可直接作为引擎方法的 progress 参数）"""
+        self.progress = (done, total)
+        self._scheduler._notify(self, 'on_progress', done, total)
+
+class JobScheduler:
+    """后台任务调度器：只读任务由线程池并发执行，写数据库的任务进入专用写队列，由唯一的写线程按提交顺序逐个执行
+    
+    导入、批量改名、撤销/重做等写任务因此不会同时争抢写锁，也不会与另一个写任务的事务交错。
+    任务函数以 Job 为参数，可通过 job.report() 报告进度、检查 job.cancel_event 响应取消。
+    结果、错误和进度回调经 dispatch(func, *args) 转交给调用方的线程（GUI 中为 root.after），
+    不给 dispatch 时直接在工作线程中调用。shutdown() 取消排队和执行中的任务，等它们提交或回滚后结束工作线程。
+    """
+    
+    def __init__(self, workers=JOB_WORKERS, dispatch=None, on_change=None):
+        self.dispatch = dispatch
+        # 任一任务的状态或进度变化时调用（同样经 dispatch 转交）
+        self.on_change = on_change
+        self._ids = counter(1)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._closed = False
+        self._read_queue = queue.Queue()
+        self._write_queue = queue.Queue()
+        self._threads = [
+            (threading.Thread(target=self._run, args=(self._read_queue,), name=f"job-reader-{i + 1}", daemon=True),
+             self._read_queue)
+            for i in range(workers)
+        ]
+        self._threads.append(
+            (threading.Thread(target=self._run, args=(self._write_queue,), name="job-writer", daemon=True),
+             self._write_queue)
+        )
+        for thread, _ in self._threads:
+            thread.start()
+        # 解释器退出时也等正在执行的任务提交或回滚
+        atexit.register(self.shutdown)
+        
+    def submit(self, name, func, write=False, cancel_event=None,
+               on_done=None, on_error=None, on_cancel=None, on_progress=None):
+        """提交任务 func(job)，返回 Job
+        
+        write 为 True 的任务进入写队列逐个执行。on_done(结果)、on_error(异常)、on_cancel()、
+        on_progress(已完成, 总数) 经 dispatch 调用；cancel_event 可传入已有的取消标志（如进度窗口的取消按钮）。
+        """
+        callbacks = {'on_done': on_done, 'on_error': on_error, 'on_cancel': on_cancel, 'on_progress': on_progress}
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("任务调度器已关闭")
+            job = Job(next(self._ids), name, func, write, cancel_event, callbacks)
+            job._scheduler = self
+            self._jobs[job.id] = job
+            self._trim()
+        (self._write_queue if write else self._read_queue).put(job)
+        self._notify(job, None)
+        return job
+        
+    def jobs(self):
+        """最近的任务（含已结束的），按提交顺序"""
+        with self._lock:
+            return list(self._jobs.values())
+        
+    def active(self):
+        """排队中和执行中的任务"""
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.finished]
+        
+    def cancel_all(self):
+        for job in self.active():
+            job.cancel()
+        
+    def wait(self, timeout=None):
+        """等待所有已提交的任务结束，超时返回 False"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not any(not job.finished for job in self._jobs.values()), timeout)
+        
+    def shutdown(self, cancel=True, wait=True, timeout=None):
+        """不再接受新任务；cancel 为 True 时取消排队和执行中的任务（False 时执行完队列中的任务）
+        
+        wait 为 True 时等待工作线程结束；返回工作线程是否都已结束。
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                # 结束标记排在已有任务之后：排队中的任务先被取消（或执行完），线程再退出
+                for _, jobs in self._threads:
+                    jobs.put(None)
+        if cancel:
+            self.cancel_all()
+        if wait:
+            for thread, _ in self._threads:
+                thread.join(timeout)
+        return not any(thread.is_alive() for thread, _ in self._threads)
+        
+    def _run(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            self._execute(job)
+        
+    def _execute(self, job):
+        if job.cancel_event.is_set():
+            self._finish(job, 'cancelled', 'on_cancel')
+            return
+        job.status = 'running'
+        self._notify(job, None)
+        try:
+            job.result = job._func(job)
+        except OperationCancelled:
+            self._finish(job, 'cancelled', 'on_cancel')
+        except Exception as e:
+            job.error = e
+            self._finish(job, 'failed', 'on_error', e)
+        else:
+            self._finish(job, 'done', 'on_done', job.result)
+        
+    def _finish(self, job, status, callback, *args):
+        job._func = None
+        # 先转交结果回调再标记结束：等待任务结束的一方看到结束时，回调已经排进 dispatch
+        self._notify(job, callback, *args)
+        with self._idle:
+            job.status = status
+            self._idle.notify_all()
+        job._finished.set()
+        self._notify(job, None)
+        
+    def _notify(self, job, callback, *args):
+        calls = [(job._callbacks.get(callback), args)] if callback else []
+        calls.append((self.on_change, ()))
+        for func, func_args in calls:
+            if func is None:
+                continue
+            try:
+                if self.dispatch is not None:
+                    self.dispatch(func, *func_args)
+                else:
+                    func(*func_args)
+            except Exception as e:
+                # 回调出错不能让工作线程退出
+                print(f"后台任务“{job.name}”的回调出错: {e}", file=sys.stderr)
+        
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY_SIZE)]:
+            del self._jobs[job_id]
+
+class DiseaseIndex:
+    """疾病名称检索索引：有序列表做前缀查找，字符倒排表做子串查找"""
+    
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self._char_postings = {}
+        for position, name in enumerate(self.names):
+            for ch in set(name):
+                self._char_postings.setdefault(ch, set()).add(position)
+        
+    def prefix(self, prefix):
+        """返回以 prefix 开头的名称（有序）"""
+        lo = bisect_left(self.names, prefix)
+        hi = bisect_left(self.names, prefix + '\U0010ffff')
+        return self.names[lo:hi]
+        
+    def search(self, query):
+        """返回包含 query 的名称：前缀匹配在前，其余子串匹配在后"""
+        query = query.strip()
+        if not query:
+            return self.names
+        
+        prefix_matches = self.prefix(query)
+        # 查询中每个字符的倒排表取交集，候选集通常只有几十条
+        postings = sorted((self._char_postings.get(ch, set()) for ch in set(query)), key=len)
+        candidates = set.intersection(*postings) if postings else set()
+        prefix_set = set(prefix_matches)
+        others = [self.names[i] for i in sorted(candidates)
+                  if query in self.names[i] and self.names[i] not in prefix_set]
+        return prefix_matches + others
+
+class CompletionIndex:
+    """标注输入的类别名自动补全：前缀树，每个节点缓存其子树中病例数最多的前 limit 个名称
+    
+    补全只需沿输入的前缀走到对应节点，耗时与名称总数无关；病例数变化或出现新名称时
+    只重算该名称路径上的节点。前缀不区分英文大小写。
+    """
+    
+    class Node:
+        __slots__ = ('children', 'top', 'names')
+        
+        def __init__(self):
+            self.children = {}
+            self.top = []
+            # 在本节点结束的名称（只差大小写的名称共用一条路径）
+            self.names = []
+            
+    def __init__(self, counts, limit=COMPLETION_LIMIT):
+        self.limit = limit
+        self.counts = dict(counts)
+        self._root = self.Node()
+        # 按病例数从多到少插入，每个节点的前 limit 个就是最先到达的 limit 个名称
+        for name in sorted(self.counts, key=self._rank):
+            node = self._root
+            for ch in name.casefold():
+                node = node.children.setdefault(ch, self.Node())
+                if len(node.top) < self.limit:
+                    node.top.append(name)
+            node.names.append(name)
+        
+    def __len__(self):
+        return len(self.counts)
+        
+    def complete(self, prefix):
+        """以 prefix 开头的名称，按病例数从多到少，最多 limit 个"""
+        node = self._root
+        for ch in prefix.casefold():
+            node = node.children.get(ch)
+            if node is None:
+                return []
+        return list(node.top) if node is not self._root else []
+        
+    def adjust(self, name, delta):
+        """名称的病例数增加 delta（新名称从0开始，减到0时移除）"""
+        count = self.counts.get(name, 0) + delta
+        if count > 0:
+            self.counts[name] = count
+        else:
+            self.counts.pop(name, None)
+        
+        path = [self._root]
+        for ch in name.casefold():
+            child = path[-1].children.get(ch)
+            if child is None:
+                if count <= 0:
+                    return
+                child = path[-1].children[ch] = self.Node()
+            path.append(child)
+        if name in path[-1].names:
+            path[-1].names.remove(name)
+        if count > 0:
+            path[-1].names.append(name)
+        
+        # 自下而上重算路径上各节点的前 limit 名：子节点的前 limit 名加上在本节点结束的名称（根节点不用于补全）
+        for node in reversed(path[1:]):
+            candidates = [name for child in node.children.values() for name in child.top] + node.names
+            node.top = sorted(candidates, key=self._rank)[:self.limit]
+        
+    def _rank(self, name):
+        return (-self.counts.get(name, 0), name)
+
+class CaseNavigator:
+    """筛选结果的键集分页导航：内存中只保留稀疏锚点（每 NAV_ANCHOR_INTERVAL 条一个id）和当前一页id
+    
+    第N条 = 第 N // 间隔 个锚点之后跳过 N % 间隔 条；id的位置 = 锚点上二分查找 + 锚点之后计数。
+    两者都是 id 有序临时表上的有界范围查询：创建时把筛选结果物化为快照，之后修改标注（如删掉
+    正在筛选的类别）或其它进程导入都不会让锚点和总数失效，翻页始终对应创建时的结果。
+    临时表建在导航器独占的连接上，因此导航器可以在后台线程中创建、交给UI线程使用。
+    """
+    
+    # 物化临时表的编号
+    _sequence = counter()
+    
+    def __init__(self, db, source_sql, params=(),
+                 anchor_interval=NAV_ANCHOR_INTERVAL, page_size=NAV_PAGE_SIZE):
+        self.db = db
+        self.anchor_interval = anchor_interval
+        self.page_size = page_size
+        self._source = (source_sql, list(params))
+        self._table = f"nav_{next(CaseNavigator._sequence)}"
+        self._conn = db.open_connection()
+        self._page_start = 0
+        self._page = []
+        
+        conn = self._conn
+        conn.execute(f"CREATE TEMP TABLE {self._table} (id TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute(f"INSERT INTO temp.{self._table} (id) {source_sql}", params)
+        conn.commit()
+        self._sql, self._params = f"SELECT id FROM temp.{self._table}", []
+        
+        # 锚点和总数各需一次索引扫描，只在筛选变化时执行
+        self.anchors = [row[0] for row in conn.execute(
+            f"""SELECT id FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY id) AS n FROM ({self._sql}))
+                WHERE (n - 1) % ? = 0 ORDER BY id""",
+            self._params + [anchor_interval]
+        )]
+        self.total = conn.execute(f"SELECT COUNT(*) FROM ({self._sql})", self._params).fetchone()[0]
+        
+    def __len__(self):
+        return self.total
+        
+    def __iter__(self):
+        """按id顺序遍历全部结果（键集分批读取，不占用导航的临时表，可在后台线程中使用）"""
+        sql, params = self._source
+        last_id = None
+        while True:
+            with self.db.connection() as conn:
+                if last_id is None:
+                    rows = conn.execute(f"SELECT id FROM ({sql}) ORDER BY id LIMIT ?", params + [self.page_size * 16])
+                else:
+                    rows = conn.execute(
+                        f"SELECT id FROM ({sql}) WHERE id > ? ORDER BY id LIMIT ?",
+                        params + [last_id, self.page_size * 16]
+                    )
+                ids = [row[0] for row in rows]
+            if not ids:
+                return
+            yield from ids
+            last_id = ids[-1]
+        
+    def id_at(self, position):
+        """第 position 条记录（从0开始）的id"""
+        if not 0 <= position < self.total:
+            raise IndexError(position)
+        if not self._page_start <= position < self._page_start + len(self._page):
+            # 新页以目标位置为中心，前后翻页都能命中
+            start = max(min(position - self.page_size // 2, self.total - self.page_size), 0)
+            self._page = self._fetch(start, self.page_size)
+            self._page_start = start
+        return self._page[position - self._page_start]
+        
+    def ids_between(self, start, stop):
+        """位置 [start, stop) 的id（预取用）"""
+        start, stop = max(start, 0), min(stop, self.total)
+        if start >= stop:
+            return []
+        page_stop = self._page_start + len(self._page)
+        if self._page_start <= start and stop <= page_stop:
+            return self._page[start - self._page_start:stop - self._page_start]
+        return self._fetch(start, stop - start)
+        
+    def insertion_point(self, case_id):
+        """结果中id小于 case_id 的记录数，即 case_id 所在（或应在）的位置"""
+        block = bisect_right(self.anchors, case_id) - 1
+        if block < 0:
+            return 0
+        count = self._conn.execute(
+            f"SELECT COUNT(*) FROM (SELECT id FROM ({self._sql}) WHERE id >= ? AND id < ? ORDER BY id LIMIT ?)",
+            self._params + [self.anchors[block], case_id, self.anchor_interval]
+        ).fetchone()[0]
+        return block * self.anchor_interval + count
+        
+    def position_of(self, case_id):
+        """case_id 在结果中的位置，不在结果中时返回 None"""
+        position = self.insertion_point(case_id)
+        if position < self.total and self.id_at(position) == case_id:
+            return position
+        return None
+        
+    def close(self):
+        """关闭物化用的连接（临时表随之删除）"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._table = None
+        
+    def _fetch(self, start, count):
+        block, offset = divmod(start, self.anchor_interval)
+        return [row[0] for row in self._conn.execute(
+            f"SELECT id FROM ({self._sql}) WHERE id >= ? ORDER BY id LIMIT ? OFFSET ?",
+            self._params + [self.anchors[block], count, offset]
+        )]
+
+class FilterExpressionError(ValueError):
+    """组合筛选条件有语法错误或引用了不存在的类别"""
+
+# 组合筛选条件的关键字（不区分大小写），相邻两个条件之间省略关键字时按 AND 处理
+FILTER_KEYWORDS = {'AND': 'and', '且': 'and', 'OR': 'or', '或': 'or', 'NOT': 'not', '非': 'not'}
+
+# 组合筛选条件的词法：括号、双引号括起的类别名（"" 表示引号本身）、标签数条件、其它连续的非空白字符
+FILTER_TOKEN = re.compile(
+    r'\s*(?:(?P<paren>[()])|"(?P<quoted>(?:[^"]|"")*)"|'
+    r'(?P<count>(?:标签数|labels))\s*(?P<op>>=|<=|!=|==|=|>|<)\s*(?P<number>\d+)|(?P<word>[^\s()"]+))',
+    re.IGNORECASE
+)
+
+def quote_filter_name(name):
+    """类别名写入组合筛选条件时的形式：含空白、括号、引号或与关键字/标签数条件冲突时加双引号"""
+    match = FILTER_TOKEN.fullmatch(name)
+    if match and match.group('word') and name.upper() not in FILTER_KEYWORDS:
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+def parse_filter_expression(text):
+    """解析组合筛选条件，返回语法树：('disease', 名称) / ('count', 比较符, 数量) / ('not', x) / ('and'|'or', x, y)
+    
+    例如 "肺炎 AND 糖尿病 NOT 结核"、"(肺炎 OR 支气管炎) AND 标签数>3"；优先级 NOT > AND > OR。
+    """
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = FILTER_TOKEN.match(text, position)
+        if match is None:
+            raise FilterExpressionError(f"无法解析: {text[position:]}")
+        position = match.end()
+        if match.group('paren'):
+            tokens.append((match.group('paren'), None))
+        elif match.group('quoted') is not None:
+            tokens.append(('disease', match.group('quoted').replace('""', '"')))
+        elif match.group('count'):
+            tokens.append(('count', (match.group('op').replace('==', '='), int(match.group('number')))))
+        elif match.group('word').upper() in FILTER_KEYWORDS:
+            tokens.append((FILTER_KEYWORDS[match.group('word').upper()], None))
+        else:
+            tokens.append(('disease', match.group('word')))
+    if not tokens:
+        raise FilterExpressionError("筛选条件为空")
+    
+    index = 0
+    
+    def peek():
+        return tokens[index][0] if index < len(tokens) else None
+    
+    def parse_or():
+        nonlocal index
+        node = parse_and()
+        while peek() == 'or':
+            index += 1
+            node = ('or', node, parse_and())
+        return node
+    
+    def parse_and():
+        nonlocal index
+        node = parse_not()
+        while peek() in ('and', 'not', 'disease', 'count', '('):
+            if peek() == 'and':
+                index += 1
+            node = ('and', node, parse_not())
+        return node
+    
+    def parse_not():
+        nonlocal index
+        if peek() == 'not':
+            index += 1
+            return ('not', parse_not())
+        return parse_atom()
+    
+    def parse_atom():
+        nonlocal index
+        kind = peek()
+        if kind is None:
+            raise FilterExpressionError("筛选条件不完整")
+        value = tokens[index][1]
+        index += 1
+        if kind == 'disease':
+            return ('disease', value)
+        if kind == 'count':
+            return ('count',) + value
+        if kind == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise FilterExpressionError("缺少右括号")
+            index += 1
+            return node
+        raise FilterExpressionError(f"此处不应出现 {'右括号' if kind == ')' else kind.upper()}")
+    
+    tree = parse_or()
+    if index < len(tokens):
+        raise FilterExpressionError("多余的右括号" if peek() == ')' else "筛选条件无法解析")
+    return tree
+
+def expression_diseases(tree):
+    """语法树中引用的全部类别名"""
+    if tree[0] == 'disease':
+        return {tree[1]}
+    if tree[0] == 'count':
+        return set()
+    return set().union(*(expression_diseases(child) for child in tree[1:]))
+
+class BitmapIndex:
+    """类别位图索引：病例按id排序后的序号作为位，布尔组合筛选在内存中按位运算完成
+    
+    病例较多的类别存为打包位图（uint64 数组），较少的存为有序序号数组（与 roaring bitmap 的两种容器类似），
+    另有每个病例的类别数数组，用于"标签数>3"这类条件。索引记录建立时的修改记录位置，每次查询前
+    按修改记录增量追上之后的保存、改名和撤销（包括其他标注员的修改）；出现新病例或所需的修改记录
+    已被压缩时整体重建。
+    """
+    
+    def __init__(self, conn):
+        self._lock = threading.Lock()
+        self.build(conn)
+        
+    def __len__(self):
+        return len(self.ids)
+        
+    def build(self, conn):
+        """从 cases / case_diseases 表建立索引"""
+        import numpy as np
+        cursor = conn.cursor()
+        # 病例、类别和修改记录位置取自同一个读快照
+        cursor.execute("BEGIN")
+        try:
+            self.ids = [row[0] for row in cursor.execute("SELECT id FROM cases ORDER BY id")]
+            positions = {case_id: position for position, case_id in enumerate(self.ids)}
+            # 每个类别一行（id用单元分隔符拼接），比逐行读取病例-类别对快得多
+            members = {
+                disease: [positions[case_id] for case_id in case_ids.split('\x1f') if case_id in positions]
+                for disease, case_ids in cursor.execute(
+                    "SELECT disease, group_concat(case_id, char(31)) FROM case_diseases GROUP BY disease"
+                )
+            }
+            self.seq = journal_position(cursor)
+        finally:
+            conn.commit()
+        
+        self._words = (len(self.ids) + 63) // 64
+        self._all = self._pack(np.arange(len(self.ids)))
+        self._containers = {}
+        counts = np.zeros(len(self.ids), dtype=np.int64)
+        for disease, disease_positions in members.items():
+            disease_positions = np.array(disease_positions, dtype=np.int32)
+            disease_positions.sort()
+            counts[disease_positions] += 1
+            self._containers[disease] = self._container(disease_positions)
+        self.counts = counts.astype(np.uint16)
+        
+    def sync(self, conn):
+        """按修改记录追上索引建立之后的标注变化"""
+        cursor = conn.cursor()
+        position = journal_position(cursor)
+        if position == self.seq:
+            return
+        cursor.execute('''
+            SELECT change_log.seq, change_log.case_id, change_log.old_value, change_log.new_value, operations.kind
+            FROM change_log LEFT JOIN operations ON operations.id = change_log.operation_id
+            WHERE change_log.seq > ? ORDER BY change_log.seq
+        ''', (self.seq,))
+        changes = cursor.fetchall()
+        # 写事务互斥，回滚也不会留下序号空洞：修改记录应当逐条连续，中间缺少任何一段都说明已被压缩
+        if position < self.seq or not changes or changes[-1][0] - self.seq != len(changes):
+            # 修改记录被清空（全量替换导入会让位置前进一格），或尚未应用的部分已被压缩
+            self.build(conn)
+            return
+        
+        # 每个病例取第一次修改前的旧值和最后一次修改后的新值
+        spans = {}
+        for _, case_id, old, new, kind in changes:
+            if kind == 'import' and old is None and new is None:
+                # 合并导入只更新了描述/诊断，标注没有变化
+                continue
+            spans[case_id] = (spans[case_id][0] if case_id in spans else old, new)
+        self._apply(spans)
+        self.seq = changes[-1][0]
+        
+    def _apply(self, spans):
+        """把 {case_id: (旧标注, 新标注)} 应用到索引；遇到索引中没有的病例时抛出 LookupError"""
+        import numpy as np
+        added, removed = {}, {}
+        for case_id, (old, new) in spans.items():
+            position = self.position(case_id)
+            if position is None:
+                raise LookupError(case_id)
+            old, new = set(split_diseases(old)), set(split_diseases(new))
+            for disease in new - old:
+                added.setdefault(disease, []).append(position)
+            for disease in old - new:
+                removed.setdefault(disease, []).append(position)
+            self.counts[position] = len(new)
+        
+        for disease in set(added) | set(removed):
+            container = self._containers.get(disease)
+            positions = self._positions(container) if container is not None else np.zeros(0, dtype=np.int32)
+            positions = np.union1d(positions, np.array(added.get(disease, []), dtype=np.int32))
+            positions = np.setdiff1d(positions, np.array(removed.get(disease, []), dtype=np.int32))
+            if len(positions):
+                self._containers[disease] = self._container(positions.astype(np.int32))
+            else:
+                self._containers.pop(disease, None)
+        
+    def position(self, case_id):
+        """病例在索引中的序号，不存在时返回 None"""
+        position = bisect_left(self.ids, case_id)
+        return position if position < len(self.ids) and self.ids[position] == case_id else None
+        
+    def query(self, conn, tree, id_range=None):
+        """追上最新修改后求值语法树，返回匹配病例的id（按id排序）；id_range 限定任务的id区间"""
+        import numpy as np
+        with self._lock:
+            try:
+                self.sync(conn)
+            except LookupError:
+                # 修改记录中出现了索引建立之后新增的病例
+                self.build(conn)
+            unknown = expression_diseases(tree) - set(self._containers)
+            if unknown:
+                raise FilterExpressionError("没有这些类别: " + "、".join(sorted(unknown)))
+            positions = self._positions(self.evaluate(tree))
+            if id_range is not None:
+                start, end = id_range
+                lo = np.searchsorted(positions, bisect_left(self.ids, start))
+                hi = np.searchsorted(positions, bisect_left(self.ids, end)) if end is not None else len(positions)
+                positions = positions[lo:hi]
+            ids = self.ids
+            return [ids[position] for position in positions.tolist()]
+        
+    def evaluate(self, tree):
+        """求值语法树，返回打包位图"""
+        import numpy as np
+        kind = tree[0]
+        if kind == 'disease':
+            container = self._containers[tree[1]]
+            return container if container.dtype == np.uint64 else self._pack(container)
+        if kind == 'count':
+            _, op, number = tree
+            comparisons = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+                           '=': np.equal, '!=': np.not_equal}
+            bits = np.zeros(self._words * 64, dtype=bool)
+            bits[:len(self.counts)] = comparisons[op](self.counts, number)
+            return np.packbits(bits, bitorder='little').view('<u8')
+        if kind == 'not':
+            return ~self.evaluate(tree[1]) & self._all
+        left, right = self.evaluate(tree[1]), self.evaluate(tree[2])
+        return left & right if kind == 'and' else left | right
+        
+    def _container(self, positions):
+        # 有序序号数组每个病例占4字节，位图每个病例占1位：病例数不到总数的1/32时数组更省空间
+        if len(positions) * 32 < len(self.ids):
+            return positions
+        return self._pack(positions)
+        
+    def _pack(self, positions):
+        import numpy as np
+        bits = np.zeros(self._words * 64, dtype=bool)
+        bits[positions] = True
+        return np.packbits(bits, bitorder='little').view('<u8')
+        
+    def _positions(self, container):
+        import numpy as np
+        if container.dtype != np.uint64:
+            return container
+        return np.flatnonzero(np.unpackbits(container.view(np.uint8), bitorder='little')).astype(np.int32)
+
+class ListNavigator:
+    """内存中已排序id列表上的导航（位图索引的筛选结果），接口与 CaseNavigator 相同"""
+    
+    def __init__(self, ids):
+        self.ids = ids
+        
+    def __len__(self):
+        return len(self.ids)
+        
+    def __iter__(self):
+        return iter(self.ids)
+        
+    def id_at(self, position):
+        if not 0 <= position < len(self.ids):
+            raise IndexError(position)
+        return self.ids[position]
+        
+    def ids_between(self, start, stop):
+        return self.ids[max(start, 0):max(stop, 0)]
+        
+    def insertion_point(self, case_id):
+        return bisect_left(self.ids, case_id)
+        
+    def position_of(self, case_id):
+        position = self.insertion_point(case_id)
+        if position < len(self.ids) and self.ids[position] == case_id:
+            return position
+        return None
+        
+    def close(self):
+        pass
+
+class AnnotationEngine:
+    """标注数据引擎：封装数据库结构与所有批处理操作，GUI和命令行共用"""
+    
+    def __init__(self, db_path=None, instrumentation=None):
+        db_path = db_path or default_db_path()
+        self.db_path = db_path
+        self.instrumentation = instrumentation or Instrumentation.from_environment()
+        self.db = Database(db_path, instrumentation=self.instrumentation)
+        self.fts_enabled = False
+        # 类别位图索引在第一次使用（或 build_index）时建立，导入后作废
+        self._bitmap_index = None
+        self._bitmap_index_lock = threading.Lock()
+        self.init_schema()
+        
+    def init_schema(self):
+        """创建表、索引和触发器，并升级旧版本数据库"""
+        conn = self.db.main_conn
+        cursor = conn.cursor()
+        
+        # 创建病例数据表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cases (
+                id TEXT PRIMARY KEY,
+                description TEXT,
+                diagnosis TEXT,
+                annotations TEXT,
+                source_annotations TEXT,
+                content_hash TEXT,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # 旧版本数据库补充内容摘要列（合并导入用）、导入时的原始标注列（统计已修改病例用）
+        # 和版本号列（多人同时标注时的乐观并发检查，每次修改加一）
+        cursor.execute("PRAGMA table_info(cases)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if 'content_hash' not in columns:
+            cursor.execute("ALTER TABLE cases ADD COLUMN content_hash TEXT")
+        if 'source_annotations' not in columns:
+            cursor.execute("ALTER TABLE cases ADD COLUMN source_annotations TEXT")
+        if 'version' not in columns:
+            cursor.execute("ALTER TABLE cases ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        
+        # 创建疾病类型表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS diseases (
+                name TEXT PRIMARY KEY
+            )
+        ''')
+        
+        # 创建病例-疾病索引表（标注拆分后的规范化形式，筛选和重命名走索引精确匹配）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS case_diseases (
+                case_id TEXT NOT NULL,
+                disease TEXT NOT NULL,
+                PRIMARY KEY (case_id, disease)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_case_diseases_disease ON case_diseases (disease, case_id)")
+        
+        # 统计表：每个类别的病例数/已修改数、类别两两共现数、病例总数（由触发器增量维护）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS disease_counts (
+                disease TEXT PRIMARY KEY,
+                cases INTEGER NOT NULL,
+                modified INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS disease_pairs (
+                disease_a TEXT NOT NULL,
+                disease_b TEXT NOT NULL,
+                cases INTEGER NOT NULL,
+                PRIMARY KEY (disease_a, disease_b)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_disease_pairs_cases ON disease_pairs (cases)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS case_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                cases INTEGER NOT NULL,
+                labelled INTEGER NOT NULL,
+                modified INTEGER NOT NULL
+            )
+        ''')
+        
+        # 每个筛选条件最后浏览的病例（再次打开同一筛选时从这里继续）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS nav_positions (
+                filter_key TEXT PRIMARY KEY,
+                case_id TEXT NOT NULL
+            )
+        ''')
+        
+        # 每名标注员退出时的会话快照（筛选条件、当前病例、类别列表），下次启动时先按快照显示
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                annotator TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                saved_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+        
+        # 修改记录（只追加）：每个操作一行，操作涉及的每个病例一行（旧值、新值）；用于撤销/重做和增量导出
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS operations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                description TEXT,
+                target INTEGER,
+                undone INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                operation_id INTEGER NOT NULL,
+                case_id TEXT NOT NULL,
+                old_value TEXT,
+                new_value TEXT,
+                old_source TEXT,
+                new_source TEXT,
+                changed_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_operation ON change_log (operation_id)")
+        
+        # 标注任务：按id区间划分的互不重叠的病例范围，每个标注员领取一个
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS work_batches (
+                id INTEGER PRIMARY KEY,
+                start_id TEXT NOT NULL,
+                end_id TEXT,
+                cases INTEGER NOT NULL,
+                annotator TEXT,
+                claimed_at TEXT,
+                finished_at TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_work_batches_annotator ON work_batches (annotator)")
+        
+        # 增量导出标记：每个标记记录上次导出时修改记录的位置
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS export_marks (
+                name TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                exported_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+        
+        self.init_fulltext_index(cursor)
+        
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        # 旧版本数据库：根据现有标注回填索引表
+        if version < 1:
+            cursor.execute("SELECT id, annotations FROM cases")
+            sync_case_diseases(cursor, cursor.fetchall())
+        # 统计表：导入时的原始标注已无从得知，以当前标注为基准
+        if version < 2:
+            cursor.execute("UPDATE cases SET source_annotations = annotations WHERE source_annotations IS NULL")
+            rebuild_statistics(cursor)
+        if version < SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        create_triggers(cursor, STATS_TRIGGERS)
+        
+        conn.commit()
+        
+    def init_fulltext_index(self, cursor):
+        """创建描述/诊断的FTS5全文索引（trigram分词，适用于中文），由触发器随 cases 表增量维护"""
+        existed = has_fulltext_index(cursor)
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS cases_fts USING fts5(
+                    description, diagnosis,
+                    content='cases', content_rowid='rowid', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            # SQLite 版本低于3.34（无trigram分词）或未编译FTS5：检索退化为逐行扫描
+            self.fts_enabled = False
+            return
+        
+        create_triggers(cursor, FULLTEXT_TRIGGERS)
+        
+        # 已有数据的旧数据库首次建立索引
+        if not existed:
+            cursor.execute("INSERT INTO cases_fts (cases_fts) VALUES ('rebuild')")
+        self.fts_enabled = True
+        
+    def close(self):
+        self.db.close()
+        self.instrumentation.close()
+        
+    def has_cases(self):
+        with self.db.connection() as conn:
+            return bool(conn.execute("SELECT EXISTS (SELECT 1 FROM cases)").fetchone()[0])
+        
+    def disease_names(self):
+        """全部疾病类别（按名称排序）"""
+        with self.db.connection() as conn:
+            return [row[0] for row in conn.execute("SELECT name FROM diseases ORDER BY name")]
+        
+    def disease_counts(self):
+        """每个疾病类别的病例数（读取增量维护的统计表）"""
+        with self.db.connection() as conn:
+            return dict(conn.execute("SELECT disease, cases FROM disease_counts"))
+        
+    def disease_statistics(self):
+        """每个类别的 (名称, 病例数, 已修改病例数)，按病例数降序"""
+        with self.db.connection() as conn:
+            return conn.execute(
+                "SELECT disease, cases, modified FROM disease_counts ORDER BY cases DESC, disease"
+            ).fetchall()
+        
+    def top_pairs(self, limit=50):
+        """共现病例最多的类别对 (类别A, 类别B, 病例数)"""
+        with self.db.connection() as conn:
+            return conn.execute(
+                "SELECT disease_a, disease_b, cases FROM disease_pairs ORDER BY cases DESC LIMIT ?", (limit,)
+            ).fetchall()
+        
+    def totals(self):
+        """病例总数、有类别的病例数、已修改（标注与导入时不同）的病例数"""
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT cases, labelled, modified FROM case_totals").fetchone() or (0, 0, 0)
+        return dict(zip(('cases', 'labelled', 'modified'), row))
+        
+    def query_ids(self, diseases=(), search_text="", intersect=True, id_range=None):
+        """按类别（任一匹配）和/或全文检索筛选病例，返回按id排序的列表
+        
+        同时给出类别和检索词时，intersect 为 True 取交集，否则只按检索词筛选；id_range 限定任务的id区间。
+        """
+        sql, params = filter_source(diseases, search_text, intersect, self.fts_enabled, id_range)
+        with self.instrumentation.measure("filter", diseases=len(diseases), search=bool(search_text)) as fields, \
+                self.db.connection() as conn:
+            ids = [row[0] for row in conn.execute(f"SELECT id FROM ({sql}) ORDER BY id", params)]
+            fields['matches'] = len(ids)
+            return ids
+        
+    def navigator(self, diseases=(), search_text="", intersect=True, id_range=None):
+        """按筛选条件创建键集分页导航器（条件同 query_ids），只在内存中保留锚点和当前页"""
+        sql, params = filter_source(diseases, search_text, intersect, self.fts_enabled, id_range)
+        with self.instrumentation.measure("filter", diseases=len(diseases), search=bool(search_text)) as fields:
+            navigator = CaseNavigator(self.db, sql, params)
+            fields['matches'] = len(navigator)
+        return navigator
+        
+    def build_index(self):
+        """建立（或取得已建立的）类别位图索引"""
+        with self._bitmap_index_lock:
+            if self._bitmap_index is None:
+                with self.instrumentation.measure("build_index") as fields, self.db.connection() as conn:
+                    self._bitmap_index = BitmapIndex(conn)
+                    fields['cases'] = len(self._bitmap_index)
+            return self._bitmap_index
+        
+    def expression_ids(self, expression, search_text="", intersect=True, id_range=None):
+        """按组合筛选条件（见 parse_filter_expression）在位图索引上筛选，返回按id排序的列表
+        
+        search_text、intersect、id_range 的含义与 query_ids 相同。条件有误时抛出 FilterExpressionError。
+        """
+        tree = parse_filter_expression(expression)
+        if search_text and not intersect:
+            return self.query_ids(search_text=search_text, id_range=id_range)
+        index = self.build_index()
+        with self.instrumentation.measure("filter", expression=True, search=bool(search_text)) as fields:
+            with self.db.connection() as conn:
+                ids = index.query(conn, tree, id_range)
+            if search_text:
+                matched = set(self.query_ids(search_text=search_text, id_range=id_range))
+                ids = [case_id for case_id in ids if case_id in matched]
+            fields['matches'] = len(ids)
+        return ids
+        
+    def expression_navigator(self, expression, search_text="", intersect=True, id_range=None):
+        """组合筛选结果的导航器（结果已在内存中，不需要物化临时表）"""
+        return ListNavigator(self.expression_ids(expression, search_text, intersect, id_range))
+        
+    def save_position(self, key, case_id):
+        """记录某个筛选条件下最后浏览的病例"""
+        with self.db.connection() as conn:
+            conn.execute(
+                "INSERT INTO nav_positions (filter_key, case_id) VALUES (?, ?) "
+                "ON CONFLICT (filter_key) DO UPDATE SET case_id = excluded.case_id",
+                (key, case_id)
+            )
+            conn.commit()
+        
+    def saved_position(self, key):
+        """某个筛选条件下最后浏览的病例id，没有记录时返回 None"""
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT case_id FROM nav_positions WHERE filter_key = ?", (key,)).fetchone()
+        return row[0] if row else None
+        
+    def save_session(self, annotator, state):
+        """保存标注员的会话快照（可序列化为JSON的字典）"""
+        with self.db.connection() as conn:
+            conn.execute(
+                "INSERT INTO sessions (annotator, state) VALUES (?, ?) ON CONFLICT (annotator) DO UPDATE "
+                "SET state = excluded.state, saved_at = datetime('now', 'localtime')",
+                (annotator, json.dumps(state, ensure_ascii=False))
+            )
+            conn.commit()
+        
+    def load_session(self, annotator):
+        """读取标注员的会话快照，没有或无法解析时返回 None"""
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT state FROM sessions WHERE annotator = ?", (annotator,)).fetchone()
+        try:
+            return json.loads(row[0]) if row else None
+        except ValueError:
+            return None
+        
+    def import_sources(self, paths, merge=False, progress=None, cancel_event=None, on_source=None, workers=None):
+        """并行导入多个文件/文件夹中的全部工作表（单一写入连接、一个事务），返回 (统计信息, 每个来源的结果)
+        
+        单个来源出错或缺少必需列时跳过并记录在结果中，不影响其它来源；全部来源都失败时报错并回滚。
+        merge 为 False 时先清空现有数据；不同来源中重复的id按合并导入的规则处理（后出现的内容为准，保留先导入的标注）。
+        """
+        sources = list_import_sources(paths)
+        if not sources:
+            raise ValueError("没有找到可导入的文件")
+        results = [
+            {'file': file_path, 'sheet': sheet, 'status': 'pending', 'rows': 0, 'total': None, 'error': None}
+            for file_path, sheet in sources
+        ]
+        
+        with self.instrumentation.measure("import", sources=len(sources), merge=merge) as fields:
+            with parse_sources(sources, workers) as messages, self.db.connection() as conn:
+                chunks = collect_source_chunks(messages, results, progress, cancel_event, on_source)
+                cursor = conn.cursor()
+                if merge:
+                    operation_id = begin_operation(cursor, 'import', f"{len(sources)} 个来源")
+                    stats = merge_cases(cursor, chunks, operation_id)
+                else:
+                    clear_cases(cursor)
+                    stats = merge_cases(cursor, chunks)
+                    finish_bulk_load(cursor)
+                
+                if not any(result['status'] == 'done' for result in results):
+                    failed = next((result for result in results if result['error']), None)
+                    raise ValueError(f"没有成功导入任何文件: {failed['error']}" if failed else "没有成功导入任何文件")
+                conn.commit()
+            fields.update(stats)
+        self._bitmap_index = None
+        return stats, results
+        
+    def export_file(self, file_path, case_ids=None, progress=None, cancel_event=None):
+        """流式导出病例（case_ids 为 None 时导出全部，并作为下一次增量导出的起点），返回导出行数"""
+        with self.instrumentation.measure("export", file=os.path.basename(file_path)) as fields, \
+                self.db.connection() as conn:
+            cursor = conn.cursor()
+            position = journal_position(cursor)
+            exported = export_cases(conn, file_path, case_ids, progress, cancel_event)
+            if case_ids is None:
+                set_export_mark(cursor, DEFAULT_EXPORT_MARK, position)
+                conn.commit()
+            fields['rows'] = exported
+        return exported
+        
+    def remap(self, mapping):
+        """在一个事务中执行类别映射，返回 (每个映射影响的病例数, 被修改的病例id)"""
+        with self.instrumentation.measure("rename", mappings=len(mapping)) as fields, self.db.connection() as conn:
+            counts, updated_ids = remap_diseases(conn.cursor(), mapping)
+            conn.commit()
+            fields['cases'] = len(updated_ids)
+        return counts, updated_ids
+        
+    def undo(self, operation_id=None):
+        """撤销一个操作（默认为最近一次尚未撤销的修改），返回 (操作id, 已恢复的病例id, 冲突的病例id)
+        
+        没有可撤销的操作时返回 None。
+        """
+        with self.instrumentation.measure("undo") as fields, self.db.connection() as conn:
+            cursor = conn.cursor()
+            if operation_id is None:
+                operation_id = last_undoable(cursor)
+                if operation_id is None:
+                    return None
+            restored, conflicts = apply_operation(cursor, operation_id, 'undo')
+            conn.commit()
+            fields.update(operation=operation_id, cases=len(restored), conflicts=len(conflicts))
+        return operation_id, restored, conflicts
+        
+    def redo(self, operation_id=None):
+        """重做一个已撤销的操作（默认为最近撤销、且之后没有新修改的操作），返回值同 undo"""
+        with self.instrumentation.measure("redo") as fields, self.db.connection() as conn:
+            cursor = conn.cursor()
+            if operation_id is None:
+                operation_id = next_redoable(cursor)
+                if operation_id is None:
+                    return None
+            restored, conflicts = apply_operation(cursor, operation_id, 'redo')
+            conn.commit()
+            fields.update(operation=operation_id, cases=len(restored), conflicts=len(conflicts))
+        return operation_id, restored, conflicts
+        
+    def history(self, limit=200):
+        """最近的操作 (id, 类型, 说明, 时间, 是否已撤销, 涉及病例数)，按时间倒序"""
+        with self.db.connection() as conn:
+            return conn.execute('''
+                SELECT id, kind, description, created_at, undone,
+                       (SELECT COUNT(*) FROM change_log WHERE operation_id = operations.id)
+                FROM operations ORDER BY id DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        
+    def pending_changes(self, mark=DEFAULT_EXPORT_MARK):
+        """上次导出以来变化过的病例数；还没有导出过时返回 None"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            since = export_mark(cursor, mark)
+            if since is None:
+                return None
+            return len(changed_case_ids(cursor, since, journal_position(cursor)))
+        
+    def export_changes(self, file_path, mark=DEFAULT_EXPORT_MARK, progress=None, cancel_event=None):
+        """增量导出：只导出上次导出以来变化过的病例（还没有导出过时导出全部），返回导出行数"""
+        with self.instrumentation.measure("export", file=os.path.basename(file_path), incremental=True) as fields, \
+                self.db.connection() as conn:
+            cursor = conn.cursor()
+            # 先确定本次导出覆盖到的位置，导出期间新写入的修改留给下一次
+            position = journal_position(cursor)
+            since = export_mark(cursor, mark)
+            case_ids = None if since is None else changed_case_ids(cursor, since, position)
+            exported = export_cases(conn, file_path, case_ids, progress, cancel_event)
+            set_export_mark(cursor, mark, position)
+            conn.commit()
+            fields['rows'] = exported
+        return exported
+        
+    def compact_journal(self, keep=JOURNAL_KEEP_OPERATIONS, vacuum=False):
+        """压缩修改记录（只保留最近 keep 个可撤销的操作），vacuum 为 True 时再整理数据库文件，返回删除的记录条数"""
+        with self.instrumentation.measure("compact", vacuum=vacuum) as fields, self.db.connection() as conn:
+            deleted = compact_journal(conn.cursor(), keep)
+            conn.commit()
+            if vacuum:
+                conn.execute("VACUUM")
+                # VACUUM 可能重排没有整数主键的表的 rowid，外部内容的全文索引需要重建
+                if self.fts_enabled:
+                    conn.execute("INSERT INTO cases_fts (cases_fts) VALUES ('rebuild')")
+                    conn.commit()
+            fields['deleted'] = deleted
+        return deleted
+        
+    def create_batches(self, size=WORK_BATCH_SIZE):
+        """按id顺序把病例划分为每份 size 条的任务，返回任务数"""
+        with self.db.connection() as conn:
+            count = create_work_batches(conn.cursor(), size)
+            conn.commit()
+        return count
+        
+    def batches(self):
+        """全部任务及其领取/完成状态"""
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                "SELECT id, start_id, end_id, cases, annotator, claimed_at, finished_at FROM work_batches ORDER BY id"
+            ).fetchall()
+        return [batch_info(row) for row in rows]
+        
+    def current_batch(self, annotator):
+        """标注员已领取但未完成的任务，没有时返回 None"""
+        with self.db.connection() as conn:
+            row = conn.execute(
+                """SELECT id, start_id, end_id, cases, annotator, claimed_at, finished_at FROM work_batches
+                   WHERE annotator = ? AND finished_at IS NULL ORDER BY id LIMIT 1""",
+                (annotator,)
+            ).fetchone()
+        return batch_info(row) if row else None
+        
+    def claim_batch(self, annotator):
+        """领取（或继续）一个任务，返回任务信息；没有可领取的任务时返回 None"""
+        with self.db.connection() as conn:
+            batch = claim_work_batch(conn.cursor(), annotator)
+            conn.commit()
+        return batch
+        
+    def finish_batch(self, batch_id, annotator, release=False):
+        """完成任务；release 为 True 时放弃任务，退回待领取"""
+        with self.db.connection() as conn:
+            finish_work_batch(conn.cursor(), batch_id, annotator, release)
+            conn.commit()
+        
+    def stats(self, top=20):
+        """病例、类别数量及病例数最多的类别和类别对（全部来自统计表，不扫描病例）"""
+        totals = self.totals()
+        with self.db.connection() as conn:
+            diseases = conn.execute("SELECT COUNT(*) FROM disease_counts").fetchone()[0]
+            top_diseases = conn.execute(
+                "SELECT disease, cases FROM disease_counts ORDER BY cases DESC, disease LIMIT ?", (top,)
+            ).fetchall()
+        return {
+            'cases': totals['cases'],
+            'annotated_cases': totals['labelled'],
+            'modified_cases': totals['modified'],
+            'diseases': diseases,
+            'top_diseases': top_diseases,
+            'top_pairs': self.top_pairs(top),
+        }
+
+def print_progress(processed, total):
+    """命令行进度输出（写到stderr，不影响管道中的结果）"""
+    if total:
+        sys.stderr.write(f"\r已处理 {processed}/{total} 行")
+    else:
+        sys.stderr.write(f"\r已处理 {processed} 行")
+    sys.stderr.flush()
+
+def describe_source(result):
+    """导入来源的显示名：文件名[工作表]"""
+    name = os.path.basename(result['file'])
+    return f"{name}[{result['sheet']}]" if result['sheet'] else name
+
+def parse_mapping_args(pairs):
+    """把命令行中的 旧名称=新名称 参数转换为映射"""
+    mapping = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise argparse.ArgumentTypeError(f"映射格式应为 旧名称=新名称: {pair}")
+        old, new = pair.split('=', 1)
+        mapping[old] = new
+    return mapping
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="engine.py", description="医疗数据标注工具命令行（无需图形界面）")
+    parser.add_argument("--db", default=default_db_path(),
+                        help=f"数据库文件（默认为环境变量 {DB_PATH_ENV}，未设置时为 {DEFAULT_DB_PATH}）")
+    parser.add_argument("--perf-log", help="把每次操作和查询的耗时追加写入该文件（JSON Lines）")
+    parser.add_argument("--profile", metavar="DIR", help="对每次操作做 cProfile 剖析，结果保存到该目录")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    p = commands.add_parser("import", help="导入Excel/CSV文件或文件夹（多个来源时并行解析，导入全部工作表）")
+    p.add_argument("paths", nargs="+", metavar="file")
+    p.add_argument("--merge", action="store_true", help="合并导入：保留已有标注，只写入新增/变化的病例")
+    p.add_argument("--workers", type=int, help=f"解析进程数（默认 {IMPORT_WORKERS}）")
+    
+    p = commands.add_parser("export", help="导出为 .xlsx/.csv/.parquet（按扩展名）")
+    p.add_argument("file")
+    add_filter_args(p)
+    p.add_argument("--changes", action="store_true", help="只导出上次导出以来变化过的病例（增量导出）")
+    
+    p = commands.add_parser("remap", help="批量修改类别名（新名称为空表示删除）")
+    p.add_argument("pairs", nargs="*", metavar="旧名称=新名称")
+    p.add_argument("--csv", help="两列（旧名称, 新名称）的映射CSV")
+    
+    p = commands.add_parser("stats", help="显示病例、类别和类别共现统计")
+    p.add_argument("--top", type=int, default=20, help="列出病例数最多的前N个类别和类别对")
+    
+    for name, text in (("undo", "撤销"), ("redo", "重做")):
+        p = commands.add_parser(name, help=f"{text}一个修改操作（默认为最近一次）")
+        p.add_argument("--operation", type=int, help=f"要{text}的操作id（见 history）")
+    
+    p = commands.add_parser("history", help="列出最近的修改操作")
+    p.add_argument("--limit", type=int, default=20)
+    
+    p = commands.add_parser("compact", help="压缩修改记录，只保留最近的可撤销操作")
+    p.add_argument("--keep", type=int, default=JOURNAL_KEEP_OPERATIONS, help=f"保留的操作数（默认 {JOURNAL_KEEP_OPERATIONS}）")
+    p.add_argument("--vacuum", action="store_true", help="同时整理数据库文件以回收空间")
+    
+    p = commands.add_parser("batches", help="列出标注任务，或按id顺序重新划分任务")
+    p.add_argument("--create", type=int, metavar="SIZE", help="按每个任务 SIZE 条病例重新划分")
+    
+    p = commands.add_parser("claim", help="为标注员领取（或继续）一个任务")
+    p.add_argument("--annotator", default=None, help=f"标注员名称（默认为环境变量 {ANNOTATOR_ENV} 或 用户名@主机名）")
+    
+    p = commands.add_parser("finish", help="完成或放弃自己领取的任务")
+    p.add_argument("batch", type=int)
+    p.add_argument("--annotator", default=None)
+    p.add_argument("--release", action="store_true", help="放弃任务，退回待领取")
+    
+    p = commands.add_parser("query", help="按类别/全文检索筛选病例，输出id")
+    add_filter_args(p)
+    p.add_argument("--count", action="store_true", help="只输出匹配数量")
+    p.add_argument("--limit", type=int, help="最多输出N个id")
+    return parser
+
+def add_filter_args(parser):
+    parser.add_argument("--disease", action="append", default=[], help="筛选类别（可重复，任一匹配）")
+    parser.add_argument("--search", default="", help="在描述/诊断中全文检索")
+    parser.add_argument("--union", action="store_true", help="同时给出类别和检索词时不取交集，只按检索词筛选")
+    parser.add_argument("--expr", default="", help="组合筛选条件，代替 --disease，如 \"肺炎 AND 糖尿病 NOT 结核\"、\"标签数>3\"")
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    instrumentation = Instrumentation.from_environment()
+    if args.perf_log:
+        instrumentation.enable(args.perf_log)
+    if args.profile:
+        instrumentation.set_profiling(args.profile)
+    engine = AnnotationEngine(args.db, instrumentation)
+    try:
+        if args.command == "import":
+            stats, results = engine.import_sources(
+                args.paths, merge=args.merge, progress=print_progress, workers=args.workers
+            )
+            sys.stderr.write("\n")
+            for result in results:
+                if result['status'] != 'done':
+                    print(f"{describe_source(result)}: {result['error']}", file=sys.stderr)
+            done = sum(1 for result in results if result['status'] == 'done')
+            print(f"成功导入 {done}/{len(results)} 个工作表；新增 {stats['inserted']} 条，更新 {stats['updated']} 条，"
+                  f"未变化 {stats['unchanged']} 条；新增疾病 {stats['new_diseases']} 种")
+                  
+        elif args.command == "export":
+            if args.changes:
+                if args.disease or args.search or args.expr:
+                    raise ValueError("增量导出不能同时指定筛选条件")
+                exported = engine.export_changes(args.file, progress=print_progress)
+            else:
+                case_ids = None
+                if args.expr:
+                    case_ids = engine.expression_ids(args.expr, args.search, intersect=not args.union)
+                elif args.disease or args.search:
+                    case_ids = engine.query_ids(args.disease, args.search, intersect=not args.union)
+                exported = engine.export_file(args.file, case_ids, progress=print_progress)
+            sys.stderr.write("\n")
+            print(f"已导出 {exported} 条记录到 {args.file}")
+            
+        elif args.command == "remap":
+            mapping = parse_mapping_args(args.pairs)
+            if args.csv:
+                mapping.update(read_mapping_csv(args.csv))
+            if not mapping:
+                print("没有需要执行的映射", file=sys.stderr)
+                return 1
+            counts, updated_ids = engine.remap(mapping)
+            for old, new in mapping.items():
+                if old in counts:
+                    print(f"{old} → {new or '(删除)'}: {counts[old]} 条")
+            print(f"已更新 {len(updated_ids)} 条记录")
+            
+        elif args.command == "stats":
+            stats = engine.stats(top=args.top)
+            print(f"病例: {stats['cases']}  已标注: {stats['annotated_cases']}  "
+                  f"已修改: {stats['modified_cases']}  类别: {stats['diseases']}")
+            for disease, count in stats['top_diseases']:
+                print(f"{count:>10}  {disease}")
+            if stats['top_pairs']:
+                print("共现最多的类别对:")
+                for disease_a, disease_b, count in stats['top_pairs']:
+                    print(f"{count:>10}  {disease_a} + {disease_b}")
+                    
+        elif args.command in ("undo", "redo"):
+            apply = engine.undo if args.command == "undo" else engine.redo
+            result = apply(args.operation)
+            if result is None:
+                print("没有可以" + ("撤销" if args.command == "undo" else "重做") + "的操作", file=sys.stderr)
+                return 1
+            operation_id, restored, conflicts = result
+            print(f"操作 #{operation_id}: 已恢复 {len(restored)} 条记录")
+            if conflicts:
+                print(f"{len(conflicts)} 条记录之后又被修改过，未改动: {', '.join(conflicts[:20])}", file=sys.stderr)
+                
+        elif args.command == "history":
+            for operation_id, kind, description, created_at, undone, cases in engine.history(args.limit):
+                state = "（已撤销）" if undone else ""
+                print(f"#{operation_id:<6} {created_at}  {OPERATION_NAMES.get(kind, kind)}{state}  {cases} 条  {description}")
+                
+        elif args.command == "compact":
+            deleted = engine.compact_journal(args.keep, vacuum=args.vacuum)
+            print(f"已删除 {deleted} 条修改记录")
+            
+        elif args.command == "batches":
+            if args.create:
+                print(f"已划分 {engine.create_batches(args.create)} 个任务")
+            for batch in engine.batches():
+                if batch['finished_at']:
+                    state = f"{batch['annotator']} 已完成 {batch['finished_at']}"
+                elif batch['annotator']:
+                    state = f"{batch['annotator']} 领取于 {batch['claimed_at']}"
+                else:
+                    state = "待领取"
+                print(f"#{batch['id']:<5} {batch['start_id'] or '(开头)'} ~ {batch['end_id'] or '(结尾)'}  "
+                      f"{batch['cases']} 条  {state}")
+                      
+        elif args.command == "claim":
+            batch = engine.claim_batch(args.annotator or default_annotator())
+            if batch is None:
+                print("没有可领取的任务", file=sys.stderr)
+                return 1
+            print(f"任务 #{batch['id']}: {batch['start_id'] or '(开头)'} ~ {batch['end_id'] or '(结尾)'}，{batch['cases']} 条")
+            
+        elif args.command == "finish":
+            engine.finish_batch(args.batch, args.annotator or default_annotator(), release=args.release)
+            print(f"任务 #{args.batch} 已{'退回' if args.release else '完成'}")
+            
+        elif args.command == "query":
+            if args.expr:
+                ids = engine.expression_ids(args.expr, args.search, intersect=not args.union)
+            else:
+                ids = engine.query_ids(args.disease, args.search, intersect=not args.union)
+            if args.count:
+                print(len(ids))
+            else:
+                for case_id in ids[:args.limit] if args.limit else ids:
+                    print(case_id)
+    except (OSError, ValueError, RuntimeError, sqlite3.Error, argparse.ArgumentTypeError) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 1
+    finally:
+        engine.close()
+    return 0
+
+if __name__ == "__main__":
+    # 打包为可执行文件后，解析子进程也从这里启动
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -1,67 +1,492 @@
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
-import pandas as pd
+from tkinter import ttk, filedialog, messagebox, simpledialog
 import sqlite3
 import threading
+import queue
+import csv
+import os
+import multiprocessing
+import argparse
+
+from engine import (
+    PREFETCH_AHEAD, PREFETCH_BEHIND, WORK_BATCH_SIZE, AnnotationEngine, CaseCache,
+    AnnotationWriter, DiseaseIndex, read_mapping_csv, filter_key, describe_source,
+    JOURNAL_KEEP_OPERATIONS, OPERATION_NAMES, default_db_path, default_annotator,
+    FilterExpressionError, ListNavigator, quote_filter_name, CompletionIndex, DISEASE_SEPARATOR, split_diseases,
+    JobScheduler, parse_filter_expression, expression_diseases,
+)
+
+# 状态栏性能统计的刷新间隔（毫秒）
+PERF_STATUS_INTERVAL = 1000
+
+# 状态栏显示滚动分位数的操作
+PERF_STATUS_OPERATIONS = [("navigate", "翻页"), ("save", "保存"), ("filter", "筛选"), ("query", "查询")]
+
+# 修改记录窗口中列出的最近操作数
+HISTORY_LIMIT = 500
+
+# 统计面板中列出的共现类别对数量
+STATS_TOP_PAIRS = 100
+
+# 导入结果提示中最多列出的失败/跳过来源数
+IMPORT_REPORT_LIMIT = 20
+
+# 导入中来源状态的显示文字
+SOURCE_STATUS_TEXT = {'running': "正在导入", 'done': "已完成", 'skipped': "已跳过", 'error': "出错"}
+
+# 描述/诊断超过该字符数时分段显示：先显示开头一段，其余部分在空闲时分批追加
+LARGE_TEXT_THRESHOLD = 20000
+
+# 分段显示时每批追加的字符数，以及两批之间让出给界面事件的间隔（毫秒）
+TEXT_CHUNK_SIZE = 8000
+TEXT_CHUNK_DELAY = 10
+
+# 启动时按会话快照显示病例后，延迟多久（毫秒）在后台加载完整的筛选结果，先让窗口完成首次绘制
+SESSION_LOAD_DELAY = 50
+
+# 主线程取出后台任务回调（结果、进度）执行的间隔，也是关闭窗口时检查后台任务是否已结束的间隔（毫秒）
+JOB_POLL_INTERVAL = 30
+
+# 筛选、统计等读取前等待标注写入的最长时间（秒）；写队列中排着导入等长时间的任务时不等待
+FLUSH_WAIT = 1.0
+
+# 支持的导出格式（按文件扩展名选择）
+EXPORT_FORMATS = [("Excel文件", "*.xlsx"), ("CSV文件", "*.csv"), ("Parquet文件", "*.parquet")]
+
+class ProgressWindow:
+    """带取消按钮的进度窗口；cancel_event 作为后台任务的取消标志，进度经调度器转到主线程后调用 update"""
+    
+    def __init__(self, root, title, message):
+        self.cancel_event = threading.Event()
+        
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        self.window.geometry("320x140")
+        self.window.transient(root)
+        self.window.grab_set()
+        
+        self.label = ttk.Label(self.window, text=message)
+        self.label.pack(pady=(10, 0))
+        self.detail = ttk.Label(self.window, text="")
+        self.detail.pack()
+        self.bar = ttk.Progressbar(self.window, mode='indeterminate')
+        self.bar.pack(pady=5, padx=20, fill=tk.X)
+        self.bar.start()
+        
+        ttk.Button(self.window, text="取消", command=self.cancel).pack(pady=5)
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel)
+        
+    def cancel(self):
+        self.cancel_event.set()
+        self.label.config(text="正在取消...")
+        
+    def set_total(self, total):
+        """总数已知时切换为确定进度"""
+        if total:
+            self.bar.stop()
+            self.bar.config(mode='determinate', maximum=total, value=0)
+        
+    def update(self, processed, total, verb="已处理"):
+        if not self.window.winfo_exists() or self.cancel_event.is_set():
+            return
+        if total and str(self.bar.cget('mode')) != 'determinate':
+            self.set_total(total)
+        elif total and float(self.bar.cget('maximum')) != total:
+            self.bar.config(maximum=total)
+        if total:
+            self.bar.config(value=min(processed, total))
+            self.label.config(text=f"{verb} {processed}/{total} 行")
+        else:
+            self.label.config(text=f"{verb} {processed} 行")
+        
+    def set_detail(self, text):
+        """第二行说明文字（如当前处理的文件）"""
+        if self.window.winfo_exists():
+            self.detail.config(text=text)
+        
+    def destroy(self):
+        self.window.destroy()
+
+class VirtualDiseaseList:
+    """只绘制可见行的疾病列表（Canvas实现），选中状态保存在集合中而不是每行一个变量"""
+    
+    ROW_HEIGHT = 22
+    
+    def __init__(self, parent, multi=True, counts=None, selected=None, on_double_click=None):
+        self.multi = multi
+        self.counts = counts or {}
+        self.selected = set(selected or ())
+        self.on_double_click = on_double_click
+        self.items = []
+        self.top = 0
+        
+        self.frame = ttk.Frame(parent)
+        self.canvas = tk.Canvas(self.frame, background='white', highlightthickness=0)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="vertical", command=self._on_scrollbar)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+        
+        self.canvas.bind("<Configure>", lambda e: self.redraw())
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<Double-Button-1>", self._on_double)
+        # 滚轮只绑定在列表上，不影响其它窗口
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1, 'units'))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll(-1, 'units'))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll(1, 'units'))
+        
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+        
+    def set_items(self, items):
+        """替换当前显示的名称列表（如过滤结果）"""
+        self.items = items
+        self.top = 0
+        self.redraw()
+        
+    def select_all(self):
+        """选中当前显示的全部名称"""
+        self.selected.update(self.items)
+        self.redraw()
+        
+    def clear(self):
+        self.selected.clear()
+        self.redraw()
+        
+    def _visible_rows(self):
+        return max(self.canvas.winfo_height() // self.ROW_HEIGHT, 1)
+        
+    def scroll(self, amount, what):
+        step = self._visible_rows() if what == 'pages' else 1
+        self._scroll_to(self.top + amount * step)
+        
+    def _scroll_to(self, top):
+        max_top = max(len(self.items) - self._visible_rows(), 0)
+        self.top = min(max(int(top), 0), max_top)
+        self.redraw()
+        
+    def _on_scrollbar(self, action, *args):
+        if action == 'moveto':
+            self._scroll_to(float(args[0]) * len(self.items))
+        elif action == 'scroll':
+            self.scroll(int(args[0]), args[1])
+        
+    def _row_at(self, y):
+        index = self.top + int(y) // self.ROW_HEIGHT
+        return index if 0 <= index < len(self.items) else None
+        
+    def _on_click(self, event):
+        index = self._row_at(event.y)
+        if index is None:
+            return
+        name = self.items[index]
+        if not self.multi:
+            self.selected = {name}
+        elif name in self.selected:
+            self.selected.discard(name)
+        else:
+            self.selected.add(name)
+        self.redraw()
+        
+    def _on_double(self, event):
+        if not self.multi and self._row_at(event.y) is not None and self.on_double_click:
+            self.on_double_click()
+        
+    def redraw(self):
+        canvas = self.canvas
+        canvas.delete("all")
+        width = canvas.winfo_width()
+        visible = self._visible_rows()
+        end = min(self.top + visible + 1, len(self.items))
+        
+        for row, name in enumerate(self.items[self.top:end]):
+            y = row * self.ROW_HEIGHT
+            mid = y + self.ROW_HEIGHT // 2
+            checked = name in self.selected
+            if checked:
+                canvas.create_rectangle(0, y, width, y + self.ROW_HEIGHT, fill='#dbe8fb', outline='')
+            # 多选画复选框，单选画圆形单选钮
+            if self.multi:
+                canvas.create_rectangle(8, mid - 6, 20, mid + 6, outline='#555')
+                if checked:
+                    canvas.create_line(10, mid, 13, mid + 4, 19, mid - 4, width=2)
+            else:
+                canvas.create_oval(8, mid - 6, 20, mid + 6, outline='#555')
+                if checked:
+                    canvas.create_oval(11, mid - 3, 17, mid + 3, fill='#333', outline='')
+            canvas.create_text(28, mid, text=name, anchor=tk.W)
+            if name in self.counts:
+                canvas.create_text(width - 8, mid, text=str(self.counts[name]), anchor=tk.E, fill='#777')
+        
+        if self.items:
+            self.scrollbar.set(self.top / len(self.items), min((self.top + visible) / len(self.items), 1.0))
+        else:
+            self.scrollbar.set(0, 1)
+
+class ProgressiveText:
+    """只读文本框的分段填充：长文本先显示开头一段，其余部分通过 after 回调分批追加
+    
+    完整文本保存在 text 中，追加尚未完成时也可以通过 copy() 整体复制；
+    切换病例时未完成的追加会被取消。
+    """
+    
+    def __init__(self, widget, frame, title, threshold=LARGE_TEXT_THRESHOLD, chunk_size=TEXT_CHUNK_SIZE):
+        self.widget = widget
+        self.frame = frame
+        self.title = title
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.loaded = 0
+        self._job = None
+        
+        # 右键菜单：复制全文（不受已显示部分的限制）
+        self.menu = tk.Menu(widget, tearoff=0)
+        self.menu.add_command(label="复制全文", command=self.copy)
+        widget.bind("<Button-3>", lambda e: self.menu.tk_popup(e.x_root, e.y_root))
+        
+    @property
+    def complete(self):
+        return self.loaded >= len(self.text)
+        
+    def set_text(self, text):
+        """替换文本；不超过阈值时一次性插入，否则只插入第一批"""
+        self.cancel()
+        self.text = text or ""
+        self.widget.config(state=tk.NORMAL)
+        self.widget.delete(1.0, tk.END)
+        if len(self.text) <= self.threshold:
+            self.loaded = len(self.text)
+            self.widget.insert(1.0, self.text)
+            self.frame.config(text=self.title)
+            return
+        self.loaded = 0
+        self._append_next()
+        
+    def _append_next(self):
+        self._job = None
+        end = min(self.loaded + self.chunk_size, len(self.text))
+        self.widget.insert(tk.END, self.text[self.loaded:end])
+        self.loaded = end
+        if self.complete:
+            self.frame.config(text=f"{self.title}（共 {len(self.text)} 字）")
+        else:
+            self.frame.config(text=f"{self.title}（已显示 {self.loaded}/{len(self.text)} 字，右键可复制全文）")
+            self._job = self.widget.after(TEXT_CHUNK_DELAY, self._append_next)
+        
+    def cancel(self):
+        """取消尚未完成的追加"""
+        if self._job is not None:
+            self.widget.after_cancel(self._job)
+            self._job = None
+        
+    def copy(self):
+        self.widget.clipboard_clear()
+        self.widget.clipboard_append(self.text)
+
+class AnnotationCompleter:
+    """标注输入框的类别名自动补全：按光标所在 '；' 分段已输入的前缀弹出候选（按病例数排序）
+    
+    ↑/↓ 选择，Tab 或回车填入，Esc 关闭；候选来自 get_index() 返回的 CompletionIndex（尚未建好时不提示）。
+    """
+    
+    # 不触发补全的按键（选择、确认候选和单独的修饰键）
+    IGNORED_KEYS = {'Up', 'Down', 'Return', 'Tab', 'Escape', 'Shift_L', 'Shift_R',
+                    'Control_L', 'Control_R', 'Alt_L', 'Alt_R'}
+    
+    def __init__(self, text, get_index):
+        self.text = text
+        self.get_index = get_index
+        self.popup = None
+        self.listbox = None
+        self.matches = []
+        
+        text.bind("<KeyRelease>", self._on_key_release, add="+")
+        text.bind("<Down>", lambda e: self._move(1))
+        text.bind("<Up>", lambda e: self._move(-1))
+        text.bind("<Tab>", lambda e: self._accept())
+        text.bind("<Return>", lambda e: self._accept())
+        text.bind("<Escape>", lambda e: self.hide())
+        # 延迟关闭，留出点击候选的时间
+        text.bind("<FocusOut>", lambda e: text.after(150, self.hide), add="+")
+        
+    def current_segment(self):
+        """光标所在分段的 (起始位置, 已输入的前缀)"""
+        before = self.text.get("insert linestart", "insert")
+        start = before.rfind(DISEASE_SEPARATOR) + 1
+        prefix = before[start:].lstrip()
+        return f"insert linestart + {len(before) - len(prefix)} chars", prefix
+        
+    def update(self):
+        """按当前前缀刷新候选；没有前缀、没有候选或唯一候选已完整输入时关闭"""
+        index = self.get_index()
+        _, prefix = self.current_segment()
+        matches = index.complete(prefix) if index is not None and prefix else []
+        if not matches or matches == [prefix]:
+            self.hide()
+            return
+        self.show(matches)
+        
+    def show(self, matches):
+        bbox = self.text.bbox("insert")
+        if not bbox:
+            self.hide()
+            return
+        if self.popup is None:
+            self.popup = tk.Toplevel(self.text)
+            self.popup.overrideredirect(True)
+            self.listbox = tk.Listbox(self.popup, exportselection=False, takefocus=0, activestyle='none')
+            self.listbox.pack(fill=tk.BOTH, expand=True)
+            self.listbox.bind("<ButtonRelease-1>", lambda e: self._accept())
+        
+        self.matches = matches
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, *matches)
+        self.listbox.config(height=len(matches))
+        self.listbox.selection_set(0)
+        x, y, _, height = bbox
+        self.popup.geometry(f"+{self.text.winfo_rootx() + x}+{self.text.winfo_rooty() + y + height}")
+        self.popup.deiconify()
+        self.popup.lift()
+        
+    def hide(self):
+        self.matches = []
+        if self.popup is not None:
+            self.popup.withdraw()
+        
+    def _on_key_release(self, event):
+        if event.keysym not in self.IGNORED_KEYS:
+            self.update()
+        
+    def _move(self, step):
+        if not self.matches:
+            return None
+        selection = self.listbox.curselection()
+        current = selection[0] if selection else 0
+        target = (current + step) % len(self.matches)
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(target)
+        self.listbox.see(target)
+        return "break"
+        
+    def _accept(self):
+        """把选中的候选填入当前分段（替换已输入的前缀）"""
+        if not self.matches:
+            return None
+        selection = self.listbox.curselection()
+        name = self.matches[selection[0] if selection else 0]
+        start, _ = self.current_segment()
+        start = self.text.index(start)
+        self.text.delete(start, "insert")
+        self.text.insert(start, name)
+        self.hide()
+        self.text.focus_set()
+        return "break"
 
 class MedicalDataAnnotator:
-    def __init__(self, root):
+    def __init__(self, root, db_path=None, annotator=None):
         self.root = root
-        self.root.title("医疗数据标注工具")
+        self.annotator = annotator or default_annotator()
+        self.root.title(f"医疗数据标注工具 - {self.annotator}")
         self.root.geometry("900x800")
         
-        # 数据库相关
-        self.db_path = "medical_data.db"
+        # 数据库相关（多名标注员可以指向同一个数据库文件）
+        self.db_path = db_path or default_db_path()
+        self.engine = AnnotationEngine(self.db_path)
+        self.db = self.engine.db
+        self.case_cache = CaseCache(self.db)
+        # 所有后台任务都交给调度器：写数据库的任务（包括标注写回）逐个执行，回调由主线程定时取出执行
+        self.closing = False
+        self.callbacks = queue.Queue()
+        self.jobs = JobScheduler(dispatch=self.dispatch, on_change=self.update_job_status)
+        self.pump_callbacks()
+        # 写回时发现的冲突在后台线程中报告，转到主线程处理
+        self.annotation_writer = AnnotationWriter(
+            self.db, self.case_cache, on_conflict=lambda: self.dispatch(self.resolve_conflicts), jobs=self.jobs
+        )
+        # 正在显示的病例及其加载时的标注和版本，保存时写回这个病例（不按位置重新查找）
+        self.current_case_id = None
+        self.loaded_annotation = None
+        self.loaded_version = None
         self.current_index = 0
-        self.filtered_ids = []
+        self.navigator = None
+        self.filter_key = None
+        # 每次切换筛选加一；后台加载完成时据此判断结果是否已过时
+        self.load_generation = 0
+        # 启动时按会话快照显示的病例正在等待完整筛选结果
+        self.session_loading = False
         self.all_diseases = []
+        # 标注输入的自动补全索引，疾病列表变化后在后台重建
+        self.completion_index = None
+        self.completion_generation = 0
+        self.disease_index = None
         self.selected_diseases = []
+        # 组合筛选条件（位图索引），非空时代替类别列表
+        self.filter_expression = ""
+        self.search_text = ""
         self.current_selected_disease = tk.StringVar(value="未选择")
+        # 当前领取的任务（只浏览任务范围内的病例），启动时继续上次未完成的任务
+        self.batch = self.engine.current_batch(self.annotator)
         
-        # 初始化数据库和UI
-        self.init_database()
+        # 初始化UI
         self.init_ui()
         
-        # 加载数据
-        self.load_data()
+        # 加载数据：有上次的会话快照时先显示上次的病例，完整的筛选结果在后台加载
+        if not self.restore_session():
+            self.load_data()
+        # 类别位图索引不在启动时建立：第一次组合筛选时在后台筛选任务中建立
         
-    def init_database(self):
-        """初始化SQLite数据库"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 创建病例数据表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cases (
-                id TEXT PRIMARY KEY,
-                description TEXT,
-                diagnosis TEXT,
-                annotations TEXT
-            )
-        ''')
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
-        # 创建疾病类型表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS diseases (
-                name TEXT PRIMARY KEY
-            )
-        ''')
+    def dispatch(self, func, *args):
+        """从后台线程登记一个要在主线程执行的回调（后台线程不直接调用Tk，主线程等待任务时也不会互相卡住）"""
+        self.callbacks.put((func, args))
         
-        conn.commit()
-        conn.close()
+    def pump_callbacks(self):
+        """在主线程中执行后台线程登记的回调；关闭窗口期间不再处理"""
+        self.root.after(JOB_POLL_INTERVAL, self.pump_callbacks)
+        while True:
+            try:
+                func, args = self.callbacks.get_nowait()
+            except queue.Empty:
+                return
+            if not self.closing:
+                func(*args)
         
     def init_ui(self):
         """初始化主界面"""
+        menubar = tk.Menu(self.root)
+        self.init_batch_menu(menubar)
+        self.init_history_menu(menubar)
+        self.init_perf_menu(menubar)
+        self.root.config(menu=menubar)
+        
         # 顶部按钮区域
         btn_frame = ttk.Frame(self.root)
         btn_frame.pack(pady=10, padx=10, fill=tk.X)
         
         self.load_btn = ttk.Button(btn_frame, text="加载Excel文件", command=self.load_excel)
         self.load_btn.pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="导入文件夹", command=self.import_folder).pack(side=tk.LEFT, padx=5)
         
         ttk.Button(btn_frame, text="选择筛选类别", command=self.select_diseases).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="批量修改类别名", command=self.batch_rename_disease).pack(side=tk.LEFT, padx=5)
-        ttk.Button(btn_frame, text="导出到Excel", command=self.export_excel).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="导出数据", command=self.export_excel).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="类别统计", command=self.show_statistics).pack(side=tk.LEFT, padx=5)
+        
+        # 全文检索区域
+        search_frame = ttk.Frame(self.root)
+        search_frame.pack(padx=10, fill=tk.X)
+        
+        ttk.Label(search_frame, text="检索描述/诊断:").pack(side=tk.LEFT, padx=5)
+        self.search_var = tk.StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        search_entry.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+        search_entry.bind("<Return>", lambda e: self.apply_search())
+        
+        self.search_intersect_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(search_frame, text="与类别筛选取交集", variable=self.search_intersect_var).pack(side=tk.LEFT, padx=5)
+        ttk.Button(search_frame, text="检索", command=self.apply_search).pack(side=tk.LEFT, padx=5)
+        ttk.Button(search_frame, text="清除", command=self.clear_search).pack(side=tk.LEFT, padx=5)
         
         # 主内容区域
         content_frame = ttk.Frame(self.root)
@@ -82,6 +507,7 @@ class MedicalDataAnnotator:
         self.desc_text.bind("<Key>", lambda e: "break")  # 阻止键盘输入
         self.desc_text.bind("<Control-v>", lambda e: "break")  # 阻止粘贴
         self.desc_text.pack(fill=tk.BOTH, padx=5, pady=5, expand=True)
+        self.desc_view = ProgressiveText(self.desc_text, desc_frame, "描述")
         
         # 诊断显示区域 - 只读但可复制
         diag_frame = ttk.LabelFrame(content_frame, text="诊断")
@@ -91,12 +517,14 @@ class MedicalDataAnnotator:
         self.diag_text.bind("<Key>", lambda e: "break")
         self.diag_text.bind("<Control-v>", lambda e: "break")
         self.diag_text.pack(fill=tk.BOTH, padx=5, pady=5, expand=True)
+        self.diag_view = ProgressiveText(self.diag_text, diag_frame, "诊断")
         
         # 标注编辑区域（高度减小）
         anno_frame = ttk.LabelFrame(content_frame, text="标注（可编辑）")
         anno_frame.pack(fill=tk.BOTH, pady=5, expand=True)
         self.anno_text = tk.Text(anno_frame, height=3, wrap=tk.WORD)  # 高度减小到3行
         self.anno_text.pack(fill=tk.BOTH, padx=5, pady=5, expand=True)
+        self.completer = AnnotationCompleter(self.anno_text, lambda: self.completion_index)
         
         # 底部导航按钮区域
         nav_frame = ttk.Frame(content_frame)
@@ -108,10 +536,124 @@ class MedicalDataAnnotator:
         self.next_btn = ttk.Button(nav_frame, text="下一个", command=self.next_case)
         self.next_btn.pack(side=tk.LEFT, padx=10)
         
-        # 状态栏
+        # 跳转：按记录号或按ID
+        self.goto_var = tk.StringVar()
+        goto_entry = ttk.Entry(nav_frame, textvariable=self.goto_var, width=16)
+        goto_entry.pack(side=tk.LEFT, padx=(30, 5))
+        goto_entry.bind("<Return>", lambda e: self.goto_record())
+        ttk.Button(nav_frame, text="转到记录号", command=self.goto_record).pack(side=tk.LEFT, padx=5)
+        ttk.Button(nav_frame, text="转到ID", command=self.goto_id).pack(side=tk.LEFT, padx=5)
+        
+        # 状态栏（右侧为正在进行的后台任务和可选的性能统计）
+        status_frame = ttk.Frame(self.root, relief=tk.SUNKEN)
+        status_frame.pack(side=tk.BOTTOM, fill=tk.X)
         self.status_var = tk.StringVar(value="就绪")
-        status_bar = ttk.Label(self.root, textvariable=self.status_var, relief=tk.SUNKEN, anchor=tk.W)
-        status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        ttk.Label(status_frame, textvariable=self.status_var, anchor=tk.W).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.perf_var = tk.StringVar()
+        ttk.Label(status_frame, textvariable=self.perf_var, anchor=tk.E).pack(side=tk.RIGHT)
+        self.jobs_var = tk.StringVar()
+        ttk.Label(status_frame, textvariable=self.jobs_var, anchor=tk.E).pack(side=tk.RIGHT, padx=(0, 10))
+        
+    def init_batch_menu(self, menubar):
+        """任务菜单：多人标注时每人领取互不重叠的一段病例"""
+        batch_menu = tk.Menu(menubar, tearoff=0)
+        batch_menu.add_command(label="领取任务", command=self.claim_batch)
+        batch_menu.add_command(label="完成当前任务", command=self.finish_batch)
+        batch_menu.add_command(label="放弃当前任务", command=lambda: self.finish_batch(release=True))
+        batch_menu.add_separator()
+        batch_menu.add_command(label="任务列表...", command=self.show_batches)
+        menubar.add_cascade(label="任务", menu=batch_menu)
+        
+    def init_history_menu(self, menubar):
+        """修改记录菜单：撤销/重做、修改记录、增量导出和压缩"""
+        history_menu = tk.Menu(menubar, tearoff=0)
+        history_menu.add_command(label="撤销", command=self.undo_last)
+        history_menu.add_command(label="重做", command=self.redo_last)
+        history_menu.add_command(label="修改记录...", command=self.show_history)
+        history_menu.add_separator()
+        history_menu.add_command(label="导出上次导出后的变更...", command=self.export_changes)
+        history_menu.add_command(label="压缩修改记录", command=self.compact_history)
+        menubar.add_cascade(label="修改记录", menu=history_menu)
+        
+    def init_perf_menu(self, menubar):
+        """性能菜单：耗时日志、状态栏分位数、cProfile剖析"""
+        instrumentation = self.engine.instrumentation
+        self.perf_log_var = tk.BooleanVar(value=instrumentation.log_path is not None)
+        self.perf_status_var = tk.BooleanVar(value=False)
+        self.perf_profile_var = tk.BooleanVar(value=instrumentation.profile_dir is not None)
+        self.perf_log_path = instrumentation.log_path or os.path.splitext(self.db_path)[0] + "_perf.log"
+        self.profile_dir = instrumentation.profile_dir or "profiles"
+        
+        perf_menu = tk.Menu(menubar, tearoff=0)
+        perf_menu.add_checkbutton(label="记录耗时日志", variable=self.perf_log_var, command=self.apply_perf_settings)
+        perf_menu.add_checkbutton(label="状态栏显示 p50/p99", variable=self.perf_status_var, command=self.apply_perf_settings)
+        perf_menu.add_checkbutton(label="剖析每次操作 (cProfile)", variable=self.perf_profile_var, command=self.apply_perf_settings)
+        perf_menu.add_command(label="长文本分段显示阈值...", command=self.set_text_threshold)
+        perf_menu.add_separator()
+        perf_menu.add_command(label="性能汇总...", command=self.show_perf_summary)
+        menubar.add_cascade(label="性能", menu=perf_menu)
+        
+    def apply_perf_settings(self):
+        """按菜单勾选状态开关计时、日志和剖析；全部关闭时埋点不产生开销"""
+        instrumentation = self.engine.instrumentation
+        try:
+            if self.perf_log_var.get():
+                instrumentation.enable(self.perf_log_path)
+            elif self.perf_status_var.get():
+                instrumentation.enable()
+            else:
+                instrumentation.disable()
+            instrumentation.set_profiling(self.profile_dir if self.perf_profile_var.get() else None)
+        except OSError as e:
+            messagebox.showerror("错误", f"无法开启性能记录: {e}")
+            self.perf_log_var.set(False)
+            self.perf_profile_var.set(False)
+            return
+        
+        messages = []
+        if self.perf_log_var.get():
+            messages.append(f"耗时日志: {os.path.abspath(self.perf_log_path)}")
+        if self.perf_profile_var.get():
+            messages.append(f"剖析结果: {os.path.abspath(self.profile_dir)}")
+        if messages:
+            self.status_var.set("；".join(messages))
+        if self.perf_status_var.get():
+            self.refresh_perf_status()
+        else:
+            self.perf_var.set("")
+        
+    def refresh_perf_status(self):
+        """定时在状态栏右侧刷新主要操作的滚动 p50/p99"""
+        if not self.perf_status_var.get():
+            return
+        parts = []
+        for operation, label in PERF_STATUS_OPERATIONS:
+            stats = self.engine.instrumentation.percentiles(operation)
+            if stats:
+                parts.append(f"{label} {stats['p50_ms']:.1f}/{stats['p99_ms']:.1f}ms")
+        self.perf_var.set("  ".join(parts) or "暂无耗时数据")
+        self.root.after(PERF_STATUS_INTERVAL, self.refresh_perf_status)
+        
+    def set_text_threshold(self):
+        """设置描述/诊断分段显示的字符数阈值，对当前病例立即生效"""
+        threshold = simpledialog.askinteger(
+            "长文本分段显示", "描述或诊断超过多少字时分段显示：",
+            initialvalue=self.desc_view.threshold, minvalue=TEXT_CHUNK_SIZE, parent=self.root
+        )
+        if threshold is None:
+            return
+        for view in (self.desc_view, self.diag_view):
+            view.threshold = threshold
+            view.set_text(view.text)
+        
+    def show_perf_summary(self):
+        summary = self.engine.instrumentation.summary()
+        if not summary:
+            messagebox.showinfo("性能汇总", "暂无耗时数据（请先在“性能”菜单中开启记录）")
+            return
+        lines = [f"{operation}: {stats['count']} 次  p50 {stats['p50_ms']:.2f}ms  p99 {stats['p99_ms']:.2f}ms"
+                 for operation, stats in summary.items()]
+        messagebox.showinfo("性能汇总", "\n".join(lines))
         
     def batch_rename_disease(self):
         """批量修改疾病类别名称"""
@@ -122,7 +664,7 @@ class MedicalDataAnnotator:
         # 创建修改窗口
         rename_window = tk.Toplevel(self.root)
         rename_window.title("批量修改类别名")
-        rename_window.geometry("500x200")
+        rename_window.geometry("500x240")
         rename_window.transient(self.root)
         rename_window.grab_set()
         
@@ -179,6 +721,10 @@ class MedicalDataAnnotator:
         
         ttk.Button(right_frame, text="确认修改", command=confirm_rename).pack(pady=10)
         
+        # 批量映射：CSV每行一个 旧名称,新名称
+        ttk.Button(rename_window, text="从CSV导入映射...",
+                   command=lambda: self.import_disease_mapping(rename_window)).pack(pady=(0, 10))
+        
     def select_single_disease_dialog(self):
         """单选疾病对话框 - 返回选中的疾病名称"""
         # 创建选择窗口
@@ -188,389 +734,999 @@ class MedicalDataAnnotator:
         select_window.transient(self.root)
         select_window.grab_set()
         
-        # 主框架
-        main_frame = ttk.Frame(select_window)
-        main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        
-        # 创建Canvas和Scrollbar
-        canvas = tk.Canvas(main_frame)
-        scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=canvas.yview)
-        
-        # 创建可滚动的框架
-        scrollable_frame = ttk.Frame(canvas)
-        
-        # 配置Canvas
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-        
-        # 绑定滚动事件
-        def on_frame_configure(event):
-            canvas.configure(scrollregion=canvas.bbox("all"))
-        
-        scrollable_frame.bind("<Configure>", on_frame_configure)
-        
-        # 鼠标滚轮支持
-        def on_mousewheel(event):
-            canvas.yview_scroll(int(-1*(event.delta/120)), "units")
-        
-        canvas.bind_all("<MouseWheel>", on_mousewheel)
-        
-        # 布局
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
-        
-        # 单选变量
-        selected_var = tk.StringVar()
+        def confirm_selection():
+            if not picker.selected:
+                messagebox.showwarning("警告", "请选择一个疾病类别")
+                return
+            result.append(next(iter(picker.selected)))
+            select_window.destroy()
         
-        # 创建单选按钮列表
-        for i, disease in enumerate(self.all_diseases):
-            rb = ttk.Radiobutton(scrollable_frame, text=disease, value=disease, variable=selected_var)
-            rb.grid(row=i, column=0, sticky=tk.W, padx=5, pady=2)
+        result = []
+        picker = self.create_disease_picker(select_window, multi=False, on_double_click=confirm_selection)
         
         # 按钮区域
         btn_frame = ttk.Frame(select_window)
         btn_frame.pack(pady=10)
         
-        def confirm_selection():
-            if not selected_var.get():
-                messagebox.showwarning("警告", "请选择一个疾病类别")
-                return
-            select_window.destroy()
-        
         ttk.Button(btn_frame, text="确定", command=confirm_selection).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="取消", command=select_window.destroy).pack(side=tk.LEFT, padx=5)
         
         # 等待窗口关闭
         self.root.wait_window(select_window)
         
-        return selected_var.get() if selected_var.get() else None
+        return result[0] if result else None
+        
+    def get_disease_index(self):
+        """当前疾病列表的检索索引（疾病列表变化后重建）"""
+        if self.disease_index is None or self.disease_index.names != sorted(self.all_diseases):
+            self.disease_index = DiseaseIndex(self.all_diseases)
+        return self.disease_index
+        
+    def show_statistics(self):
+        """类别统计面板：各类别病例数（已修改/未修改）和共现最多的类别对，双击类别按其筛选"""
+        self.flush_annotations()
+        totals = self.engine.totals()
+        statistics = self.engine.disease_statistics()
+        pairs = self.engine.top_pairs(STATS_TOP_PAIRS)
+        
+        stats_window = tk.Toplevel(self.root)
+        stats_window.title("类别统计")
+        stats_window.geometry("560x640")
+        stats_window.transient(self.root)
+        
+        summary = (f"病例 {totals['cases']}，有类别 {totals['labelled']}，"
+                   f"已修改 {totals['modified']}，未修改 {totals['cases'] - totals['modified']}；"
+                   f"类别 {len(statistics)} 种")
+        ttk.Label(stats_window, text=summary).pack(padx=10, pady=(10, 5), anchor=tk.W)
+        
+        disease_frame = ttk.LabelFrame(stats_window, text="各类别病例数（点击表头排序，双击按该类别筛选）")
+        disease_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        columns = ("disease", "cases", "modified", "unchanged")
+        disease_tree = ttk.Treeview(disease_frame, columns=columns, show="headings")
+        for column, heading, width in zip(columns, ("类别", "病例数", "已修改", "未修改"), (240, 80, 80, 80)):
+            disease_tree.heading(column, text=heading, command=lambda c=column: sort_by(c))
+            disease_tree.column(column, width=width, anchor=tk.W if column == "disease" else tk.E)
+        scrollbar = ttk.Scrollbar(disease_frame, orient=tk.VERTICAL, command=disease_tree.yview)
+        disease_tree.configure(yscrollcommand=scrollbar.set)
+        disease_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        rows = [(disease, cases, modified, cases - modified) for disease, cases, modified in statistics]
+        sort_state = {'column': "cases", 'reverse': True}
+        
+        def fill():
+            disease_tree.delete(*disease_tree.get_children())
+            for row in rows:
+                disease_tree.insert("", tk.END, values=row)
+        
+        def sort_by(column):
+            index = columns.index(column)
+            reverse = not sort_state['reverse'] if sort_state['column'] == column else column != "disease"
+            sort_state.update(column=column, reverse=reverse)
+            rows.sort(key=lambda row: row[index], reverse=reverse)
+            fill()
+        
+        def filter_by_selected(event):
+            item = disease_tree.identify_row(event.y)
+            if not item:
+                return
+            self.selected_diseases = [disease_tree.item(item, "values")[0]]
+            self.filter_expression = ""
+            stats_window.destroy()
+            self.load_data()
+        
+        disease_tree.bind("<Double-1>", filter_by_selected)
+        fill()
+        
+        pair_frame = ttk.LabelFrame(stats_window, text=f"共现最多的类别对（前{STATS_TOP_PAIRS}）")
+        pair_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(5, 10))
+        pair_tree = ttk.Treeview(pair_frame, columns=("a", "b", "cases"), show="headings", height=8)
+        for column, heading, width in (("a", "类别A", 200), ("b", "类别B", 200), ("cases", "病例数", 80)):
+            pair_tree.heading(column, text=heading)
+            pair_tree.column(column, width=width, anchor=tk.E if column == "cases" else tk.W)
+        pair_scrollbar = ttk.Scrollbar(pair_frame, orient=tk.VERTICAL, command=pair_tree.yview)
+        pair_tree.configure(yscrollcommand=pair_scrollbar.set)
+        pair_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        pair_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        for pair in pairs:
+            pair_tree.insert("", tk.END, values=pair)
+        
+    def get_disease_counts(self):
+        """每个疾病类别的病例数（来自增量维护的统计表）"""
+        self.flush_annotations()
+        return self.engine.disease_counts()
+        
+    def create_disease_picker(self, window, multi, selected=(), on_double_click=None):
+        """在窗口中创建带搜索框的虚拟化疾病列表"""
+        index = self.get_disease_index()
+        
+        search_var = tk.StringVar()
+        search_entry = ttk.Entry(window, textvariable=search_var)
+        search_entry.pack(fill=tk.X, padx=10, pady=(10, 0))
+        search_entry.focus_set()
+        
+        picker = VirtualDiseaseList(window, multi=multi, counts=self.get_disease_counts(),
+                                    selected=selected, on_double_click=on_double_click)
+        picker.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        picker.set_items(index.names)
+        
+        search_var.trace_add("write", lambda *args: picker.set_items(index.search(search_var.get())))
+        return picker
         
     def rename_disease(self, old_name, new_name):
         """在数据库中批量重命名疾病（去重逻辑）"""
-        def do_rename():
-            try:
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                
-                # 获取所有包含该疾病的病例
-                cursor.execute("SELECT id, annotations FROM cases WHERE annotations LIKE ?", (f"%{old_name}%",))
-                cases = cursor.fetchall()
-                
-                updated_count = 0
-                
-                for case_id, annotations in cases:
-                    # 分割疾病列表
-                    diseases = [d.strip() for d in annotations.split('；') if d.strip()]
-                    
-                    # 处理替换逻辑
-                    new_diseases = []
-                    old_found = False
-                    
-                    for d in diseases:
-                        if d == old_name:
-                            old_found = True
-                            # 如果新名称不为空且不在列表中，则添加
-                            if new_name and new_name not in new_diseases:
-                                new_diseases.append(new_name)
-                        else:
-                            if d not in new_diseases:  # 避免重复
-                                new_diseases.append(d)
-                    
-                    # 如果有变化，更新数据库
-                    if old_found:
-                        new_annotations = '；'.join(new_diseases)
-                        cursor.execute("UPDATE cases SET annotations = ? WHERE id = ?", (new_annotations, case_id))
-                        updated_count += 1
-                
-                # 如果新名称是全新的，更新疾病类型表
-                if new_name and new_name not in self.all_diseases:
-                    cursor.execute("INSERT OR REPLACE INTO diseases (name) VALUES (?)", (new_name,))
-                
-                # 删除旧名称（如果没有病例再使用它）
-                cursor.execute("DELETE FROM diseases WHERE name = ? AND NOT EXISTS (SELECT 1 FROM cases WHERE annotations LIKE ?)", 
-                             (old_name, f"%{old_name}%"))
-                
-                conn.commit()
-                conn.close()
-                
-                # 更新内存中的all_diseases列表
-                self.load_data()
-                
-                # 清空选择
-                self.current_selected_disease.set("未选择")
-                
-                self.root.after(0, lambda: messagebox.showinfo("成功", f"已更新 {updated_count} 条记录"))
-                
-            except Exception as e:
-                self.root.after(0, lambda: messagebox.showerror("错误", f"修改失败: {str(e)}"))
-        
-        # 在后台线程执行
-        thread = threading.Thread(target=do_rename)
-        thread.daemon = True
-        thread.start()
+        self.remap_diseases({old_name: new_name})
         
-    def load_excel(self):
-        """加载Excel文件"""
+    def remap_diseases(self, mapping):
+        """在后台一次性执行多个类别映射（一个事务），完成后在主线程刷新界面"""
+        # 先落盘未写入的标注，避免重命名后被旧值覆盖
+        self.flush_annotations()
+        
+        # 回调由调度器转到主线程执行（Tk控件只能在主线程中操作）
+        def on_done(counts, updated_ids):
+            self.current_selected_disease.set("未选择")
+            self.load_data()
+            
+            lines = [f"{old} → {new or '(删除)'}: {counts[old]} 条" for old, new in mapping.items() if old in counts]
+            if len(lines) > 20:
+                lines = lines[:20] + [f"... 共 {len(counts)} 个映射"]
+            messagebox.showinfo("成功", f"已更新 {len(updated_ids)} 条记录\n\n" + "\n".join(lines))
+        
+        def do_remap(job):
+            counts, updated_ids = self.engine.remap(mapping)
+            self.case_cache.invalidate(updated_ids)
+            return counts, updated_ids
+        
+        # 在写队列中执行，不会与导入、撤销等写操作同时进行
+        self.jobs.submit("修改类别", do_remap, write=True,
+                         on_done=lambda result: on_done(*result),
+                         on_error=lambda e: messagebox.showerror("错误", f"修改失败: {e}"))
+        
+    def import_disease_mapping(self, parent_window):
+        """从CSV读取类别映射并批量执行"""
         file_path = filedialog.askopenfilename(
-            title="选择Excel文件",
-            filetypes=[("Excel文件", "*.xlsx *.xls")]
+            title="选择映射CSV（旧名称, 新名称）",
+            filetypes=[("CSV文件", "*.csv")],
+            parent=parent_window
         )
-        
         if not file_path:
             return
         
+        try:
+            mapping = read_mapping_csv(file_path)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            messagebox.showerror("错误", f"读取映射失败: {e}", parent=parent_window)
+            return
+        if not mapping:
+            messagebox.showwarning("警告", "映射文件中没有有效的记录", parent=parent_window)
+            return
+        
+        deletions = sum(1 for new in mapping.values() if not new)
+        message = f"共 {len(mapping)} 个映射（其中删除 {deletions} 个），确定要执行吗？"
+        if messagebox.askyesno("确认修改", message, parent=parent_window):
+            self.remap_diseases(mapping)
+            parent_window.destroy()
+        
+    def load_excel(self):
+        """加载Excel/CSV文件（可多选，Excel文件中的每个工作表都会导入）"""
+        file_paths = filedialog.askopenfilenames(
+            title="选择Excel文件",
+            filetypes=[("Excel/CSV文件", "*.xlsx *.xls *.csv"), ("Excel文件", "*.xlsx *.xls"), ("CSV文件", "*.csv")]
+        )
+        
+        if file_paths:
+            self.import_paths(list(file_paths))
+        
+    def import_folder(self):
+        """导入文件夹（含子文件夹）中的全部Excel/CSV文件"""
+        folder = filedialog.askdirectory(title="选择要导入的文件夹")
+        if folder:
+            self.import_paths([folder])
+        
+    def import_paths(self, paths):
+        """在后台并行解析并导入文件/文件夹；单个文件或工作表出错时跳过，结束后汇总提示"""
+        # 导入前落盘未写入的标注，避免导入后被写回队列覆盖
+        self.flush_annotations()
+        
+        # 已有数据时询问导入方式
+        merge = False
+        if self.engine.has_cases():
+            merge = messagebox.askyesnocancel(
+                "导入方式",
+                "数据库中已有病例。\n\n"
+                "是：合并导入（新增病例、更新内容有变化的病例，保留已有标注）\n"
+                "否：全量替换（清空现有数据和标注）"
+            )
+            if merge is None:
+                return
+        
         # 创建进度条窗口
-        progress_window = tk.Toplevel(self.root)
-        progress_window.title("解析中...")
-        progress_window.geometry("300x100")
-        progress_window.transient(self.root)
-        progress_window.grab_set()
-        
-        ttk.Label(progress_window, text="正在解析Excel文件...").pack(pady=10)
-        progress_bar = ttk.Progressbar(progress_window, mode='indeterminate')
-        progress_bar.pack(pady=10, padx=20, fill=tk.X)
-        progress_bar.start()
-        
-        # 在后台线程中解析Excel
-        def parse_excel():
-            try:
-                df = pd.read_excel(file_path)
-                required_columns = ['id', '描述', '诊断', '标注']
-                missing_columns = [col for col in required_columns if col not in df.columns]
-                if missing_columns:
-                    raise ValueError(f"缺少必需的列: {', '.join(missing_columns)}")
-                
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM cases")
-                cursor.execute("DELETE FROM diseases")
-                conn.commit()
-                
-                all_diseases_set = set()
-                
-                for index, row in df.iterrows():
-                    cursor.execute(
-                        "INSERT INTO cases (id, description, diagnosis, annotations) VALUES (?, ?, ?, ?)",
-                        (str(row['id']), str(row['描述']), str(row['诊断']), str(row['标注']))
-                    )
-                    
-                    diseases = str(row['标注']).split('；')
-                    for disease in diseases:
-                        disease = disease.strip()
-                        if disease:
-                            all_diseases_set.add(disease)
-                
-                for disease in sorted(all_diseases_set):
-                    cursor.execute("INSERT INTO diseases (name) VALUES (?)", (disease,))
-                
-                conn.commit()
-                conn.close()
-                
-                self.root.after(0, self.load_data)
-                self.root.after(0, progress_window.destroy)
-                self.root.after(0, lambda: messagebox.showinfo("成功", f"已加载 {len(df)} 条记录和 {len(all_diseases_set)} 种疾病"))
-                
-            except Exception as e:
-                self.root.after(0, lambda: messagebox.showerror("错误", f"加载失败: {str(e)}"))
-                self.root.after(0, progress_window.destroy)
-        
-        thread = threading.Thread(target=parse_excel)
-        thread.daemon = True
-        thread.start()
+        progress = ProgressWindow(self.root, "解析中...", "正在解析Excel文件...")
+        
+        def on_source(index, result):
+            text = f"{SOURCE_STATUS_TEXT.get(result['status'], result['status'])}: {describe_source(result)}"
+            self.dispatch(progress.set_detail, text)
+        
+        # 在写队列中并行解析、单线程批量写入（整个导入在一个事务中，取消或出错时回滚）
+        def parse_excel(job):
+            result = self.engine.import_sources(paths, merge, progress=job.report,
+                                                cancel_event=job.cancel_event, on_source=on_source)
+            self.case_cache.invalidate()
+            return result
+        
+        def on_done(result):
+            stats, results = result
+            if merge:
+                message = (f"新增 {stats['inserted']} 条，更新 {stats['updated']} 条，"
+                           f"未变化 {stats['unchanged']} 条；新增疾病 {stats['new_diseases']} 种")
+            else:
+                message = f"已加载 {stats['inserted']} 条记录和 {stats['new_diseases']} 种疾病"
+            
+            failed = [result for result in results if result['status'] != 'done']
+            if len(results) > 1:
+                message = f"成功导入 {len(results) - len(failed)}/{len(results)} 个工作表\n" + message
+            if failed:
+                lines = [f"{describe_source(result)}: {result['error']}" for result in failed[:IMPORT_REPORT_LIMIT]]
+                if len(failed) > IMPORT_REPORT_LIMIT:
+                    lines.append(f"……另有 {len(failed) - IMPORT_REPORT_LIMIT} 个")
+                message += "\n\n以下来源未导入：\n" + "\n".join(lines)
+            
+            progress.destroy()
+            self.load_data()
+            if failed:
+                messagebox.showwarning("部分导入", message)
+            else:
+                messagebox.showinfo("成功", message)
+        
+        def on_cancel():
+            progress.destroy()
+            messagebox.showinfo("已取消", "导入已取消，数据库未做任何修改")
+        
+        def on_error(e):
+            progress.destroy()
+            messagebox.showerror("错误", f"加载失败: {e}")
+        
+        self.jobs.submit("导入", parse_excel, write=True, cancel_event=progress.cancel_event,
+                         on_done=on_done, on_error=on_error, on_cancel=on_cancel,
+                         on_progress=lambda done, total: progress.update(done, total, "已导入"))
         
     def export_excel(self):
-        """导出所有数据到Excel文件"""
+        """导出数据到Excel/CSV/Parquet文件"""
+        if self.results_pending():
+            return
         file_path = filedialog.asksaveasfilename(
-            title="导出Excel文件",
+            title="导出数据",
             defaultextension=".xlsx",
-            filetypes=[("Excel文件", "*.xlsx"), ("所有文件", "*.*")]
+            filetypes=EXPORT_FORMATS
         )
         
         if not file_path:
             return
         
-        progress_window = tk.Toplevel(self.root)
-        progress_window.title("导出中...")
-        progress_window.geometry("300x100")
-        progress_window.transient(self.root)
-        progress_window.grab_set()
+        # 有筛选条件时询问导出范围
+        case_ids = None
+        if self.filter_active():
+            choice = messagebox.askyesnocancel(
+                "导出范围",
+                f"是否只导出当前筛选结果（{len(self.navigator)} 条）？\n选择\"否\"将导出全部病例。"
+            )
+            if choice is None:
+                return
+            if choice:
+                # 导出线程按id顺序分批遍历筛选结果，不需要把id全部读入内存
+                case_ids = self.navigator
+        
+        self.flush_annotations()
+        progress = ProgressWindow(self.root, "导出中...", "正在导出数据...")
+        
+        def do_export(job):
+            return self.engine.export_file(file_path, case_ids, progress=job.report, cancel_event=job.cancel_event)
+        
+        # 导出全部病例时会记下增量导出的起点（一次写入），与其它写任务一样进入写队列；只导出筛选结果时并发执行
+        self.submit_export(do_export, case_ids is None, progress,
+                           lambda exported: f"已导出 {exported} 条记录到\n{file_path}")
+        
+    def submit_export(self, export, write, progress, message):
+        """提交导出任务并在进度窗口中显示进度，完成后按 message(导出行数) 提示"""
+        def on_done(exported):
+            progress.destroy()
+            messagebox.showinfo("导出成功", message(exported))
+        
+        def on_cancel():
+            progress.destroy()
+            messagebox.showinfo("已取消", "导出已取消")
+        
+        def on_error(e):
+            progress.destroy()
+            messagebox.showerror("导出失败", f"错误: {e}")
+        
+        self.jobs.submit("导出", export, write=write, cancel_event=progress.cancel_event,
+                         on_done=on_done, on_error=on_error, on_cancel=on_cancel,
+                         on_progress=lambda done, total: progress.update(done, total, "已导出"))
+        
+    def undo_last(self):
+        """撤销最近一次修改"""
+        self.apply_history("undo")
+        
+    def redo_last(self):
+        """重做最近一次撤销的修改"""
+        self.apply_history("redo")
+        
+    def apply_history(self, action, operation_id=None, parent=None, on_done=None):
+        """在后台撤销/重做一个操作（operation_id 为 None 时为最近一次），完成后刷新界面并提示冲突"""
+        # 先落盘未写入的标注，撤销/重做才能看到最新的修改
+        self.flush_annotations()
+        verb = "撤销" if action == "undo" else "重做"
+        apply = self.engine.undo if action == "undo" else self.engine.redo
+        
+        def finish(result):
+            if result is None:
+                messagebox.showinfo(verb, f"没有可以{verb}的修改", parent=parent)
+                return
+            operation_id, restored, conflicts = result
+            self.load_data()
+            message = f"已{verb}操作 #{operation_id}，恢复 {len(restored)} 条记录"
+            if conflicts:
+                shown = "、".join(conflicts[:IMPORT_REPORT_LIMIT])
+                more = f" 等 {len(conflicts)} 条" if len(conflicts) > IMPORT_REPORT_LIMIT else ""
+                messagebox.showwarning(verb, f"{message}\n\n以下记录之后又被修改过，未改动：\n{shown}{more}", parent=parent)
+            else:
+                self.status_var.set(message)
+            if on_done:
+                on_done()
+        
+        def do_apply(job):
+            result = apply(operation_id)
+            if result is not None:
+                self.case_cache.invalidate(result[1])
+            return result
+        
+        self.jobs.submit(verb, do_apply, write=True, on_done=finish,
+                         on_error=lambda e: messagebox.showerror("错误", f"{verb}失败: {e}", parent=parent))
+        
+    def show_history(self):
+        """修改记录窗口：列出最近的操作，可撤销/重做所选的单个修改或整次批量改名"""
+        self.flush_annotations()
+        
+        history_window = tk.Toplevel(self.root)
+        history_window.title("修改记录")
+        history_window.geometry("720x480")
+        history_window.transient(self.root)
+        
+        tree_frame = ttk.Frame(history_window)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        columns = ("id", "time", "kind", "cases", "description")
+        tree = ttk.Treeview(tree_frame, columns=columns, show="headings", selectmode="browse")
+        for column, heading, width in zip(columns, ("编号", "时间", "操作", "病例数", "内容"), (60, 140, 110, 60, 330)):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, anchor=tk.E if column in ("id", "cases") else tk.W)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        def fill():
+            tree.delete(*tree.get_children())
+            for operation_id, kind, description, created_at, undone, cases in self.engine.history(HISTORY_LIMIT):
+                name = OPERATION_NAMES.get(kind, kind) + ("（已撤销）" if undone else "")
+                tree.insert("", tk.END, iid=str(operation_id), values=(operation_id, created_at, name, cases, description))
+        
+        def apply_selected(action):
+            selection = tree.selection()
+            if not selection:
+                messagebox.showwarning("警告", "请先选择一个操作", parent=history_window)
+                return
+            self.apply_history(action, int(selection[0]), parent=history_window,
+                               on_done=lambda: history_window.winfo_exists() and fill())
+        
+        btn_frame = ttk.Frame(history_window)
+        btn_frame.pack(pady=(5, 10))
+        ttk.Button(btn_frame, text="撤销所选", command=lambda: apply_selected("undo")).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="重做所选", command=lambda: apply_selected("redo")).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="刷新", command=fill).pack(side=tk.LEFT, padx=5)
+        fill()
+        
+    def export_changes(self):
+        """增量导出：只导出上次导出以来变化过的病例"""
+        self.flush_annotations()
+        pending = self.engine.pending_changes()
+        if pending == 0:
+            messagebox.showinfo("导出变更", "上次导出以来没有变化的病例")
+            return
+        if pending is None and not messagebox.askyesno("导出变更", "还没有导出过数据，将导出全部病例。继续吗？"):
+            return
         
-        ttk.Label(progress_window, text="正在导出数据到Excel...").pack(pady=10)
-        progress_bar = ttk.Progressbar(progress_window, mode='indeterminate')
-        progress_bar.pack(pady=10, padx=20, fill=tk.X)
-        progress_bar.start()
+        file_path = filedialog.asksaveasfilename(
+            title="导出变更",
+            defaultextension=".xlsx",
+            filetypes=EXPORT_FORMATS
+        )
+        if not file_path:
+            return
         
-        def do_export():
-            try:
-                conn = sqlite3.connect(self.db_path)
-                df = pd.read_sql_query("SELECT id, description, diagnosis, annotations FROM cases ORDER BY id", conn)
-                conn.close()
-                
-                df.columns = ['id', '描述', '诊断', '标注']
-                df.to_excel(file_path, index=False, engine='openpyxl')
-                
-                self.root.after(0, progress_window.destroy)
-                self.root.after(0, lambda: messagebox.showinfo("导出成功", f"已导出 {len(df)} 条记录到\n{file_path}"))
-                
-            except Exception as e:
-                self.root.after(0, lambda: messagebox.showerror("导出失败", f"错误: {str(e)}"))
-                self.root.after(0, progress_window.destroy)
-        
-        thread = threading.Thread(target=do_export)
-        thread.daemon = True
-        thread.start()
+        progress = ProgressWindow(self.root, "导出中...", "正在导出变化的病例...")
+        
+        def do_export(job):
+            return self.engine.export_changes(file_path, progress=job.report, cancel_event=job.cancel_event)
+        
+        self.submit_export(do_export, True, progress,
+                           lambda exported: f"已导出 {exported} 条变化的记录到\n{file_path}")
+        
+    def compact_history(self):
+        """压缩修改记录并整理数据库文件"""
+        if not messagebox.askyesno("压缩修改记录",
+                                   f"只保留最近 {JOURNAL_KEEP_OPERATIONS} 个操作的撤销记录，并整理数据库文件。继续吗？"):
+            return
+        self.flush_annotations()
+        
+        self.jobs.submit("压缩修改记录", lambda job: self.engine.compact_journal(vacuum=True), write=True,
+                         on_done=lambda deleted: self.status_var.set(f"已压缩修改记录，删除 {deleted} 条"),
+                         on_error=lambda e: messagebox.showerror("错误", f"压缩失败: {e}"))
+        
+    def resolve_conflicts(self):
+        """处理写回时发现的冲突（病例已被其他标注员修改）：由用户选择保留自己的还是对方的标注"""
+        conflicts = self.annotation_writer.take_conflicts()
+        if not conflicts:
+            return
+        
+        lines = [f"{c['case_id']}\n    对方: {c['theirs'] or '(空)'}\n    我的: {c['mine'] or '(空)'}"
+                 for c in conflicts[:IMPORT_REPORT_LIMIT]]
+        if len(conflicts) > IMPORT_REPORT_LIMIT:
+            lines.append(f"……共 {len(conflicts)} 条")
+        keep_mine = messagebox.askyesno(
+            "标注冲突",
+            f"以下 {len(conflicts)} 条记录在你修改期间已被其他标注员修改：\n\n" + "\n".join(lines) +
+            "\n\n是：用我的标注覆盖\n否：保留对方的修改"
+        )
+        if keep_mine:
+            for conflict in conflicts:
+                self.annotation_writer.overwrite(conflict)
+        
+        # 正在显示的病例如有冲突且没有继续编辑，刷新为最新内容
+        conflicted = {conflict['case_id'] for conflict in conflicts}
+        self.case_cache.invalidate(conflicted)
+        if self.current_case_id in conflicted and not self.anno_text.edit_modified():
+            self.display_current_case()
+        
+    def batch_range(self):
+        """当前任务的id区间，没有领取任务时为 None（浏览全部病例）"""
+        return (self.batch['start_id'], self.batch['end_id']) if self.batch else None
+        
+    def claim_batch(self):
+        """领取一个标注任务（已有未完成的任务时继续该任务），之后只浏览任务范围内的病例"""
+        self.flush_annotations()
+        
+        def on_done(batch):
+            if batch is None:
+                messagebox.showinfo("领取任务", "没有可领取的任务（请先在“任务列表”中划分任务）")
+                return
+            self.batch = batch
+            self.load_data()
+        
+        self.jobs.submit("领取任务", lambda job: self.engine.claim_batch(self.annotator), write=True,
+                         on_done=on_done, on_error=lambda e: messagebox.showerror("错误", f"领取任务失败: {e}"))
+        
+    def finish_batch(self, release=False):
+        """完成（或放弃）当前任务，回到浏览全部病例"""
+        if self.batch is None:
+            messagebox.showinfo("任务", "当前没有领取任务")
+            return
+        verb = "放弃" if release else "完成"
+        if not messagebox.askyesno(f"{verb}任务", f"确定{verb}任务 #{self.batch['id']} 吗？"):
+            return
+        self.flush_annotations()
+        batch_id = self.batch['id']
+        
+        def on_done(result):
+            if self.batch is not None and self.batch['id'] == batch_id:
+                self.batch = None
+                self.load_data()
+        
+        self.jobs.submit(f"{verb}任务", lambda job: self.engine.finish_batch(batch_id, self.annotator, release=release),
+                         write=True, on_done=on_done,
+                         on_error=lambda e: messagebox.showerror("错误", f"{verb}任务失败: {e}"))
+        
+    def show_batches(self):
+        """任务列表：各任务的范围和领取状态，可按病例数重新划分"""
+        batch_window = tk.Toplevel(self.root)
+        batch_window.title("任务列表")
+        batch_window.geometry("640x420")
+        batch_window.transient(self.root)
+        
+        tree_frame = ttk.Frame(batch_window)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        columns = ("id", "range", "cases", "state")
+        tree = ttk.Treeview(tree_frame, columns=columns, show="headings")
+        for column, heading, width in zip(columns, ("编号", "id范围", "病例数", "状态"), (60, 220, 70, 260)):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, anchor=tk.E if column in ("id", "cases") else tk.W)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        def fill():
+            tree.delete(*tree.get_children())
+            for batch in self.engine.batches():
+                if batch['finished_at']:
+                    state = f"{batch['annotator']} 已完成"
+                elif batch['annotator']:
+                    state = f"{batch['annotator']} 进行中（{batch['claimed_at']}）"
+                else:
+                    state = "待领取"
+                span = f"{batch['start_id'] or '(开头)'} ~ {batch['end_id'] or '(结尾)'}"
+                tree.insert("", tk.END, values=(batch['id'], span, batch['cases'], state))
+        
+        def create():
+            size = simpledialog.askinteger("划分任务", "每个任务的病例数：", parent=batch_window,
+                                           initialvalue=WORK_BATCH_SIZE, minvalue=1)
+            if not size:
+                return
+            
+            def on_done(count):
+                if batch_window.winfo_exists():
+                    messagebox.showinfo("划分任务", f"已划分为 {count} 个任务", parent=batch_window)
+                    fill()
+            
+            self.jobs.submit("划分任务", lambda job: self.engine.create_batches(size), write=True, on_done=on_done,
+                             on_error=lambda e: messagebox.showerror("错误", f"划分失败: {e}"))
+        
+        btn_frame = ttk.Frame(batch_window)
+        btn_frame.pack(pady=(5, 10))
+        ttk.Button(btn_frame, text="划分任务...", command=create).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="刷新", command=fill).pack(side=tk.LEFT, padx=5)
+        fill()
         
     def load_data(self):
-        """从数据库加载数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """从数据库加载数据，并回到该筛选条件下上次浏览的位置"""
+        self.remember_position()
+        self.load_generation += 1
+        self.session_loading = False
+        self.set_disease_names(self.engine.disease_names())
+        
+        intersect = self.search_intersect_var.get()
+        try:
+            navigator, key = self.open_navigator(intersect)
+        except FilterExpressionError as e:
+            # 例如条件中的类别已被改名或删除
+            messagebox.showwarning("组合筛选", f"组合筛选条件已失效，改为不按类别筛选：{e}")
+            self.filter_expression = ""
+            navigator, key = self.open_navigator(intersect)
+        self.show_navigator(navigator, key)
+        
+    def apply_filter(self):
+        """在后台按当前筛选条件查询，完成后切换到新的结果；查询期间仍可浏览、标注原来的结果"""
+        self.load_generation += 1
+        generation = self.load_generation
+        intersect = self.search_intersect_var.get()
+        self.status_var.set("正在筛选…")
+        
+        def on_done(result):
+            navigator, key = result
+            if generation != self.load_generation:
+                # 期间又切换了筛选条件
+                navigator.close()
+                return
+            self.save_current_annotation()
+            self.remember_position()
+            self.session_loading = False
+            self.show_navigator(navigator, key)
+        
+        def on_error(e):
+            # 条件在查询前已失效等：按常规方式加载（并提示）
+            if generation == self.load_generation:
+                self.load_data()
         
-        cursor.execute("SELECT name FROM diseases ORDER BY name")
-        self.all_diseases = [row[0] for row in cursor.fetchall()]
+        self.jobs.submit("筛选", lambda job: self.open_navigator(intersect), on_done=on_done, on_error=on_error)
         
-        if not self.selected_diseases:
-            cursor.execute("SELECT id FROM cases ORDER BY id")
+    def set_disease_names(self, names):
+        """更新疾病列表；与之前不同时在后台重建标注补全索引"""
+        if names == self.all_diseases and self.completion_generation:
+            return
+        self.all_diseases = names
+        self.completion_generation += 1
+        generation = self.completion_generation
+        
+        def on_done(index):
+            # 期间疾病列表又变了：以更新的一次为准
+            if generation == self.completion_generation:
+                self.completion_index = index
+        
+        self.jobs.submit("建立补全索引", lambda job: CompletionIndex(self.engine.disease_counts()), on_done=on_done)
+        
+    def open_navigator(self, intersect):
+        """按当前筛选条件创建导航器，返回 (导航器, 筛选键)；不操作控件，可在后台线程中调用"""
+        id_range = self.batch_range()
+        if self.filter_expression:
+            navigator = self.engine.expression_navigator(self.filter_expression, self.search_text, intersect, id_range)
         else:
-            conditions = " OR ".join(["annotations LIKE ?" for _ in self.selected_diseases])
-            params = [f"%{disease}%" for disease in self.selected_diseases]
-            cursor.execute(f"SELECT id FROM cases WHERE {conditions} ORDER BY id", params)
-        
-        self.filtered_ids = [row[0] for row in cursor.fetchall()]
-        self.current_index = 0 if self.filtered_ids else -1
+            navigator = self.engine.navigator(self.selected_diseases, self.search_text, intersect, id_range)
+        key = filter_key(self.selected_diseases, self.search_text, intersect, id_range, self.filter_expression)
+        return navigator, key
+        
+    def show_navigator(self, navigator, key, case_id=None):
+        """切换到新的筛选结果，定位到 case_id（默认为该筛选条件下上次浏览的病例）"""
+        if self.navigator is not None:
+            self.navigator.close()
+        self.navigator, self.filter_key = navigator, key
+        
+        self.current_index = -1
+        if len(self.navigator):
+            if case_id is None:
+                case_id = self.engine.saved_position(self.filter_key)
+            # 上次的病例已不在结果中时，停在它原本所在的位置
+            position = self.navigator.insertion_point(case_id) if case_id is not None else 0
+            self.current_index = min(position, len(self.navigator) - 1)
+        self.display_current_case()
         
-        conn.close()
+    def session_state(self):
+        """当前的会话快照：筛选条件、正在浏览的病例及其位置、类别列表"""
+        if self.current_case_id is None or self.session_loading:
+            return None
+        return {
+            'batch': self.batch['id'] if self.batch else None,
+            'diseases': self.selected_diseases,
+            'expression': self.filter_expression,
+            'search': self.search_text,
+            'intersect': self.search_intersect_var.get(),
+            'case_id': self.current_case_id,
+            'position': self.current_index,
+            'total': len(self.navigator),
+            'disease_names': self.all_diseases,
+        }
+        
+    def restore_session(self):
+        """按上次退出时的会话快照立即显示上次的病例，完整的筛选结果在后台加载完成后再接上
+        
+        只需读取快照和一个病例，启动时不必等待筛选、锚点扫描和类别列表；没有可用快照时返回 False。
+        """
+        session = self.engine.load_session(self.annotator)
+        if not session or session.get('batch') != (self.batch['id'] if self.batch else None):
+            return False
+        row = self.case_cache.get(session['case_id'])
+        if row is None:
+            return False
+        
+        self.selected_diseases = session['diseases']
+        self.filter_expression = session['expression']
+        self.search_text = session['search']
+        self.search_var.set(self.search_text)
+        self.search_intersect_var.set(session['intersect'])
+        self.set_disease_names(session['disease_names'])
+        
+        # 完整结果到达之前只有这一个病例可以浏览
+        self.load_generation += 1
+        self.session_loading = True
+        self.navigator = ListNavigator([row[0]])
+        self.filter_key = filter_key(self.selected_diseases, self.search_text, session['intersect'],
+                                     self.batch_range(), self.filter_expression)
+        self.current_index = 0
         self.display_current_case()
+        self.status_var.set(f"记录 {session['position'] + 1}/{session['total']}（正在加载筛选结果…）")
+        
+        generation = self.load_generation
+        intersect = session['intersect']
+        
+        def load(job):
+            navigator, key = self.open_navigator(intersect)
+            return navigator, key, self.engine.disease_names()
+        
+        def on_error(e):
+            # 快照中的筛选条件已失效等：按常规方式加载（并提示）
+            if generation == self.load_generation:
+                self.load_data()
+        
+        self.root.after(SESSION_LOAD_DELAY, lambda: self.jobs.submit(
+            "加载筛选结果", load,
+            on_done=lambda result: self.finish_session_load(generation, *result), on_error=on_error
+        ))
+        return True
+        
+    def finish_session_load(self, generation, navigator, key, diseases):
+        """后台加载完成：换上完整的筛选结果，停留在正在浏览的病例上"""
+        if generation != self.load_generation:
+            # 加载期间已切换了筛选条件
+            navigator.close()
+            return
+        self.session_loading = False
+        self.set_disease_names(diseases)
+        case_id = self.current_case_id
+        position = navigator.position_of(case_id)
+        if position is None:
+            self.save_current_annotation()
+            self.show_navigator(navigator, key, case_id)
+            return
+        # 病例不变时不重新显示，保留加载期间已输入的标注
+        self.navigator.close()
+        self.navigator, self.filter_key = navigator, key
+        self.current_index = position
+        self.update_status()
+        
+    def current_position(self):
+        """(筛选键, 正在浏览的病例id)，没有正在浏览的病例时为 None"""
+        if self.current_case_id is None:
+            return None
+        return self.filter_key, self.current_case_id
+        
+    def remember_position(self):
+        """在写队列中保存当前筛选条件下正在浏览的病例"""
+        position = self.current_position()
+        if position is not None:
+            self.jobs.submit("保存浏览位置", lambda job: self.engine.save_position(*position), write=True)
+        
+    def results_pending(self):
+        """启动时的完整筛选结果尚未加载完成（此时提示稍候）"""
+        if self.session_loading:
+            messagebox.showinfo("请稍候", "正在加载筛选结果，请稍候再试")
+        return self.session_loading
+        
+    def goto_record(self):
+        """跳转到第N条记录（从1开始）"""
+        if self.results_pending():
+            return
+        text = self.goto_var.get().strip()
+        if not text.isdigit() or not 1 <= int(text) <= len(self.navigator):
+            messagebox.showwarning("警告", f"请输入 1 到 {len(self.navigator)} 之间的记录号")
+            return
+        self.jump_to(int(text) - 1)
+        
+    def goto_id(self):
+        """跳转到指定ID的病例"""
+        case_id = self.goto_var.get().strip()
+        if not case_id or self.results_pending():
+            return
+        position = self.navigator.position_of(case_id)
+        if position is None:
+            messagebox.showwarning("警告", f"当前筛选结果中没有ID为 {case_id} 的病例")
+            return
+        self.jump_to(position)
+        
+    def jump_to(self, position):
+        with self.engine.instrumentation.measure("navigate", direction="jump"):
+            self.save_current_annotation()
+            self.current_index = position
+            self.display_current_case()
+        
+    def apply_search(self):
+        """按检索框内容筛选病例"""
+        self.flush_annotations()
+        self.search_text = self.search_var.get().strip()
+        self.load_data()
+        
+    def clear_search(self):
+        self.search_var.set("")
+        self.apply_search()
+        
+    def filter_active(self):
+        """当前是否有类别筛选或全文检索条件"""
+        return bool(self.selected_diseases or self.filter_expression or self.search_text)
         
     def display_current_case(self):
         """显示当前病例"""
-        if self.current_index < 0 or self.current_index >= len(self.filtered_ids):
+        self.completer.hide()
+        self.current_case_id = None
+        if self.current_index < 0 or self.current_index >= len(self.navigator):
             self.id_var.set("")
-            self.desc_text.config(state=tk.NORMAL)
-            self.desc_text.delete(1.0, tk.END)
-            self.diag_text.config(state=tk.NORMAL)
-            self.diag_text.delete(1.0, tk.END)
+            self.desc_view.set_text("")
+            self.diag_view.set_text("")
             self.anno_text.delete(1.0, tk.END)
             self.status_var.set("无数据")
             return
         
-        case_id = self.filtered_ids[self.current_index]
+        case_id = self.navigator.id_at(self.current_index)
+        row = self.case_cache.get(case_id)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, description, diagnosis, annotations FROM cases WHERE id = ?", (case_id,))
-        row = cursor.fetchone()
-        conn.close()
+        # 预取前后相邻的病例，下一次翻页直接命中缓存
+        self.case_cache.prefetch(self.navigator.ids_between(
+            self.current_index - PREFETCH_BEHIND, self.current_index + PREFETCH_AHEAD + 1
+        ))
         
         if row:
             self.id_var.set(row[0])
             
-            self.desc_text.config(state=tk.NORMAL)
-            self.desc_text.delete(1.0, tk.END)
-            self.desc_text.insert(1.0, row[1])
-            
-            self.diag_text.config(state=tk.NORMAL)
-            self.diag_text.delete(1.0, tk.END)
-            self.diag_text.insert(1.0, row[2])
+            # 超长的描述/诊断分段显示，避免一次性插入卡住界面
+            self.desc_view.set_text(row[1])
+            self.diag_view.set_text(row[2])
             
+            # 尚未写回数据库的修改优先
+            annotation = self.annotation_writer.pending_value(row[0])
+            if annotation is None:
+                annotation = row[3]
             self.anno_text.delete(1.0, tk.END)
-            self.anno_text.insert(1.0, row[3])
+            self.anno_text.insert(1.0, annotation)
+            self.anno_text.edit_modified(False)
+            self.current_case_id = row[0]
+            self.loaded_annotation = annotation
+            self.loaded_version = row[4]
             
-            self.status_var.set(f"记录 {self.current_index + 1}/{len(self.filtered_ids)}")
+            self.update_status()
+        
+    def update_status(self):
+        """状态栏：任务号和当前记录位置"""
+        status = f"记录 {self.current_index + 1}/{len(self.navigator)}"
+        if self.batch:
+            status = f"任务 #{self.batch['id']}  " + status
+        self.status_var.set(status)
+        
+    def update_job_status(self):
+        """状态栏右侧：排队和执行中的后台任务及进度"""
+        parts = []
+        for job in self.jobs.active():
+            done, total = job.progress
+            if job.status == 'pending':
+                parts.append(f"{job.name}（排队中）")
+            elif total:
+                parts.append(f"{job.name} {min(done, total) * 100 // total}%")
+            else:
+                parts.append(job.name)
+        self.jobs_var.set("后台任务: " + "、".join(parts) if parts else "")
         
     def save_current_annotation(self):
         """保存当前标注"""
-        if self.current_index < 0 or self.current_index >= len(self.filtered_ids):
+        if self.current_case_id is None:
+            return
+        
+        # 未编辑过或内容与加载时相同则无需写入
+        if not self.anno_text.edit_modified():
             return
         
-        case_id = self.filtered_ids[self.current_index]
+        case_id = self.current_case_id
         new_annotation = self.anno_text.get(1.0, tk.END).strip()
+        self.anno_text.edit_modified(False)
+        if new_annotation == (self.loaded_annotation or '').strip():
+            return
+        
+        self.annotation_writer.submit(case_id, new_annotation, self.loaded_version)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE cases SET annotations = ? WHERE id = ?", (new_annotation, case_id))
-        conn.commit()
-        conn.close()
+        # 补全索引的病例数随之增减，新输入的类别名下次即可补全
+        if self.completion_index is not None:
+            old, new = set(split_diseases(self.loaded_annotation)), set(split_diseases(new_annotation))
+            for disease in new - old:
+                self.completion_index.adjust(disease, 1)
+            for disease in old - new:
+                self.completion_index.adjust(disease, -1)
+        self.loaded_annotation = new_annotation
         
     def select_diseases(self):
-        """选择疾病筛选类别（带滚动条优化版）"""
+        """选择疾病筛选类别（虚拟化列表，支持输入过滤）"""
         if not self.all_diseases:
             messagebox.showwarning("警告", "没有可用的疾病类别")
             return
         
         select_window = tk.Toplevel(self.root)
         select_window.title("选择筛选类别")
-        select_window.geometry("450x500")
+        select_window.geometry("450x560")
         select_window.transient(self.root)
         select_window.grab_set()
         
-        main_frame = ttk.Frame(select_window)
-        main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        
-        canvas = tk.Canvas(main_frame)
-        scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=canvas.yview)
-        scrollable_frame = ttk.Frame(canvas)
-        
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-        
-        def on_frame_configure(event):
-            canvas.configure(scrollregion=canvas.bbox("all"))
-        
-        scrollable_frame.bind("<Configure>", on_frame_configure)
-        
-        def on_mousewheel(event):
-            canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+        # 组合条件：填写后代替下面勾选的类别（任一匹配）
+        expression_frame = ttk.LabelFrame(select_window, text="组合条件（可选，填写后代替勾选的类别）")
+        expression_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+        expression_var = tk.StringVar(value=self.filter_expression)
+        ttk.Entry(expression_frame, textvariable=expression_var).pack(fill=tk.X, padx=5, pady=(5, 0))
+        ttk.Label(expression_frame, foreground='#777',
+                  text="AND / OR / NOT 和括号，如：肺炎 AND 糖尿病 NOT 结核；标签数>3").pack(anchor=tk.W, padx=5, pady=(0, 5))
         
-        canvas.bind_all("<MouseWheel>", on_mousewheel)
-        
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
-        
-        vars_list = []
-        
-        for i, disease in enumerate(self.all_diseases):
-            var = tk.BooleanVar(value=disease in self.selected_diseases)
-            vars_list.append(var)
-            cb = ttk.Checkbutton(scrollable_frame, text=disease, variable=var)
-            cb.grid(row=i, column=0, sticky=tk.W, padx=5, pady=2)
+        picker = self.create_disease_picker(select_window, multi=True, selected=self.selected_diseases)
         
         btn_frame = ttk.Frame(select_window)
         btn_frame.pack(pady=10, padx=10)
         
+        def add_to_expression():
+            """把勾选的类别（任一匹配）追加到组合条件中"""
+            names = [quote_filter_name(d) for d in self.all_diseases if d in picker.selected]
+            if not names:
+                return
+            term = " OR ".join(names)
+            expression = expression_var.get().strip()
+            if expression:
+                term = f"{expression} AND ({term})" if len(names) > 1 else f"{expression} AND {term}"
+            expression_var.set(term)
+        
         def confirm_selection():
-            self.selected_diseases = [self.all_diseases[i] for i, var in enumerate(vars_list) if var.get()]
+            expression = expression_var.get().strip()
+            if expression:
+                # 界面线程只检查语法和类别名，查询交给后台任务
+                try:
+                    unknown = expression_diseases(parse_filter_expression(expression)) - set(self.all_diseases)
+                except FilterExpressionError as e:
+                    messagebox.showerror("组合条件有误", str(e), parent=select_window)
+                    return
+                if unknown:
+                    messagebox.showerror("组合条件有误", "没有这些类别: " + "、".join(sorted(unknown)),
+                                         parent=select_window)
+                    return
+            self.filter_expression = expression
+            self.selected_diseases = [d for d in self.all_diseases if d in picker.selected]
             select_window.destroy()
-            self.load_data()
+            self.flush_annotations()
+            self.apply_filter()
         
         ttk.Button(btn_frame, text="确定", command=confirm_selection).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="取消", command=select_window.destroy).pack(side=tk.LEFT, padx=5)
         
-        def select_all():
-            for var in vars_list:
-                var.set(True)
-        
-        def clear_all():
-            for var in vars_list:
-                var.set(False)
-        
-        ttk.Button(btn_frame, text="全选", command=select_all).pack(side=tk.LEFT, padx=5)
-        ttk.Button(btn_frame, text="清空", command=clear_all).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="全选", command=picker.select_all).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="清空", command=picker.clear).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="加入组合条件", command=add_to_expression).pack(side=tk.LEFT, padx=5)
         
     def previous_case(self):
         """上一个病例"""
-        self.save_current_annotation()
-        if self.filtered_ids and self.current_index > 0:
-            self.current_index -= 1
-            self.display_current_case()
+        with self.engine.instrumentation.measure("navigate", direction="previous"):
+            self.save_current_annotation()
+            if self.current_index > 0:
+                self.current_index -= 1
+                self.display_current_case()
         
     def next_case(self):
         """下一个病例"""
+        with self.engine.instrumentation.measure("navigate", direction="next"):
+            self.save_current_annotation()
+            if self.current_index < len(self.navigator) - 1:
+                self.current_index += 1
+                self.display_current_case()
+        
+    def flush_annotations(self):
+        """把写回队列中的标注排进写队列写入数据库（筛选、导入导出、批量修改前调用）
+        
+        写队列空闲时等它写完，随后的读取能看到最新标注；前面排着导入等长时间的写任务时不等待，以免界面卡住，
+        之后提交的写任务仍在这次写入之后执行。
+        """
         self.save_current_annotation()
-        if self.filtered_ids and self.current_index < len(self.filtered_ids) - 1:
-            self.current_index += 1
-            self.display_current_case()
+        if not self.annotation_writer.pending_count():
+            return
+        job = self.annotation_writer.schedule_flush()
+        if not any(other.write and other is not job for other in self.jobs.active()):
+            job.wait(FLUSH_WAIT)
+        
+    def on_close(self):
+        """关闭窗口：取消后台任务并等它们提交或回滚，再写入所有未保存的标注、保存会话快照并关闭数据库连接"""
+        if self.closing:
+            return
+        active = self.jobs.active()
+        if active:
+            names = "、".join(job.name for job in active)
+            if not messagebox.askyesno("退出", f"后台任务尚未完成：{names}\n\n"
+                                              "取消这些任务并退出吗？（未完成的写入会整体回滚）"):
+                return
+        # 之后到达的任务回调不再处理；不阻塞主线程，定时检查任务是否都已结束
+        self.closing = True
+        self.jobs.cancel_all()
+        self.status_var.set("正在等待后台任务结束…")
+        self.finish_close()
+        
+    def finish_close(self):
+        if not self.jobs.wait(timeout=0):
+            self.root.after(JOB_POLL_INTERVAL, self.finish_close)
+            return
+        # 后台任务都已结束，以下写入不会与它们争抢写锁
+        self.save_current_annotation()
+        position = self.current_position()
+        if position is not None:
+            self.engine.save_position(*position)
+        session = self.session_state()
+        if session is not None:
+            self.engine.save_session(self.annotator, session)
+        try:
+            self.annotation_writer.close()
+        except sqlite3.Error as e:
+            if not messagebox.askyesno("保存失败", f"有 {self.annotation_writer.pending_count()} 条标注未能写入数据库: {e}\n仍然退出？"):
+                # 继续使用：恢复定时写回，之后的修改照常写入
+                self.closing = False
+                self.annotation_writer.reopen()
+                self.update_job_status()
+                return
+        self.jobs.shutdown()
+        self.case_cache.close()
+        self.engine.close()
+        self.root.destroy()
 
 if __name__ == "__main__":
+    # 打包为可执行文件时，导入用的解析子进程需要先经过这里
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="医疗数据标注工具")
+    parser.add_argument("--db", help="数据库文件（多人共用时指向同一个文件；默认为环境变量 ANNOTATOR_DB 或 medical_data.db）")
+    parser.add_argument("--annotator", help="标注员名称（默认为环境变量 ANNOTATOR_NAME 或 用户名@主机名）")
+    args = parser.parse_args()
     root = tk.Tk()
-    app = MedicalDataAnnotator(root)
+    app = MedicalDataAnnotator(root, args.db, args.annotator)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""性能埋点：按操作计时、滚动分位数、结构化日志（JSON Lines）和 cProfile 剖析
+
+默认关闭；关闭时 measure() 直接返回空上下文，数据库查询只多一次属性判断。
+也可通过环境变量开启：
+    ANNOTATOR_PERF_LOG=perf.log     记录每次操作和查询的耗时
+    ANNOTATOR_PROFILE_DIR=profiles  对每次操作做 cProfile 剖析并保存 .prof 文件
+"""
+import os
+import json
+import time
+import sqlite3
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+# 每种操作保留的最近样本数（用于滚动分位数）
+ROLLING_WINDOW = 500
+
+# 日志中SQL语句保留的最大长度
+SQL_LOG_LENGTH = 200
+
+class Instrumentation:
+    """操作计时与剖析开关；GUI、命令行和数据库连接共用一个实例"""
+    
+    def __init__(self, log_path=None, profile_dir=None, window=ROLLING_WINDOW):
+        self.enabled = False
+        self.log_path = None
+        self.profile_dir = None
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._log = None
+        # cProfile 同一时刻只能有一个剖析器在运行，嵌套或并发的操作不再单独剖析
+        self._profile_lock = threading.Lock()
+        if log_path:
+            self.enable(log_path)
+        if profile_dir:
+            self.set_profiling(profile_dir)
+        
+    @classmethod
+    def from_environment(cls):
+        return cls(os.environ.get("ANNOTATOR_PERF_LOG"), os.environ.get("ANNOTATOR_PROFILE_DIR"))
+        
+    def enable(self, log_path=None):
+        """开启计时；给出 log_path 时同时追加写入结构化日志，否则只保留内存中的滚动样本"""
+        with self._lock:
+            if log_path != self.log_path:
+                if self._log:
+                    self._log.close()
+                self._log = open(log_path, 'a', encoding='utf-8', buffering=1) if log_path else None
+                self.log_path = log_path
+            self.enabled = True
+        
+    def disable(self):
+        """关闭计时并关闭日志文件（已有的滚动样本保留）"""
+        with self._lock:
+            self.enabled = False
+            if self._log:
+                self._log.close()
+            self._log = None
+            self.log_path = None
+        
+    def set_profiling(self, profile_dir):
+        """设置剖析输出目录，None 表示关闭剖析"""
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+        self.profile_dir = profile_dir or None
+        
+    def measure(self, operation, **fields):
+        """计时一次操作：with instrumentation.measure("import", file=path) as fields: ...
+        
+        with 块中可以往 fields 中补充字段（如处理行数），一并写入日志。
+        """
+        if not self.enabled and self.profile_dir is None:
+            return nullcontext(fields)
+        return self._measure(operation, fields)
+        
+    @contextmanager
+    def _measure(self, operation, fields):
+        profiler = None
+        if self.profile_dir is not None and self._profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields['error'] = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profile_lock.release()
+                fields['profile'] = self._dump_profile(operation, profiler)
+            if self.enabled:
+                self.record(operation, seconds, fields)
+        
+    def record(self, operation, seconds, fields=None):
+        """记录一个样本：加入滚动窗口，并写入日志（如已开启）"""
+        with self._lock:
+            samples = self._samples.get(operation)
+            if samples is None:
+                samples = self._samples[operation] = deque(maxlen=self.window)
+            samples.append(seconds)
+            if self._log is not None:
+                entry = {
+                    'ts': datetime.now().isoformat(timespec='milliseconds'),
+                    'op': operation,
+                    'ms': round(seconds * 1000, 3),
+                    'thread': threading.current_thread().name,
+                }
+                if fields:
+                    entry.update(fields)
+                self._log.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        
+    def record_query(self, sql, seconds):
+        self.record("query", seconds, {'sql': " ".join(sql.split())[:SQL_LOG_LENGTH]})
+        
+    def percentiles(self, operation):
+        """最近样本的 p50/p99（毫秒），没有样本时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples.get(operation, ()))
+        if not samples:
+            return None
+        return {
+            'count': len(samples),
+            'p50_ms': samples[len(samples) // 2] * 1000,
+            'p99_ms': samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1000,
+        }
+        
+    def summary(self):
+        """所有操作的滚动分位数"""
+        with self._lock:
+            operations = sorted(self._samples)
+        return {operation: self.percentiles(operation) for operation in operations}
+        
+    def close(self):
+        self.disable()
+        
+    def _dump_profile(self, operation, profiler):
+        file_name = f"{operation}-{datetime.now():%Y%m%d-%H%M%S-%f}.prof"
+        file_path = os.path.join(self.profile_dir, file_name)
+        profiler.dump_stats(file_path)
+        return file_path
+
+class TimedCursor(sqlite3.Cursor):
+    """计时 execute/executemany 的游标（只包含语句执行，不含之后逐行读取的时间）"""
+    
+    def execute(self, sql, parameters=()):
+        instrumentation = self.connection.instrumentation
+        if not instrumentation.enabled:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            instrumentation.record_query(sql, time.perf_counter() - start)
+        
+    def executemany(self, sql, seq_of_parameters):
+        instrumentation = self.connection.instrumentation
+        if not instrumentation.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            instrumentation.record_query(sql, time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3.connect 的连接工厂：conn.cursor() 返回 TimedCursor
+    
+    Connection.execute() 在 C 代码中直接创建普通游标，不经过 cursor()，因此开启计时时也改为经由 TimedCursor 执行；
+    关闭时直接调用原方法，不增加开销。
+    """
+    
+    instrumentation = Instrumentation()
+    
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+        
+    def execute(self, sql, parameters=()):
+        if not self.instrumentation.enabled:
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+        
+    def executemany(self, sql, seq_of_parameters):
+        if not self.instrumentation.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor().executemany(sql, seq_of_parameters)
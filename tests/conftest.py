@@ -0,0 +1,34 @@
+import os
+import sys
+import csv
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import AnnotationEngine, REQUIRED_COLUMNS
+
+def write_cases(file_path, rows):
+    """写一个导入用的CSV：rows 为 (id, 标注)"""
+    with open(file_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(REQUIRED_COLUMNS)
+        for case_id, annotations in rows:
+            writer.writerow([case_id, f"{case_id} 描述", f"{case_id} 诊断", annotations])
+    return file_path
+
+@pytest.fixture
+def make_engine(tmp_path):
+    """打开（同一个数据库文件上可打开多个）标注引擎，测试结束时关闭"""
+    engines = []
+    
+    def make(rows=None, merge=False):
+        engine = AnnotationEngine(str(tmp_path / "cases.db"))
+        engines.append(engine)
+        if rows is not None:
+            engine.import_sources([write_cases(str(tmp_path / f"cases_{len(engines)}.csv"), rows)], merge=merge)
+        return engine
+    
+    yield make
+    for engine in engines:
+        engine.close()
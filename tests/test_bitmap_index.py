@@ -0,0 +1,30 @@
+from engine import AnnotationWriter
+
+def test_sync_after_edits_in_another_process(make_engine):
+    engine_a = make_engine([("C001", "甲"), ("C002", "乙"), ("C003", "甲；乙")])
+    engine_b = make_engine()
+    assert engine_a.expression_ids("甲") == ["C001", "C003"]
+    assert engine_a.expression_ids("甲 AND NOT 乙") == ["C001"]
+    
+    writer = AnnotationWriter(engine_b.db)
+    try:
+        writer.submit("C002", "甲；丙")
+        writer.submit("C003", "乙")
+        writer.flush()
+    finally:
+        writer.close()
+    assert engine_a.expression_ids("甲") == ["C001", "C002"]
+    assert engine_a.expression_ids("丙 OR 标签数>=2") == ["C002"]
+
+def test_sync_after_replace_import_in_another_process(make_engine):
+    """另一个进程全量替换导入后，已建立的位图索引整体重建，不会按旧的病例序号继续使用"""
+    engine_a = make_engine([("C001", "甲"), ("C002", "甲"), ("C003", "乙")])
+    assert engine_a.expression_ids("甲") == ["C001", "C002"]
+    
+    engine_b = make_engine([("D001", "甲"), ("D002", "乙")])
+    assert engine_a.expression_ids("甲") == ["D001"]
+    assert engine_a.expression_ids("NOT 甲") == ["D002"]
+    
+    # 病例id不变、只有标注不同的替换导入不产生修改记录，同样要重建
+    make_engine([("D001", "乙"), ("D002", "甲")])
+    assert engine_a.expression_ids("甲") == ["D002"]
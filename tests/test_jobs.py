@@ -0,0 +1,63 @@
+import time
+import threading
+
+from engine import AnnotationWriter, JobScheduler
+
+def test_write_jobs_run_one_at_a_time_in_order():
+    scheduler = JobScheduler()
+    events, lock = [], threading.Lock()
+    
+    def write(job, index):
+        with lock:
+            events.append(('start', index, threading.current_thread().name))
+        time.sleep(0.01)
+        with lock:
+            events.append(('end', index, threading.current_thread().name))
+        return index
+    
+    try:
+        jobs = [scheduler.submit(f"写入 {i}", lambda job, i=i: write(job, i), write=True) for i in range(5)]
+        assert scheduler.wait(5)
+    finally:
+        scheduler.shutdown()
+    assert [job.result for job in jobs] == list(range(5))
+    assert [job.status for job in jobs] == ['done'] * 5
+    # 每个写任务都在前一个结束之后才开始，且都在同一个写线程中执行
+    assert [event[:2] for event in events] == [(kind, i) for i in range(5) for kind in ('start', 'end')]
+    assert {event[2] for event in events} == {"job-writer"}
+
+def test_read_jobs_run_beside_a_running_write_job():
+    scheduler = JobScheduler(workers=2)
+    barrier = threading.Barrier(3, timeout=5)
+    try:
+        # 写任务执行期间，两个只读任务同时在线程池中执行
+        jobs = [scheduler.submit("写入", lambda job: barrier.wait(), write=True)]
+        jobs += [scheduler.submit(f"读取 {i}", lambda job: barrier.wait()) for i in range(2)]
+        assert scheduler.wait(5)
+    finally:
+        scheduler.shutdown()
+    assert [job.status for job in jobs] == ['done'] * 3
+
+def test_annotation_flush_queues_behind_other_writes(make_engine):
+    """给出 jobs 时标注写回排在已提交的写任务之后，在写线程中执行"""
+    engine = make_engine([("C001", "甲")])
+    scheduler = JobScheduler()
+    writer = AnnotationWriter(engine.db, jobs=scheduler)
+    release = threading.Event()
+    order = []
+    try:
+        blocker = scheduler.submit("导入", lambda job: (release.wait(5), order.append("导入")), write=True)
+        writer.submit("C001", "乙")
+        flush = writer.schedule_flush()
+        # 尚未开始的刷新任务会带上之后登记的修改，不重复排队
+        assert writer.schedule_flush() is flush
+        time.sleep(0.05)
+        assert flush.status == 'pending' and writer.pending_count() == 1
+        release.set()
+        assert flush.wait(5)
+        assert blocker.finished and order == ["导入"]
+    finally:
+        writer.close()
+        scheduler.shutdown()
+    assert flush.result == 1
+    assert engine.query_ids(["乙"]) == ["C001"]
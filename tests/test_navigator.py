@@ -0,0 +1,67 @@
+from engine import AnnotationWriter, CaseNavigator, filter_source
+
+def case_ids(count):
+    return [f"C{i:03d}" for i in range(count)]
+
+def open_navigator(engine, diseases=(), search_text=""):
+    sql, params = filter_source(diseases, search_text, fts_enabled=engine.fts_enabled)
+    return CaseNavigator(engine.db, sql, params, anchor_interval=4, page_size=6)
+
+def test_paging_matches_sorted_ids(make_engine):
+    ids = case_ids(30)
+    engine = make_engine([(case_id, "甲" if i % 3 else "乙") for i, case_id in enumerate(reversed(ids))])
+    navigator = open_navigator(engine, ["甲"])
+    expected = sorted(case_id for i, case_id in enumerate(reversed(ids)) if i % 3)
+    try:
+        assert len(navigator) == len(expected)
+        assert [navigator.id_at(i) for i in range(len(navigator))] == expected
+        assert [navigator.id_at(i) for i in reversed(range(len(navigator)))] == expected[::-1]
+        assert navigator.ids_between(-2, 5) == expected[:5]
+        assert navigator.ids_between(15, 100) == expected[15:]
+        assert list(navigator) == expected
+    finally:
+        navigator.close()
+
+def test_position_of(make_engine):
+    ids = case_ids(25)
+    engine = make_engine([(case_id, "甲") for case_id in ids[::2]] + [(case_id, "乙") for case_id in ids[1::2]])
+    navigator = open_navigator(engine, ["甲"])
+    try:
+        for position, case_id in enumerate(ids[::2]):
+            assert navigator.position_of(case_id) == position
+        # 不在结果中的病例：position_of 为 None，insertion_point 为它应在的位置
+        assert navigator.position_of("C003") is None
+        assert navigator.insertion_point("C003") == 2
+        assert navigator.insertion_point("A") == 0
+        assert navigator.insertion_point("Z") == len(navigator)
+    finally:
+        navigator.close()
+
+def test_paging_while_edits_remove_filtered_category(make_engine):
+    """逐条翻页并删掉正在筛选的类别：结果是创建时的快照，翻页不跳过、不越界"""
+    ids = case_ids(40)
+    engine = make_engine([(case_id, "甲；乙") for case_id in ids])
+    writer = AnnotationWriter(engine.db)
+    try:
+        # 单个类别和多个类别的筛选，每条病例都在翻到时改掉被筛选的类别
+        for diseases, annotation in ((["甲"], "乙"), (["甲", "乙"], "丙")):
+            navigator = open_navigator(engine, diseases)
+            try:
+                seen = []
+                for position in range(len(navigator)):
+                    case_id = navigator.id_at(position)
+                    seen.append(case_id)
+                    writer.submit(case_id, annotation)
+                    writer.flush()
+                assert seen == ids
+                assert len(navigator) == len(ids)
+                assert navigator.position_of(ids[-1]) == len(ids) - 1
+            finally:
+                navigator.close()
+            
+            # 重新筛选才反映修改后的数据
+            navigator = engine.navigator(diseases)
+            assert len(navigator) == 0
+            navigator.close()
+    finally:
+        writer.close()
@@ -0,0 +1,48 @@
+from engine import AnnotationWriter
+
+def stored(engine, case_id):
+    with engine.db.connection() as conn:
+        return tuple(conn.execute("SELECT annotations, version FROM cases WHERE id = ?", (case_id,)).fetchone())
+
+def test_version_conflict_between_annotators(make_engine):
+    """两个标注员基于同一版本修改同一病例：后写入的一方不覆盖，而是得到冲突"""
+    engine_a = make_engine([("C001", "甲"), ("C002", "乙")])
+    engine_b = make_engine()
+    writer_a, writer_b = AnnotationWriter(engine_a.db), AnnotationWriter(engine_b.db)
+    try:
+        _, version = stored(engine_a, "C001")
+        writer_a.submit("C001", "甲；丙", version)
+        writer_b.submit("C001", "丁", version)
+        writer_b.submit("C002", "戊", stored(engine_b, "C002")[1])
+        assert writer_a.flush() == 1
+        assert writer_b.flush() == 1
+        
+        conflicts = writer_b.take_conflicts()
+        assert conflicts == [{'case_id': "C001", 'mine': "丁", 'theirs': "甲；丙", 'version': version + 1}]
+        assert writer_b.take_conflicts() == []
+        assert stored(engine_a, "C001") == ("甲；丙", version + 1)
+        assert stored(engine_a, "C002")[0] == "戊"
+        
+        # 保留自己的修改：以对方写入后的版本为基准重新写入
+        writer_b.overwrite(conflicts[0])
+        assert writer_b.flush() == 1
+        assert writer_b.take_conflicts() == []
+        assert stored(engine_a, "C001") == ("丁", version + 2)
+    finally:
+        writer_a.close()
+        writer_b.close()
+
+def test_own_edits_do_not_conflict(make_engine):
+    """同一病例连续修改（仍带着加载时的版本号）不算与自己冲突"""
+    engine = make_engine([("C001", "甲")])
+    conflicts = []
+    writer = AnnotationWriter(engine.db, on_conflict=lambda: conflicts.extend(writer.take_conflicts()))
+    try:
+        _, version = stored(engine, "C001")
+        for annotation in ("乙", "丙", "丁"):
+            writer.submit("C001", annotation, version)
+            assert writer.flush() == 1
+        assert conflicts == []
+        assert stored(engine, "C001") == ("丁", version + 3)
+    finally:
+        writer.close()